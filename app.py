@@ -4,18 +4,20 @@ FastAPI 后端：案例管理 / URL导入 / AI灵感搜索 / 图谱数据 / 图
 """
 from dotenv import load_dotenv
 load_dotenv()
-import json, uuid, os, re, shutil
+import json, uuid, os, re, shutil, copy, threading, logging, asyncio, time, zlib, gzip, io, itertools, tempfile, hashlib, mimetypes, contextvars
 from pathlib import Path
 from typing import Optional
-from contextlib import asynccontextmanager
-from functools import lru_cache
-from datetime import datetime, timedelta
+from contextlib import asynccontextmanager, contextmanager, nullcontext
+from functools import lru_cache, partial
+from datetime import datetime
+from collections import OrderedDict, Counter, deque
 
 import httpx
 from bs4 import BeautifulSoup
-from fastapi import FastAPI, HTTPException, UploadFile, File, Form
+from fastapi import FastAPI, HTTPException, UploadFile, File, Form, Request
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import FileResponse, Response
+from fastapi.responses import FileResponse, Response, StreamingResponse, JSONResponse
+from starlette.datastructures import Headers, MutableHeaders
 from pydantic import BaseModel
 from openai import OpenAI
 
@@ -27,213 +29,48 @@ SEED_FILE = Path("seed_data.json")
 TAGS_FILE = Path("tags.json")
 CONCEPTS_FILE = Path("concepts.json")
 NEBULAS_FILE = Path("nebulas.json")
-HISTORY_FILE = Path("history.json")
+HISTORY_FILE = Path("history.jsonl")
+LEGACY_HISTORY_FILE = Path("history.json")  # 旧版：每次操作存一份全量快照
+STORAGE_FORMAT = os.getenv("STORAGE_FORMAT", "json").lower()  # json（缩进，兼容旧版）/ compact / msgpack
+JOURNAL_MODE = os.getenv("JOURNAL_MODE", "false").lower() == "true"  # JSON 模式下使用追加式变更日志
+JOURNAL_FILE = Path("data.journal")
+JOURNAL_COMPACT_BYTES = int(os.getenv("JOURNAL_COMPACT_BYTES", str(4 * 1024 * 1024)))  # 日志超过该大小后台折叠
 SNAPSHOTS_DIR = Path("snapshots")
 SNAPSHOTS_DIR.mkdir(exist_ok=True)
 
-# —— Performance Cache ——
-_graph_cache = None
-_graph_cache_time = None
-CACHE_TTL = timedelta(seconds=5)  # 5秒缓存
-
-def _get_cached_graph(active_nebula_id: Optional[str] = None):
-    """获取缓存的图谱数据"""
-    global _graph_cache, _graph_cache_time
-    cache_key = f"graph_{active_nebula_id or 'all'}"
-    if _graph_cache_time and datetime.now() - _graph_cache_time < CACHE_TTL:
-        if cache_key in _graph_cache:
-            return _graph_cache[cache_key]
-    return None
+logger = logging.getLogger("archgraph")
 
-def _set_cached_graph(active_nebula_id: Optional[str] = None, graph_data: dict = None):
-    """设置缓存的图谱数据"""
-    global _graph_cache, _graph_cache_time
-    if _graph_cache is None:
-        _graph_cache = {}
-    cache_key = f"graph_{active_nebula_id or 'all'}"
-    _graph_cache[cache_key] = graph_data
-    _graph_cache_time = datetime.now()
+# —— Performance Cache ——
+GRAPH_CACHE_SIZE = int(os.getenv("GRAPH_CACHE_SIZE", "32"))  # 最多缓存多少个星云视图
+GRAPH_DELTA_LOG = int(os.getenv("GRAPH_DELTA_LOG", "1000"))    # 保留多少个版本的图谱增量供断线重连补发
+_graph_cache: "OrderedDict[tuple, dict]" = OrderedDict()
+_graph_cache_lock = threading.Lock()
+
+def _get_cached_graph(view: tuple):
+    """获取缓存的图谱数据。以 (视图参数, 数据版本) 为键，数据没变就一直有效。"""
+    key = (view, repo.version)
+    with _graph_cache_lock:
+        graph = _graph_cache.get(key)
+        if graph is not None:
+            _graph_cache.move_to_end(key)
+        return graph
+
+def _set_cached_graph(view: tuple, graph_data: dict, version: int):
+    """设置缓存的图谱数据，超出容量时淘汰最久未使用的视图"""
+    with _graph_cache_lock:
+        _graph_cache[(view, version)] = graph_data
+        _graph_cache.move_to_end((view, version))
+        while len(_graph_cache) > GRAPH_CACHE_SIZE:
+            _graph_cache.popitem(last=False)
 
 def _invalidate_graph_cache():
-    """使图谱缓存失效"""
-    global _graph_cache, _graph_cache_time
-    _graph_cache = None
-    _graph_cache_time = None
+    """数据版本变化后丢弃旧版本的缓存"""
+    with _graph_cache_lock:
+        for key in [k for k in _graph_cache if k[1] != repo.version]:
+            del _graph_cache[key]
 UPLOAD_DIR = Path("static/uploads")
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
-# —— Database layer (optional SQLite support) ——
-if USE_DATABASE:
-    import sqlite3
-    def _init_db():
-        """初始化SQLite数据库"""
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS cases (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            architect TEXT,
-            year TEXT,
-            location TEXT,
-            tags TEXT,
-            description TEXT,
-            image_url TEXT,
-            source_url TEXT,
-            data TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS concepts (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            keywords TEXT,
-            description TEXT,
-            image_url TEXT,
-            source_url TEXT,
-            data TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS tags (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            parent_id TEXT,
-            parent_ids TEXT,
-            parent_details TEXT,
-            children TEXT,
-            data TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS nebulas (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            case_ids TEXT,
-            concept_ids TEXT,
-            data TEXT
-        )''')
-        conn.commit()
-        conn.close()
-    _init_db()
-
-    def _db_load_cases() -> list[dict]:
-        """从数据库加载案例"""
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("SELECT * FROM cases")
-        rows = c.fetchall()
-        conn.close()
-        cases = []
-        for row in rows:
-            case = json.loads(row[9]) if row[9] else {}
-            case.update({
-                "id": row[0], "name": row[1], "architect": row[2], "year": row[3],
-                "location": row[4], "tags": json.loads(row[5]) if row[5] else [],
-                "description": row[6], "image_url": row[7], "source_url": row[8]
-            })
-            cases.append(case)
-        return cases
-
-    def _db_save_cases(cases: list[dict]):
-        """保存案例到数据库"""
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("DELETE FROM cases")
-        for case in cases:
-            c.execute("INSERT INTO cases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-                (case.get("id"), case.get("name"), case.get("architect"), case.get("year"),
-                 case.get("location"), json.dumps(case.get("tags", [])), case.get("description"),
-                 case.get("image_url"), case.get("source_url"), json.dumps(case)))
-        conn.commit()
-        conn.close()
-
-    def _db_load_concepts() -> list[dict]:
-        """从数据库加载概念"""
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("SELECT * FROM concepts")
-        rows = c.fetchall()
-        conn.close()
-        concepts = []
-        for row in rows:
-            concept = json.loads(row[6]) if row[6] else {}
-            concept.update({
-                "id": row[0], "name": row[1], "keywords": row[2], "description": row[3],
-                "image_url": row[4], "source_url": row[5]
-            })
-            concepts.append(concept)
-        return concepts
-
-    def _db_save_concepts(concepts: list[dict]):
-        """保存概念到数据库"""
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("DELETE FROM concepts")
-        for concept in concepts:
-            c.execute("INSERT INTO concepts VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (concept.get("id"), concept.get("name"), concept.get("keywords"),
-                 concept.get("description"), concept.get("image_url"), concept.get("source_url"),
-                 json.dumps(concept)))
-        conn.commit()
-        conn.close()
-
-    def _db_load_tags() -> dict:
-        """从数据库加载标签"""
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("SELECT * FROM tags")
-        rows = c.fetchall()
-        conn.close()
-        tags = {}
-        for row in rows:
-            tag = json.loads(row[6]) if row[6] else {}
-            tag.update({
-                "id": row[0], "name": row[1], "parent_id": row[2],
-                "parent_ids": json.loads(row[3]) if row[3] else [],
-                "parent_details": json.loads(row[4]) if row[4] else [],
-                "children": json.loads(row[5]) if row[5] else []
-            })
-            tags[row[0]] = tag
-        return tags
-
-    def _db_save_tags(tags: dict):
-        """保存标签到数据库"""
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("DELETE FROM tags")
-        for tid, tag in tags.items():
-            c.execute("INSERT INTO tags VALUES (?, ?, ?, ?, ?, ?, ?)",
-                (tid, tag.get("name"), tag.get("parent_id"),
-                 json.dumps(tag.get("parent_ids", [])), json.dumps(tag.get("parent_details", [])),
-                 json.dumps(tag.get("children", [])), json.dumps(tag)))
-        conn.commit()
-        conn.close()
-
-    def _db_load_nebulas() -> list[dict]:
-        """从数据库加载星云"""
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("SELECT * FROM nebulas")
-        rows = c.fetchall()
-        conn.close()
-        nebulas = []
-        for row in rows:
-            nebula = json.loads(row[4]) if row[4] else {}
-            nebula.update({
-                "id": row[0], "name": row[1],
-                "case_ids": json.loads(row[2]) if row[2] else [],
-                "concept_ids": json.loads(row[3]) if row[3] else []
-            })
-            nebulas.append(nebula)
-        return nebulas
-
-    def _db_save_nebulas(nebulas: list[dict]):
-        """保存星云到数据库"""
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute("DELETE FROM nebulas")
-        for nebula in nebulas:
-            c.execute("INSERT INTO nebulas VALUES (?, ?, ?, ?, ?)",
-                (nebula.get("id"), nebula.get("name"),
-                 json.dumps(nebula.get("case_ids", [])), json.dumps(nebula.get("concept_ids", [])),
-                 json.dumps(nebula)))
-        conn.commit()
-        conn.close()
-
 client = OpenAI(
     api_key=os.getenv("LLM_API_KEY", "sk-xxx"),
     base_url=os.getenv("LLM_BASE_URL", "https://api.openai.com/v1"),
@@ -247,60 +84,46 @@ DOUBAO_IMAGE_API_URL = os.getenv("DOUBAO_IMAGE_API_URL", "https://ark.cn-beijing
 # —— Database layer (optional SQLite support) ——
 if USE_DATABASE:
     import sqlite3
-    def _init_db():
-        """初始化SQLite数据库"""
-        conn = sqlite3.connect(DB_FILE)
-        c = conn.cursor()
-        c.execute('''CREATE TABLE IF NOT EXISTS cases (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            architect TEXT,
-            year TEXT,
-            location TEXT,
-            tags TEXT,
-            description TEXT,
-            image_url TEXT,
-            source_url TEXT,
-            data TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS concepts (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            keywords TEXT,
-            description TEXT,
-            image_url TEXT,
-            source_url TEXT,
-            data TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS tags (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            parent_id TEXT,
-            parent_ids TEXT,
-            parent_details TEXT,
-            children TEXT,
-            data TEXT
-        )''')
-        c.execute('''CREATE TABLE IF NOT EXISTS nebulas (
-            id TEXT PRIMARY KEY,
-            name TEXT,
-            case_ids TEXT,
-            concept_ids TEXT,
-            data TEXT
+
+_DB_SCHEMA = {
+    "cases": ("id", "name", "architect", "year", "location", "tags", "description", "image_url", "source_url", "data"),
+    "concepts": ("id", "name", "keywords", "description", "image_url", "source_url", "data"),
+    "tags": ("id", "name", "parent_id", "parent_ids", "parent_details", "children", "data"),
+    "nebulas": ("id", "name", "case_ids", "concept_ids", "data"),
+}
+_db_conn = None
+_db_lock = threading.Lock()
+
+def _db():
+    """进程内复用的 SQLite 连接：WAL 模式下写入不阻塞读取"""
+    global _db_conn
+    if _db_conn is None:
+        conn = sqlite3.connect(DB_FILE, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _db_conn = conn
+    return _db_conn
+
+def _init_db():
+    """初始化SQLite数据库"""
+    with _db_lock, _db() as conn:
+        for table, columns in _DB_SCHEMA.items():
+            cols = ",\n            ".join(f"{c} TEXT PRIMARY KEY" if c == "id" else f"{c} TEXT" for c in columns)
+            conn.execute(f'''CREATE TABLE IF NOT EXISTS {table} (
+            {cols}
         )''')
-        conn.commit()
-        conn.close()
+
+if USE_DATABASE:
     _init_db()
 
+def _db_rows(table: str) -> list:
+    with _db_lock:
+        return _db().execute(f"SELECT * FROM {table} ORDER BY rowid").fetchall()
+
 def _db_load_cases() -> list[dict]:
     """从数据库加载案例"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM cases")
-    rows = c.fetchall()
-    conn.close()
     cases = []
-    for row in rows:
+    for row in _db_rows("cases"):
         case = json.loads(row[9]) if row[9] else {}
         case.update({
             "id": row[0], "name": row[1], "architect": row[2], "year": row[3],
@@ -310,58 +133,22 @@ def _db_load_cases() -> list[dict]:
         cases.append(case)
     return cases
 
-def _db_save_cases(cases: list[dict]):
-    """保存案例到数据库"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM cases")
-    for case in cases:
-        c.execute("INSERT INTO cases VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
-            (case.get("id"), case.get("name"), case.get("architect"), case.get("year"),
-             case.get("location"), json.dumps(case.get("tags", [])), case.get("description"),
-             case.get("image_url"), case.get("source_url"), json.dumps(case)))
-    conn.commit()
-    conn.close()
-
 def _db_load_concepts() -> list[dict]:
     """从数据库加载概念"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM concepts")
-    rows = c.fetchall()
-    conn.close()
     concepts = []
-    for row in rows:
+    for row in _db_rows("concepts"):
         concept = json.loads(row[6]) if row[6] else {}
         concept.update({
-            "id": row[0], "name": row[1], "keywords": row[2], "description": row[3],
+            "id": row[0], "name": row[1], "keywords": json.loads(row[2]) if row[2] else [], "description": row[3],
             "image_url": row[4], "source_url": row[5]
         })
         concepts.append(concept)
     return concepts
 
-def _db_save_concepts(concepts: list[dict]):
-    """保存概念到数据库"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM concepts")
-    for concept in concepts:
-        c.execute("INSERT INTO concepts VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (concept.get("id"), concept.get("name"), concept.get("keywords"),
-             concept.get("description"), concept.get("image_url"), concept.get("source_url"),
-             json.dumps(concept)))
-    conn.commit()
-    conn.close()
-
 def _db_load_tags() -> dict:
     """从数据库加载标签"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM tags")
-    rows = c.fetchall()
-    conn.close()
     tags = {}
-    for row in rows:
+    for row in _db_rows("tags"):
         tag = json.loads(row[6]) if row[6] else {}
         tag.update({
             "id": row[0], "name": row[1], "parent_id": row[2],
@@ -372,28 +159,10 @@ def _db_load_tags() -> dict:
         tags[row[0]] = tag
     return tags
 
-def _db_save_tags(tags: dict):
-    """保存标签到数据库"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM tags")
-    for tid, tag in tags.items():
-        c.execute("INSERT INTO tags VALUES (?, ?, ?, ?, ?, ?, ?)",
-            (tid, tag.get("name"), tag.get("parent_id"),
-             json.dumps(tag.get("parent_ids", [])), json.dumps(tag.get("parent_details", [])),
-             json.dumps(tag.get("children", [])), json.dumps(tag)))
-    conn.commit()
-    conn.close()
-
 def _db_load_nebulas() -> list[dict]:
     """从数据库加载星云"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT * FROM nebulas")
-    rows = c.fetchall()
-    conn.close()
     nebulas = []
-    for row in rows:
+    for row in _db_rows("nebulas"):
         nebula = json.loads(row[4]) if row[4] else {}
         nebula.update({
             "id": row[0], "name": row[1],
@@ -403,111 +172,703 @@ def _db_load_nebulas() -> list[dict]:
         nebulas.append(nebula)
     return nebulas
 
-def _db_save_nebulas(nebulas: list[dict]):
-    """保存星云到数据库"""
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("DELETE FROM nebulas")
-    for nebula in nebulas:
-        c.execute("INSERT INTO nebulas VALUES (?, ?, ?, ?, ?)",
-            (nebula.get("id"), nebula.get("name"),
-             json.dumps(nebula.get("case_ids", [])), json.dumps(nebula.get("concept_ids", [])),
-             json.dumps(nebula)))
-    conn.commit()
-    conn.close()
+def _db_row(kind: str, item: dict) -> tuple:
+    """把实体转换为对应表的一行"""
+    if kind == "cases":
+        return (item.get("id"), item.get("name"), item.get("architect"), item.get("year"),
+                item.get("location"), json.dumps(item.get("tags", [])), item.get("description"),
+                item.get("image_url"), item.get("source_url"), json.dumps(item))
+    if kind == "concepts":
+        return (item.get("id"), item.get("name"), json.dumps(item.get("keywords", [])),
+                item.get("description"), item.get("image_url"), item.get("source_url"),
+                json.dumps(item))
+    if kind == "tags":
+        return (item.get("id"), item.get("name"), item.get("parent_id"),
+                json.dumps(item.get("parent_ids", [])), json.dumps(item.get("parent_details", [])),
+                json.dumps(item.get("children", [])), json.dumps(item))
+    return (item.get("id"), item.get("name"),
+            json.dumps(item.get("case_ids", [])), json.dumps(item.get("concept_ids", [])),
+            json.dumps(item))
+
+def _db_upsert_sql(table: str) -> str:
+    columns = _DB_SCHEMA[table]
+    updates = ", ".join(f"{c}=excluded.{c}" for c in columns if c != "id")
+    return (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+            f"ON CONFLICT(id) DO UPDATE SET {updates}")
+
+def _db_apply_changes(changes: list, order: Optional[dict[str, list]] = None):
+    """只写入发生变化的行：新增/修改走 upsert，删除走单行 DELETE，整批在一个事务内提交。
+    order 中的集合（replace() 调整过顺序）按新顺序整表重写，加载时按 rowid 读出的顺序与内存一致。"""
+    final = {}
+    for kind, eid, _, after in changes:
+        final[(kind, eid)] = after
+    upserts, deletes = {}, {}
+    for (kind, eid), after in final.items():
+        if after is None:
+            deletes.setdefault(kind, []).append((eid,))
+        else:
+            upserts.setdefault(kind, []).append(_db_row(kind, after))
+    with _db_lock, _db() as conn:
+        for kind, rows in deletes.items():
+            conn.executemany(f"DELETE FROM {kind} WHERE id = ?", rows)
+        for kind, rows in upserts.items():
+            conn.executemany(_db_upsert_sql(kind), rows)
+        for kind, items in (order or {}).items():
+            conn.execute(f"DELETE FROM {kind}")
+            conn.executemany(_db_upsert_sql(kind), [_db_row(kind, item) for item in items])
+
+# —— Storage format ——
+try:
+    import orjson  # 可选：更快的 JSON 编解码
+except ImportError:
+    orjson = None
+try:
+    import msgpack  # 可选：STORAGE_FORMAT=msgpack 时需要
+except ImportError:
+    msgpack = None
+try:
+    import numpy as np  # 可选：服务端图谱布局需要
+except ImportError:
+    np = None
+try:
+    import brotli  # 可选：br 响应压缩
+except ImportError:
+    brotli = None
+try:
+    import zstandard  # 可选：zstd 响应压缩
+except ImportError:
+    zstandard = None
+if STORAGE_FORMAT not in ("json", "compact", "msgpack"):
+    raise RuntimeError(f"未知的 STORAGE_FORMAT: {STORAGE_FORMAT}")
+if STORAGE_FORMAT == "msgpack" and msgpack is None:
+    raise RuntimeError("STORAGE_FORMAT=msgpack 需要先 pip install msgpack")
+
+FORMAT_SUFFIXES = {"json": ".json", "compact": ".json", "msgpack": ".msgpack"}
+
+def _encode(obj, fmt: str = STORAGE_FORMAT) -> bytes:
+    """按存储格式序列化：json 为缩进 JSON，compact 为紧凑 JSON，msgpack 为二进制"""
+    if fmt == "msgpack":
+        return msgpack.packb(obj, use_bin_type=True)
+    if fmt == "compact":
+        if orjson is not None:
+            return orjson.dumps(obj)
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+
+def _decode(data: bytes, suffix: str = ".json"):
+    if suffix == ".msgpack":
+        if msgpack is None:
+            raise RuntimeError("读取 .msgpack 数据文件需要先 pip install msgpack")
+        return msgpack.unpackb(data, raw=False)
+    return orjson.loads(data) if orjson is not None else json.loads(data)
+
+def _document_candidates(path: Path) -> list[Path]:
+    """当前格式的文件排在最前，其后是其它格式的旧文件"""
+    current = path.with_suffix(FORMAT_SUFFIXES[STORAGE_FORMAT])
+    return list(dict.fromkeys([current, path.with_suffix(".json"), path.with_suffix(".msgpack")]))
+
+def _document_exists(path: Path) -> bool:
+    return any(p.exists() for p in _document_candidates(path))
+
+def _read_document(path: Path, default=None):
+    """读取数据文件。当前格式的文件不存在时透明回退到旧格式文件，下次写入即完成迁移。"""
+    for candidate in _document_candidates(path):
+        if candidate.exists():
+            return _decode(candidate.read_bytes(), candidate.suffix)
+    return default
+
+def _write_document(path: Path, obj):
+    """按当前格式写入，并删除其它格式的旧文件，避免切换格式后读到过期数据"""
+    target, *stale = _document_candidates(path)
+    _atomic_write(target, _encode(obj))
+    for p in stale:
+        p.unlink(missing_ok=True)
 
 # —— Data layer ——
-def load_cases() -> list[dict]:
+COLLECTION_FILES = {"cases": DATA_FILE, "concepts": CONCEPTS_FILE, "tags": TAGS_FILE, "nebulas": NEBULAS_FILE}
+ID_PREFIXES = {"cases": "case", "concepts": "concept", "tags": "tag", "nebulas": "nebula"}
+
+def _disk_load(kind: str):
+    """从磁盘读取整个集合（只在仓库初始化时调用）"""
     if USE_DATABASE:
-        return _db_load_cases()
-    if DATA_FILE.exists():
-        return json.loads(DATA_FILE.read_text(encoding="utf-8"))
-    if SEED_FILE.exists():
-        cases = json.loads(SEED_FILE.read_text(encoding="utf-8"))
-        save_cases(cases)
-        # 创建默认星云"示范案例"，包含所有种子案例
-        _create_default_nebula(cases)
-        return cases
-    return []
+        return {"cases": _db_load_cases, "concepts": _db_load_concepts,
+                "tags": _db_load_tags, "nebulas": _db_load_nebulas}[kind]()
+    return _read_document(COLLECTION_FILES[kind], {} if kind == "tags" else [])
+
+def _atomic_write(path: Path, data: bytes):
+    """先写临时文件再原子替换，写到一半崩溃也不会留下损坏的文件"""
+    tmp = path.with_name(path.name + ".tmp")
+    with open(tmp, "wb") as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+
+def _disk_save(kind: str, items):
+    """把整个集合写回数据文件"""
+    _write_document(COLLECTION_FILES[kind], items)
+
+
+def _reordered(items: dict, ids: list) -> dict:
+    """按 ids 的顺序重排 id -> 实体 字典，ids 中没有的实体按原顺序排在最后"""
+    result = {eid: items[eid] for eid in ids if eid in items}
+    result.update((eid, item) for eid, item in items.items() if eid not in result)
+    return result
+
+
+class ChangeJournal:
+    """JSON 模式下的追加式变更日志。
+
+    每个写批次追加一行紧凑 JSON 并 fsync，写入成本只与改动大小有关；
+    日志超过 JOURNAL_COMPACT_BYTES 后由后台线程把内存数据折叠回基础文件。
+    折叠时先把日志改名为 .compacting，新写入继续追加到新日志，基础文件写完后再删除旧日志。
+    启动时先读基础文件，再依次重放 .compacting 和当前日志。
+    """
+
+    def __init__(self, path: Path, threshold: int):
+        self.path = path
+        self.rotated = path.with_name(path.name + ".compacting")
+        self.threshold = threshold
+        self._fh = None
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def exists(self) -> bool:
+        return self.path.exists() or self.rotated.exists()
+
+    def replay(self, data: dict[str, dict]):
+        """把日志中的变更依次应用到刚从基础文件读出的数据上"""
+        for path in (self.rotated, self.path):
+            if not path.exists():
+                continue
+            valid_end = 0
+            with open(path, "rb") as f:
+                for line in f:
+                    try:
+                        record = _decode(line)
+                    except ValueError:
+                        break
+                    valid_end += len(line)
+                    for op in record["ops"]:
+                        if op["op"] == "put":
+                            data[op["kind"]][op["id"]] = op["data"]
+                        elif op["op"] == "order":
+                            data[op["kind"]] = _reordered(data[op["kind"]], op["ids"])
+                        else:
+                            data[op["kind"]].pop(op["id"], None)
+            if valid_end < path.stat().st_size:
+                # 崩溃时只写了一半的最后一行：截掉它，避免后续追加的记录接在残行后面
+                with open(path, "r+b") as f:
+                    f.truncate(valid_end)
+
+    def append(self, changes: list, order: Optional[dict[str, list]] = None):
+        """order 为 replace() 调整过顺序的集合 -> 新的 id 顺序，记在本批增删之后"""
+        ops, final = [], {}
+        for kind, eid, _, after in changes:
+            final[(kind, eid)] = after
+        for (kind, eid), after in final.items():
+            if after is None:
+                ops.append({"op": "del", "kind": kind, "id": eid})
+            else:
+                ops.append({"op": "put", "kind": kind, "id": eid, "data": after})
+        for kind, ids in (order or {}).items():
+            ops.append({"op": "order", "kind": kind, "ids": ids})
+        if self._fh is None:
+            self._fh = open(self.path, "ab")
+        self._fh.write(_encode({"ops": ops}, "compact") + b"\n")
+        self._fh.flush()
+        os.fsync(self._fh.fileno())
+        if self._fh.tell() > self.threshold:
+            self._schedule_compaction()
+
+    def rotate(self) -> bool:
+        """把当前日志移到 .compacting，返回是否有需要折叠的内容（调用方需持有仓库锁）"""
+        if self._fh is not None:
+            self._fh.close()
+            self._fh = None
+        if self.path.exists() and not self.rotated.exists():
+            os.replace(self.path, self.rotated)
+        return self.rotated.exists()
+
+    def finish_rotation(self):
+        self.rotated.unlink(missing_ok=True)
+
+    def _schedule_compaction(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._compactor, name="journal-compactor", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def _compactor(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                repo.compact()
+            except Exception:
+                logger.exception("日志折叠失败")
+
+
+journal = ChangeJournal(JOURNAL_FILE, JOURNAL_COMPACT_BYTES)
+
+
+class Repository:
+    """进程内数据仓库：每个集合只在启动时从磁盘加载一次，读请求直接走内存，写操作同步落盘。
+
+    所有集合在内存中都以 id -> 实体 的有序字典保存（与原列表顺序一致）。
+    load_* 返回的是只读视图；修改实体时先用 get() 取副本，改完再 put() 写回，
+    存储中的实体对象只会被整体替换，从不原地修改，因此已发出的视图始终一致。
+
+    另外维护几组二级索引，随每次写入同步更新，替代各接口里的全表扫描：
+    标签名 -> 标签 id、标签名 -> 使用它的案例 id、案例/概念 id -> 所属星云 id，
+    以及标签层级的传递闭包（祖先/后代及层数）。
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._data: Optional[dict[str, dict]] = None
+        self._views: dict[str, object] = {}
+        self._batch: Optional[list] = None
+        self._batch_order: dict[str, list] = {}  # 本批中 replace() 调整过顺序的集合 -> 调整前的 id 顺序，回滚时用
+        self._version = 0
+        self._compacting = threading.Lock()
+        self._tag_ids_by_name: dict[str, set[str]] = {}
+        self._tag_seq: dict[str, int] = {}  # 标签在 tags 字典中的先后，同名标签按它取第一个
+        self._next_tag_seq = 0
+        self._case_ids_by_tag: dict[str, set[str]] = {}
+        self._nebula_ids_by_member: dict[str, set[str]] = {}
+        self._tag_children: dict[str, set[str]] = {}           # 父 id -> 以它为父的标签（父可能尚不存在）
+        self._tag_ancestors: dict[str, dict[str, int]] = {}    # 标签 -> {祖先标签: 最短层数}
+        self._tag_descendants: dict[str, dict[str, int]] = {}  # 标签 -> {后代标签: 最短层数}
+        self._tag_depth: dict[str, int] = {}                   # 标签 -> 到最远根标签的层数（最长路径）
+
+    # —— 加载 ——
+    def _ensure_loaded(self):
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self._load()
+
+    def _load(self):
+        data = {}
+        for kind in COLLECTION_FILES:
+            items = _disk_load(kind)
+            if kind == "tags":  # 与 replace() 一致，标签的 id 以字典键为准
+                data[kind] = {tid: td if td.get("id") == tid else {**td, "id": tid} for tid, td in items.items()}
+            else:
+                data[kind] = {}
+                for item in items:
+                    item = self._with_id(kind, item)
+                    data[kind][item["id"]] = item
+        if JOURNAL_MODE and not USE_DATABASE:
+            journal.replay(data)
+        elif journal.exists():
+            logger.warning("发现变更日志 %s，但 JOURNAL_MODE 未开启，其中的修改不会被加载", journal.path)
+        self._data = data
+        self._views = {}
+        self._tag_ids_by_name, self._case_ids_by_tag, self._nebula_ids_by_member = {}, {}, {}
+        self._tag_children, self._tag_ancestors, self._tag_descendants = {}, {}, {}
+        self._tag_depth = {}
+        self._tag_seq = {tid: i for i, tid in enumerate(data["tags"])}
+        self._next_tag_seq = len(self._tag_seq)
+        for kind, items in data.items():
+            for item in items.values():
+                self._index(kind, item)
+        self._refresh_tag_closure(data["tags"])
+        self._bootstrap()
+        if JOURNAL_MODE and not USE_DATABASE and journal.rotated.exists():
+            self.compact()  # 上次折叠中途退出，重放完成后立即补做
+
+    def _bootstrap(self):
+        """首次启动时写入种子案例，并保证存在默认星云"示范案例" """
+        if (not USE_DATABASE and not _document_exists(DATA_FILE) and not (JOURNAL_MODE and journal.exists())
+                and SEED_FILE.exists()):
+            seed_cases = json.loads(SEED_FILE.read_text(encoding="utf-8"))
+            self.replace("cases", seed_cases)
+            _create_default_nebula([c["id"] for c in seed_cases])
+        elif _document_exists(NEBULAS_FILE) and _document_exists(DATA_FILE):
+            # 检查是否有种子案例（ID格式为case_001到case_012）
+            _create_default_nebula([cid for cid in self._data["cases"] if cid.startswith("case_00")])
+
+    def reload(self):
+        """丢弃内存数据，下次访问时重新从磁盘加载"""
+        with self._lock:
+            self._data = None
+            self._views = {}
+            self._version += 1
+
+    @staticmethod
+    def _with_id(kind: str, item: dict) -> dict:
+        """保证实体带字符串 id：缺失时生成，导入数据里的数字等其他类型转成字符串"""
+        eid = item.get("id")
+        if isinstance(eid, str) and eid:
+            return item
+        if eid or eid == 0:
+            return {**item, "id": str(eid)}
+        return {**item, "id": f"{ID_PREFIXES[kind]}_{uuid.uuid4().hex[:8]}"}
+
+    # —— 读 ——
+    @property
+    def version(self) -> int:
+        """数据版本，每次提交写入后加一，用作各类缓存的键"""
+        self._ensure_loaded()
+        return self._version
+
+    def view(self, kind: str):
+        """集合的只读视图：tags 为 id -> 标签 字典，其余为实体列表。写入后首次读取时重建一次。"""
+        self._ensure_loaded()
+        v = self._views.get(kind)
+        if v is None:
+            with self._lock:
+                items = self._data[kind]
+                v = dict(items) if kind == "tags" else list(items.values())
+                self._views[kind] = v
+        return v
+
+    def get(self, kind: str, eid: str) -> Optional[dict]:
+        """按 id 取实体的副本，可自由修改后 put() 写回"""
+        self._ensure_loaded()
+        with self._lock:
+            item = self._data[kind].get(eid)
+        return copy.deepcopy(item) if item is not None else None
+
+    def exists(self, kind: str, eid: str) -> bool:
+        self._ensure_loaded()
+        with self._lock:
+            return eid in self._data[kind]
+
+    def peek(self, kind: str, eid: str) -> Optional[dict]:
+        """按 id 取实体本身（不复制），只读"""
+        self._ensure_loaded()
+        return self._data[kind].get(eid)
+
+    @property
+    def lock(self) -> threading.RLock:
+        return self._lock
+
+    # —— 写 ——
+    @contextmanager
+    def batch(self):
+        """把多次写操作合并为一次落盘；块内抛出异常时回滚内存中的修改"""
+        self._ensure_loaded()
+        with self._lock:
+            if self._batch is not None:
+                yield
+                return
+            self._batch, self._batch_order = [], {}
+            try:
+                yield
+            except BaseException:
+                changes, order, self._batch, self._batch_order = self._batch, self._batch_order, None, {}
+                self._rollback(changes, order)
+                raise
+            changes, order, self._batch, self._batch_order = self._batch, self._batch_order, None, {}
+            if changes or order:
+                self._commit(changes, order)
+
+    def _rollback(self, changes: list, order: dict[str, list]):
+        for kind, eid, before, _ in reversed(changes):
+            self._apply(kind, eid, before)
+        for kind, ids in order.items():
+            self._set_order(kind, ids)
+
+    def _set_order(self, kind: str, ids: list):
+        self._data[kind] = _reordered(self._data[kind], ids)
+        self._views.pop(kind, None)
+        if kind == "tags":
+            self._tag_seq = {tid: i for i, tid in enumerate(self._data["tags"])}
+            self._next_tag_seq = len(self._tag_seq)
+
+    def _apply(self, kind: str, eid: str, item: Optional[dict]):
+        before = self._data[kind].get(eid)
+        if before is not None:
+            self._unindex(kind, before)
+        if item is None:
+            self._data[kind].pop(eid, None)
+            if kind == "tags":
+                self._tag_seq.pop(eid, None)
+        else:
+            if kind == "tags" and before is None:
+                self._tag_seq[eid] = self._next_tag_seq
+                self._next_tag_seq += 1
+            self._data[kind][eid] = item
+            self._index(kind, item)
+        self._views.pop(kind, None)
+        if kind == "tags" and (before is None or item is None or _tag_parents(before)[0] != _tag_parents(item)[0]):
+            self._refresh_tag_closure([eid])
+
+    # —— 二级索引 ——
+    def _index(self, kind: str, item: dict):
+        eid = item["id"]
+        if kind == "tags":
+            self._tag_ids_by_name.setdefault(item.get("name"), set()).add(eid)
+            for pid in _tag_parents(item)[0]:
+                self._tag_children.setdefault(pid, set()).add(eid)
+        elif kind == "cases":
+            for tag in item.get("tags") or []:
+                self._case_ids_by_tag.setdefault(tag, set()).add(eid)
+        elif kind == "nebulas":
+            for mid in (item.get("case_ids") or []) + (item.get("concept_ids") or []):
+                self._nebula_ids_by_member.setdefault(mid, set()).add(eid)
+
+    def _unindex(self, kind: str, item: dict):
+        eid = item["id"]
+        if kind == "tags":
+            _discard(self._tag_ids_by_name, item.get("name"), eid)
+            for pid in _tag_parents(item)[0]:
+                _discard(self._tag_children, pid, eid)
+        elif kind == "cases":
+            for tag in item.get("tags") or []:
+                _discard(self._case_ids_by_tag, tag, eid)
+        elif kind == "nebulas":
+            for mid in (item.get("case_ids") or []) + (item.get("concept_ids") or []):
+                _discard(self._nebula_ids_by_member, mid, eid)
+
+    def tag_id_by_name(self, name: str) -> Optional[str]:
+        """同名标签取最早创建的那个"""
+        self._ensure_loaded()
+        with self._lock:
+            ids = self._tag_ids_by_name.get(name)
+            if not ids:
+                return None
+            return min(ids, key=self._tag_seq.__getitem__) if len(ids) > 1 else next(iter(ids))
+
+    def case_ids_with_tag(self, name: str) -> set[str]:
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._case_ids_by_tag.get(name, ()))
+
+    def nebula_ids_containing(self, member_id: str) -> set[str]:
+        """包含该案例/概念的星云"""
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._nebula_ids_by_member.get(member_id, ()))
+
+    # —— 标签层级闭包 ——
+    def _tag_parent_tags(self, tid: str) -> list[str]:
+        return [pid for pid in _tag_parents(self._data["tags"][tid])[0] if pid in self._data["tags"]]
+
+    def _refresh_tag_closure(self, tag_ids):
+        """重算这些标签及其全部后代的祖先集合和层数（父标签变化、新建或删除时调用）。
+        后代沿 父 -> 子 索引找出，按拓扑序（父先于子）逐个由父节点的祖先集合和层数合并得到；
+        数据里已有的环（导入的旧数据）在遍历时跳过回边，不会死循环。"""
+        affected, stack = set(), list(tag_ids)
+        while stack:
+            tid = stack.pop()
+            if tid not in affected:
+                affected.add(tid)
+                stack.extend(self._tag_children.get(tid, ()))
+        for tid in affected:
+            self._tag_depth.pop(tid, None)
+            for ancestor in self._tag_ancestors.pop(tid, {}):
+                self._tag_descendants[ancestor].pop(tid, None)
+                if not self._tag_descendants[ancestor]:
+                    del self._tag_descendants[ancestor]
+        tags, order, seen = self._data["tags"], [], set()
+        for root in affected:
+            if root in seen or root not in tags:
+                continue
+            seen.add(root)
+            path = [(root, iter(self._tag_parent_tags(root)))]
+            while path:
+                tid, parents = path[-1]
+                for pid in parents:
+                    if pid in affected and pid not in seen:
+                        seen.add(pid)
+                        path.append((pid, iter(self._tag_parent_tags(pid))))
+                        break
+                else:
+                    path.pop()
+                    order.append(tid)
+        done = set()
+        for tid in order:
+            ancestors: dict[str, int] = {}
+            longest = 0
+            for pid in self._tag_parent_tags(tid):
+                for ancestor, depth in [(pid, 0), *self._tag_ancestors.get(pid, {}).items()]:
+                    if ancestor != tid and depth + 1 < ancestors.get(ancestor, 1 << 30):
+                        ancestors[ancestor] = depth + 1
+                if pid not in affected or pid in done:  # 还没算到的受影响父节点是环上的回边
+                    longest = max(longest, self._tag_depth.get(pid, 0) + 1)
+            self._tag_depth[tid] = longest
+            done.add(tid)
+            if ancestors:
+                self._tag_ancestors[tid] = ancestors
+                for ancestor, depth in ancestors.items():
+                    self._tag_descendants.setdefault(ancestor, {})[tid] = depth
+
+    def tag_ancestors(self, tid: str) -> dict[str, int]:
+        """标签的全部祖先标签 -> 最短层数（父为 1）"""
+        self._ensure_loaded()
+        with self._lock:
+            return dict(self._tag_ancestors.get(tid, {}))
+
+    def tag_descendants(self, tid: str) -> dict[str, int]:
+        """标签的全部后代标签 -> 最短层数（子为 1）"""
+        self._ensure_loaded()
+        with self._lock:
+            return dict(self._tag_descendants.get(tid, {}))
+
+    def tag_depth(self, tid: str) -> int:
+        """到最远的根标签的层数（最长路径），根标签为 0。
+        闭包里记的是最短层数，多父标签时两者不同；最长路径在 _refresh_tag_closure 中随闭包一起维护。"""
+        self._ensure_loaded()
+        with self._lock:
+            return self._tag_depth.get(tid, 0)
+
+    def tag_cycle(self, tid: str, parent_ids) -> Optional[str]:
+        """把 parent_ids 设为 tid 的父节点是否会形成环，会则返回造成环的父节点"""
+        self._ensure_loaded()
+        with self._lock:
+            descendants = self._tag_descendants.get(tid, {})
+            return next((pid for pid in parent_ids if pid == tid or pid in descendants), None)
+
+    def case_ids_in_tag_subtree(self, tid: str) -> set[str]:
+        """带有该标签或其任一后代标签的案例（案例中的标签可以是名称，也可以是 id）"""
+        with self.lock:
+            result = set()
+            for t in [tid, *self.tag_descendants(tid)]:
+                result |= self.case_ids_with_tag(t)
+                tag = self.peek("tags", t)
+                if tag is not None:
+                    result |= self.case_ids_with_tag(tag.get("name"))
+            return result
+
+    def _change(self, kind: str, eid: str, after: Optional[dict]):
+        before = self._data[kind].get(eid)
+        if before is None and after is None:
+            return
+        self._apply(kind, eid, after)
+        self._batch.append((kind, eid, before, after))
+
+    def put(self, kind: str, item: dict) -> dict:
+        """新增或整体替换一个实体"""
+        with self.batch():
+            item = self._with_id(kind, item)
+            self._change(kind, item["id"], item)
+        return item
+
+    def put_many(self, kind: str, items: list[dict]):
+        with self.batch():
+            for item in items:
+                item = self._with_id(kind, item)
+                self._change(kind, item["id"], item)
+
+    def delete(self, kind: str, eid: str) -> bool:
+        with self.batch():
+            existed = eid in self._data[kind]
+            self._change(kind, eid, None)
+        return existed
+
+    def replace(self, kind: str, items):
+        """用新内容整体替换一个集合（导入、撤销、恢复快照）"""
+        if kind == "tags":
+            items = [{**td, "id": tid} for tid, td in items.items()]
+        items = [self._with_id(kind, item) for item in items]
+        with self.batch():
+            before_order = list(self._data[kind])
+            new_ids = {item["id"] for item in items}
+            for eid in [eid for eid in self._data[kind] if eid not in new_ids]:
+                self._change(kind, eid, None)
+            for item in items:
+                if self._data[kind].get(item["id"]) != item:
+                    self._change(kind, item["id"], item)
+            # 保持传入的顺序。逐条增删得到的顺序与之不同时记下来，提交时随本批写入日志/数据库，重放后顺序一致
+            current, ids = list(self._data[kind]), list(dict.fromkeys(item["id"] for item in items))
+            if current != ids:
+                self._batch_order.setdefault(kind, before_order)
+                self._set_order(kind, ids)
+
+    def _commit(self, changes: list, order: dict[str, list]):
+        """落盘失败时同样回滚内存中的修改，内存与磁盘保持一致"""
+        saved = []
+        try:
+            new_order = {kind: list(self._data[kind].values()) for kind in order}
+            if USE_DATABASE:
+                _db_apply_changes(changes, new_order)
+            elif JOURNAL_MODE:
+                journal.append(changes, {kind: [item["id"] for item in items] for kind, items in new_order.items()})
+            else:
+                for kind in dict.fromkeys([*(kind for kind, *_ in changes), *order]):
+                    self._save(kind)
+                    saved.append(kind)
+        except BaseException:
+            self._rollback(changes, order)
+            for kind in saved:  # 已经写出的集合改回回滚后的内容
+                try:
+                    self._save(kind)
+                except Exception:
+                    logger.exception("回滚后重写 %s 失败", kind)
+            raise
+        self._version += 1
+        history.capture(changes)
+        graph_events.publish(self._version, graph_model.apply(changes))
+        _invalidate_graph_cache()
+        graph_analytics.schedule()
+
+    def _save(self, kind: str):
+        items = self._data[kind]
+        _disk_save(kind, dict(items) if kind == "tags" else list(items.values()))
+
+    def compact(self):
+        """把变更日志折叠进基础文件。只在改名日志和复制字典时持锁，序列化和写盘不阻塞其他请求。"""
+        self._ensure_loaded()
+        with self._compacting:
+            with self._lock:
+                if not journal.rotate():
+                    return
+                snapshot = {kind: dict(items) for kind, items in self._data.items()}
+            for kind, items in snapshot.items():
+                _disk_save(kind, items if kind == "tags" else list(items.values()))
+            journal.finish_rotation()
+
+
+def _discard(index: dict, key, value):
+    """从 key -> 集合 的索引里移除一个值，集合空了就删掉 key"""
+    members = index.get(key)
+    if members is None:
+        return
+    members.discard(value)
+    if not members:
+        del index[key]
+
+
+repo = Repository()
+
+def load_cases() -> list[dict]:
+    return repo.view("cases")
 
 def save_cases(cases: list[dict]):
-    if USE_DATABASE:
-        _db_save_cases(cases)
-    else:
-        DATA_FILE.write_text(json.dumps(cases, ensure_ascii=False, indent=2), encoding="utf-8")
-    _invalidate_graph_cache()
+    repo.replace("cases", cases)
 
 def load_tags() -> dict:
-    if USE_DATABASE:
-        return _db_load_tags()
-    if TAGS_FILE.exists():
-        return json.loads(TAGS_FILE.read_text(encoding="utf-8"))
-    return {}
+    return repo.view("tags")
 
 def save_tags(tags: dict):
-    if USE_DATABASE:
-        _db_save_tags(tags)
-    else:
-        TAGS_FILE.write_text(json.dumps(tags, ensure_ascii=False, indent=2), encoding="utf-8")
-    _invalidate_graph_cache()
+    repo.replace("tags", tags)
 
 def load_concepts() -> list[dict]:
-    if USE_DATABASE:
-        return _db_load_concepts()
-    if CONCEPTS_FILE.exists():
-        return json.loads(CONCEPTS_FILE.read_text(encoding="utf-8"))
-    return []
+    return repo.view("concepts")
 
 def save_concepts(concepts: list[dict]):
-    if USE_DATABASE:
-        _db_save_concepts(concepts)
-    else:
-        CONCEPTS_FILE.write_text(json.dumps(concepts, ensure_ascii=False, indent=2), encoding="utf-8")
-    _invalidate_graph_cache()
+    repo.replace("concepts", concepts)
 
 def load_nebulas() -> list[dict]:
-    if NEBULAS_FILE.exists():
-        nebulas = json.loads(NEBULAS_FILE.read_text(encoding="utf-8"))
-        # 如果存在种子案例但还没有默认星云，则创建
-        if DATA_FILE.exists() and not any(n.get("name") == "示范案例" for n in nebulas):
-            cases = load_cases()
-            # 检查是否有种子案例（ID格式为case_001到case_012）
-            seed_case_ids = [c["id"] for c in cases if c["id"].startswith("case_00")]
-            if seed_case_ids:
-                default_nebula = {
-                    "id": "nebula_demo",
-                    "name": "示范案例",
-                    "case_ids": seed_case_ids,
-                    "concept_ids": []
-                }
-                nebulas.append(default_nebula)
-                save_nebulas(nebulas)
-        return nebulas
-    return []
+    return repo.view("nebulas")
 
 def save_nebulas(nebulas: list[dict]):
-    if USE_DATABASE:
-        _db_save_nebulas(nebulas)
-    else:
-        NEBULAS_FILE.write_text(json.dumps(nebulas, ensure_ascii=False, indent=2), encoding="utf-8")
-    _invalidate_graph_cache()
+    repo.replace("nebulas", nebulas)
 
-def _create_default_nebula(seed_cases: list[dict]):
+def _create_default_nebula(seed_case_ids: list[str]):
     """创建默认星云'示范案例'，包含所有种子案例。如果已存在则不重复创建。"""
-    nebulas = load_nebulas()
-    # 检查是否已存在名为"示范案例"的星云
-    if any(n.get("name") == "示范案例" for n in nebulas):
+    if not seed_case_ids or any(n.get("name") == "示范案例" for n in load_nebulas()):
         return
-    # 获取所有种子案例的ID
-    seed_case_ids = [c["id"] for c in seed_cases]
-    default_nebula = {
+    repo.put("nebulas", {
         "id": "nebula_demo",
         "name": "示范案例",
         "case_ids": seed_case_ids,
         "concept_ids": []
-    }
-    nebulas.append(default_nebula)
-    save_nebulas(nebulas)
+    })
 
 
 def ensure_tag_by_name(name: str) -> str:
@@ -515,27 +876,27 @@ def ensure_tag_by_name(name: str) -> str:
     if not name or not name.strip():
         return ""
     name = name.strip()
-    tags = load_tags()
-    for tid, td in tags.items():
-        if td.get("name") == name:
+    with repo.batch():
+        tid = repo.tag_id_by_name(name)
+        if tid:
             return tid
-    tag_id = f"tag_{uuid.uuid4().hex[:8]}"
-    tags[tag_id] = {
-        "id": tag_id,
-        "name": name,
-        "parent_id": None,
-        "parent_ids": [],
-        "parent_details": [],
-        "children": [],
-    }
-    save_tags(tags)
+        tag_id = f"tag_{uuid.uuid4().hex[:8]}"
+        repo.put("tags", {
+            "id": tag_id,
+            "name": name,
+            "parent_id": None,
+            "parent_ids": [],
+            "parent_details": [],
+            "children": [],
+        })
     return tag_id
 
 
 def sync_case_tags_to_registry(case: dict):
     """将案例的 tags 同步到 tags.json，保证每个标签名都有对应节点。"""
-    for tag_name in case.get("tags") or []:
-        ensure_tag_by_name(tag_name)
+    with repo.batch():
+        for tag_name in case.get("tags") or []:
+            ensure_tag_by_name(tag_name)
 
 # —— Pydantic models ——
 class CaseCreate(BaseModel):
@@ -608,11 +969,118 @@ class NebulaUpdate(BaseModel):
 # —— App ——
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    load_cases()
+    load_cases()  # 启动时一次性把所有集合加载进内存
+    history.load()
+    _precompress_static()
+    graph_model.project()  # 预先构建图谱模型，之后的写操作都能产生增量
+    if np is not None:
+        threading.Thread(target=graph_data, kwargs={"layout": True}, daemon=True).start()  # 后台预算全图布局
     yield
+    history.flush()  # 写完还在排队的历史记录
+    if JOURNAL_MODE and not USE_DATABASE:
+        repo.compact()
 
 app = FastAPI(title="ArchGraph API", lifespan=lifespan)
 
+# —— Response Compression ——
+COMPRESS_MIN_SIZE = int(os.getenv("COMPRESS_MIN_SIZE", "1024"))  # 小于该大小的完整响应不压缩
+# 服务端支持的编码，客户端权重相同时按此顺序优先
+COMPRESS_ENCODINGS = [enc for enc, ok in (("zstd", zstandard is not None), ("br", brotli is not None), ("gzip", True)) if ok]
+
+
+def _negotiate_encoding(accept_encoding: str) -> Optional[str]:
+    """按 Accept-Encoding（含 q 值）选出服务端支持的最优编码，都不接受时返回 None"""
+    weights = {}
+    for part in accept_encoding.lower().split(","):
+        name, _, params = part.partition(";")
+        match = re.search(r"q\s*=\s*([0-9.]+)", params)
+        try:
+            weights[name.strip()] = float(match.group(1)) if match else 1.0
+        except ValueError:
+            weights[name.strip()] = 0.0
+    best, best_q = None, 0.0
+    for enc in COMPRESS_ENCODINGS:
+        q = weights.get(enc, weights.get("*", 0.0))
+        if q > best_q:
+            best, best_q = enc, q
+    return best
+
+
+def _compressor(encoding: str, best: bool = False):
+    """流式压缩器，返回 (compress, flush, finish)。flush 吐出已写入的全部数据，流式响应的每条消息能及时送达；
+    best=True 用最高压缩级别（静态资源只在启动时压缩一次），否则用适合在线压缩的快速级别"""
+    if encoding == "gzip":
+        c = zlib.compressobj(9 if best else 6, zlib.DEFLATED, 31)
+        return c.compress, lambda: c.flush(zlib.Z_SYNC_FLUSH), c.flush
+    if encoding == "br":
+        c = brotli.Compressor(quality=11 if best else 5)
+        return c.process, c.flush, c.finish
+    c = zstandard.ZstdCompressor(level=19 if best else 3).compressobj()
+    return c.compress, lambda: c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK), c.flush
+
+
+def _compress(data: bytes, encoding: str, best: bool = False) -> bytes:
+    compress, _, finish = _compressor(encoding, best)
+    return compress(data) + finish()
+
+
+def _compressible(headers: MutableHeaders) -> bool:
+    """文本类响应才压缩；已经编码过的（如 gzip 导出）和 SSE 事件流原样发送"""
+    if "content-encoding" in headers:
+        return False
+    media_type = headers.get("content-type", "").split(";")[0].strip().lower()
+    if media_type == "text/event-stream":
+        return False
+    return media_type.startswith("text/") or any(t in media_type for t in ("json", "xml", "javascript"))
+
+
+class CompressionMiddleware:
+    """按 Accept-Encoding 协商压缩响应（zstd / br / gzip）。
+    第一段响应体到达时再决定：完整且小于 COMPRESS_MIN_SIZE 的响应、不可压缩的类型原样发送；
+    流式响应（导出、NDJSON 进度）逐段压缩并 flush，不会被缓冲到结束。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        encoding = _negotiate_encoding(Headers(scope=scope).get("accept-encoding", "")) if scope["type"] == "http" else None
+        if encoding is None:
+            await self.app(scope, receive, send)
+            return
+        start, codec = None, None
+
+        async def send_compressed(message):
+            nonlocal start, codec
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if start is not None:
+                headers = MutableHeaders(scope=start)
+                body, more = message.get("body", b""), message.get("more_body", False)
+                if (message["type"] == "http.response.body" and start["status"] not in (204, 304)
+                        and _compressible(headers) and (more or len(body) >= COMPRESS_MIN_SIZE)):
+                    codec = _compressor(encoding)
+                    headers["Content-Encoding"] = encoding
+                    headers.add_vary_header("Accept-Encoding")
+                    if "content-length" in headers:
+                        del headers["content-length"]
+                    if headers.get("etag", "").startswith('"'):
+                        headers["ETag"] = "W/" + headers["etag"]  # 压缩后不再是字节相同的表示
+                await send(start)
+                start = None
+            if codec is None or message["type"] != "http.response.body":
+                await send(message)
+                return
+            compress, flush, finish = codec
+            more = message.get("more_body", False)
+            body = compress(message.get("body", b"")) + (flush() if more else finish())
+            await send({"type": "http.response.body", "body": body, "more_body": more})
+
+        await self.app(scope, receive, send_compressed)
+
+
+app.add_middleware(CompressionMiddleware)
+
 # —— Image Upload ——
 ALLOWED_EXT = {".jpg", ".jpeg", ".png", ".webp", ".gif"}
 
@@ -639,48 +1107,95 @@ async def upload_image_for_case(case_id: str, file: UploadFile = File(...)):
     with open(fpath, "wb") as f:
         shutil.copyfileobj(file.file, f)
     url = f"/static/uploads/{fname}"
-    cases = load_cases()
-    for c in cases:
-        if c["id"] == case_id:
-            c["image_url"] = url
-            save_cases(cases)
-            return {"url": url, "case": c}
-    raise HTTPException(404, "Case not found")
+    _record_history("update_case", {"case_id": case_id})
+    c = repo.get("cases", case_id)
+    if c is None:
+        raise HTTPException(404, "Case not found")
+    c["image_url"] = url
+    repo.put("cases", c)
+    return {"url": url, "case": c}
 
 # —— Case CRUD ——
+# —— Field Projection ——
+CASE_LIST_FIELDS = ("id", "name", "architect", "year", "location", "tags")
+CONCEPT_LIST_FIELDS = ("id", "name", "keywords")
+GRAPH_NODE_FIELDS = ("id", "label", "type", "x", "y", "is_subtag", "is_bridge", "is_active", "is_collapsed")  # 绘制图谱所需
+ENTITY_BATCH_LIMIT = 500
+
+
+def _parse_fields(fields: Optional[str], default: tuple, required: tuple = ("id",)) -> Optional[frozenset]:
+    """解析 fields= 参数：缺省时用 default，"all" 表示全部字段（返回 None），否则为逗号分隔的字段名（总是包含 required）"""
+    if fields is None:
+        return frozenset(default)
+    if fields.strip() == "all":
+        return None
+    return frozenset(f.strip() for f in fields.split(",") if f.strip()) | frozenset(required)
+
+
+def _project(items: list[dict], keep: Optional[frozenset]) -> list[dict]:
+    if keep is None:
+        return items
+    return [{k: v for k, v in item.items() if k in keep} for item in items]
+
+
+@app.get("/api/entities")
+def get_entities(ids: str, fields: str | None = None):
+    """按 id 批量获取实体的完整内容（列表和图谱默认只带最少字段，详情按需获取）。
+    ids 为逗号分隔的案例/概念/标签/星云 id；返回 {"items": {id: 实体}, "kinds": {id: 集合名}, "missing": [...]}"""
+    wanted = list(dict.fromkeys(i.strip() for i in ids.split(",") if i.strip()))
+    if len(wanted) > ENTITY_BATCH_LIMIT:
+        raise HTTPException(400, f"一次最多查询 {ENTITY_BATCH_LIMIT} 个实体")
+    keep = _parse_fields(fields, ()) if fields is not None else None
+    items, kinds, missing = {}, {}, []
+    for eid in wanted:
+        kind = next((k for k in COLLECTION_FILES if repo.exists(k, eid)), None)
+        item = repo.peek(kind, eid) if kind else None
+        if item is None:
+            missing.append(eid)
+            continue
+        items[eid] = _project([item], keep)[0]
+        kinds[eid] = kind
+    return {"items": items, "kinds": kinds, "missing": missing}
+
+
 @app.get("/api/cases")
-def list_cases():
-    return load_cases()
+def list_cases(fields: str | None = None, tag: str | None = None):
+    """案例列表，默认只返回列表展示所需的字段；fields=all 返回全部字段，或用逗号分隔指定字段。
+    tag 为标签 id 时只返回带有该标签或其任一子孙标签的案例。"""
+    cases = load_cases()
+    if tag is not None:
+        if not repo.exists("tags", tag):
+            raise HTTPException(404, "Tag not found")
+        ids = repo.case_ids_in_tag_subtree(tag)
+        cases = [c for c in cases if c["id"] in ids]
+    return _project(cases, _parse_fields(fields, CASE_LIST_FIELDS))
 
 @app.post("/api/cases")
 def create_case(case: CaseCreate):
     _record_history("create_case", {"case_name": case.name})
-    cases = load_cases()
     new_case = {"id": f"case_{uuid.uuid4().hex[:8]}", **case.model_dump()}
-    cases.append(new_case)
-    save_cases(cases)
-    sync_case_tags_to_registry(new_case)
+    with repo.batch():
+        repo.put("cases", new_case)
+        sync_case_tags_to_registry(new_case)
     return new_case
 
 @app.put("/api/cases/{case_id}")
 def update_case(case_id: str, update: CaseUpdate):
     _record_history("update_case", {"case_id": case_id})
-    cases = load_cases()
-    for c in cases:
-        if c["id"] == case_id:
-            for k, v in update.model_dump(exclude_none=True).items():
-                c[k] = v
-            save_cases(cases)
-            sync_case_tags_to_registry(c)
-            return c
-    raise HTTPException(404, "Case not found")
+    c = repo.get("cases", case_id)
+    if c is None:
+        raise HTTPException(404, "Case not found")
+    for k, v in update.model_dump(exclude_none=True).items():
+        c[k] = v
+    with repo.batch():
+        repo.put("cases", c)
+        sync_case_tags_to_registry(c)
+    return c
 
 @app.delete("/api/cases/{case_id}")
 def delete_case(case_id: str):
     _record_history("delete_case", {"case_id": case_id})
-    cases = load_cases()
-    cases = [c for c in cases if c["id"] != case_id]
-    save_cases(cases)
+    repo.delete("cases", case_id)
     return {"ok": True}
 
 # —— URL Import (improved image scraping) ——
@@ -865,7 +1380,6 @@ description要求：不要泛泛而谈，要有具体的设计手法和空间特
     except Exception as e:
         raise HTTPException(500, f"AI 提取失败: {e}")
 
-    cases = load_cases()
     new_case = {
         "id": f"case_{uuid.uuid4().hex[:8]}",
         "name": info.get("name", "未命名"),
@@ -877,42 +1391,37 @@ description要求：不要泛泛而谈，要有具体的设计手法和空间特
         "image_url": local_image,
         "source_url": req.url,
     }
-    cases.append(new_case)
-    save_cases(cases)
+    repo.put("cases", new_case)
     return new_case
 
 # —— Concept Management ——
 @app.get("/api/concepts")
-def list_concepts():
-    return load_concepts()
+def list_concepts(fields: str | None = None):
+    """概念列表，默认只返回 id、名称和关键词；fields 用法同 /api/cases"""
+    return _project(load_concepts(), _parse_fields(fields, CONCEPT_LIST_FIELDS))
 
 @app.post("/api/concepts")
 def create_concept(concept: ConceptCreate):
     _record_history("create_concept", {"concept_name": concept.name})
-    concepts = load_concepts()
     new_concept = {"id": f"concept_{uuid.uuid4().hex[:8]}", **concept.model_dump()}
-    concepts.append(new_concept)
-    save_concepts(concepts)
+    repo.put("concepts", new_concept)
     return new_concept
 
 @app.put("/api/concepts/{concept_id}")
 def update_concept(concept_id: str, update: ConceptUpdate):
     _record_history("update_concept", {"concept_id": concept_id})
-    concepts = load_concepts()
-    for c in concepts:
-        if c["id"] == concept_id:
-            for k, v in update.model_dump(exclude_none=True).items():
-                c[k] = v
-            save_concepts(concepts)
-            return c
-    raise HTTPException(404, "Concept not found")
+    c = repo.get("concepts", concept_id)
+    if c is None:
+        raise HTTPException(404, "Concept not found")
+    for k, v in update.model_dump(exclude_none=True).items():
+        c[k] = v
+    repo.put("concepts", c)
+    return c
 
 @app.delete("/api/concepts/{concept_id}")
 def delete_concept(concept_id: str):
     _record_history("delete_concept", {"concept_id": concept_id})
-    concepts = load_concepts()
-    concepts = [c for c in concepts if c["id"] != concept_id]
-    save_concepts(concepts)
+    repo.delete("concepts", concept_id)
     return {"ok": True}
 
 @app.post("/api/concepts/from-url")
@@ -977,7 +1486,6 @@ description要求：要具体，说明这个概念是什么、如何应用、有
         info = json.loads(raw)
     except Exception as e:
         raise HTTPException(500, f"AI 提取失败: {e}")
-    concepts = load_concepts()
     new_concept = {
         "id": f"concept_{uuid.uuid4().hex[:8]}",
         "name": info.get("name", "未命名概念"),
@@ -986,8 +1494,7 @@ description要求：要具体，说明这个概念是什么、如何应用、有
         "image_url": local_image,
         "source_url": req.url,
     }
-    concepts.append(new_concept)
-    save_concepts(concepts)
+    repo.put("concepts", new_concept)
     return new_concept
 
 # —— Nebula Management ——
@@ -997,49 +1504,43 @@ def list_nebulas():
 
 @app.post("/api/nebulas")
 def create_nebula(nebula: NebulaCreate):
-    nebulas = load_nebulas()
-    cases = load_cases()
-    concepts = load_concepts()
+    _record_history("create_nebula", {"nebula_name": nebula.name})
     # 验证案例和概念ID是否存在
     for cid in nebula.case_ids:
-        if not any(c["id"] == cid for c in cases):
+        if not repo.exists("cases", cid):
             raise HTTPException(404, f"案例 '{cid}' 不存在")
     for cid in nebula.concept_ids:
-        if not any(c["id"] == cid for c in concepts):
+        if not repo.exists("concepts", cid):
             raise HTTPException(404, f"概念 '{cid}' 不存在")
     new_nebula = {"id": f"nebula_{uuid.uuid4().hex[:8]}", "name": nebula.name, "case_ids": nebula.case_ids, "concept_ids": nebula.concept_ids}
-    nebulas.append(new_nebula)
-    save_nebulas(nebulas)
+    repo.put("nebulas", new_nebula)
     return new_nebula
 
 @app.put("/api/nebulas/{nebula_id}")
 def update_nebula(nebula_id: str, update: NebulaUpdate):
-    nebulas = load_nebulas()
-    cases = load_cases()
-    concepts = load_concepts()
-    for n in nebulas:
-        if n["id"] == nebula_id:
-            if update.name is not None:
-                n["name"] = update.name
-            if update.case_ids is not None:
-                for cid in update.case_ids:
-                    if not any(c["id"] == cid for c in cases):
-                        raise HTTPException(404, f"案例 '{cid}' 不存在")
-                n["case_ids"] = update.case_ids
-            if update.concept_ids is not None:
-                for cid in update.concept_ids:
-                    if not any(c["id"] == cid for c in concepts):
-                        raise HTTPException(404, f"概念 '{cid}' 不存在")
-                n["concept_ids"] = update.concept_ids
-            save_nebulas(nebulas)
-            return n
-    raise HTTPException(404, "Nebula not found")
+    _record_history("update_nebula", {"nebula_id": nebula_id})
+    n = repo.get("nebulas", nebula_id)
+    if n is None:
+        raise HTTPException(404, "Nebula not found")
+    if update.name is not None:
+        n["name"] = update.name
+    if update.case_ids is not None:
+        for cid in update.case_ids:
+            if not repo.exists("cases", cid):
+                raise HTTPException(404, f"案例 '{cid}' 不存在")
+        n["case_ids"] = update.case_ids
+    if update.concept_ids is not None:
+        for cid in update.concept_ids:
+            if not repo.exists("concepts", cid):
+                raise HTTPException(404, f"概念 '{cid}' 不存在")
+        n["concept_ids"] = update.concept_ids
+    repo.put("nebulas", n)
+    return n
 
 @app.delete("/api/nebulas/{nebula_id}")
 def delete_nebula(nebula_id: str):
-    nebulas = load_nebulas()
-    nebulas = [n for n in nebulas if n["id"] != nebula_id]
-    save_nebulas(nebulas)
+    _record_history("delete_nebula", {"nebula_id": nebula_id})
+    repo.delete("nebulas", nebula_id)
     return {"ok": True}
 
 # —— AI Inspiration Search（支持豆包/火山方舟联网搜索）——
@@ -1352,6 +1853,22 @@ def list_tags():
     return load_tags()
 
 
+@app.get("/api/tags/{tag_id}/hierarchy")
+def get_tag_hierarchy(tag_id: str):
+    """标签在层级中的位置：全部祖先和后代（按层数排序，depth 为与该标签相隔的层数）及自身到根的层数"""
+    td = repo.peek("tags", tag_id)
+    if td is None:
+        raise HTTPException(404, "Tag not found")
+    tags = load_tags()
+
+    def listing(related: dict[str, int]) -> list[dict]:
+        return [{"id": tid, "name": tags[tid]["name"], "depth": depth}
+                for tid, depth in sorted(related.items(), key=lambda kv: (kv[1], kv[0]))]
+
+    return {"id": tag_id, "name": td["name"], "depth": repo.tag_depth(tag_id),
+            "ancestors": listing(repo.tag_ancestors(tag_id)), "descendants": listing(repo.tag_descendants(tag_id))}
+
+
 @app.post("/api/tags/sync-from-cases")
 def sync_tags_from_cases():
     """将当前所有案例中的标签名同步到 tags.json，使标签管理与案例标签统一为一套体系。可多次调用。"""
@@ -1363,261 +1880,1464 @@ def sync_tags_from_cases():
 @app.post("/api/tags")
 def create_tag(tag: TagCreate):
     _record_history("create_tag", {"tag_name": tag.name})
-    tags = load_tags()
-    cases = load_cases()
     tag_id = f"tag_{uuid.uuid4().hex[:8]}"
     all_parent_ids = tag.parent_ids if tag.parent_ids else ([tag.parent_id] if tag.parent_id else [])
     parent_details = []
     for pid in all_parent_ids:
-        is_case = any(c["id"] == pid for c in cases)
-        is_tag = pid in tags
+        is_case = repo.exists("cases", pid)
+        is_tag = repo.exists("tags", pid)
         if not is_case and not is_tag:
             raise HTTPException(404, f"父节点 '{pid}' 不存在")
         parent_details.append({"id": pid, "type": "case" if is_case else "tag"})
-    for pd in parent_details:
-        if pd["type"] == "tag" and pd["id"] in tags:
-            if "children" not in tags[pd["id"]]: tags[pd["id"]]["children"] = []
-            if tag_id not in tags[pd["id"]]["children"]: tags[pd["id"]]["children"].append(tag_id)
-    tags[tag_id] = {"id": tag_id, "name": tag.name, "parent_id": all_parent_ids[0] if len(all_parent_ids)==1 else None, "parent_ids": all_parent_ids, "parent_details": parent_details, "children": []}
-    save_tags(tags)
-    return tags[tag_id]
+    with repo.batch():
+        for pd in parent_details:
+            if pd["type"] == "tag":
+                parent = repo.get("tags", pd["id"])
+                if tag_id not in parent.setdefault("children", []):
+                    parent["children"].append(tag_id)
+                    repo.put("tags", parent)
+        new_tag = {"id": tag_id, "name": tag.name, "parent_id": all_parent_ids[0] if len(all_parent_ids)==1 else None, "parent_ids": all_parent_ids, "parent_details": parent_details, "children": []}
+        repo.put("tags", new_tag)
+    return new_tag
 
 @app.put("/api/tags/{tag_id}")
 def update_tag(tag_id: str, update: TagUpdate):
     _record_history("update_tag", {"tag_id": tag_id})
-    tags = load_tags()
-    cases = load_cases()
-    if tag_id not in tags: raise HTTPException(404, "Tag not found")
-    if update.name is not None: tags[tag_id]["name"] = update.name
+    t = repo.get("tags", tag_id)
+    if t is None: raise HTTPException(404, "Tag not found")
+    if update.name is not None: t["name"] = update.name
     new_parent_ids = None
     if update.parent_ids is not None: new_parent_ids = update.parent_ids
     elif update.parent_id is not None: new_parent_ids = [update.parent_id] if update.parent_id else []
-    if new_parent_ids is not None:
-        old_pids = tags[tag_id].get("parent_ids", [])
-        if not old_pids and tags[tag_id].get("parent_id"): old_pids = [tags[tag_id]["parent_id"]]
-        for op in old_pids:
-            if op in tags and "children" in tags[op]: tags[op]["children"] = [c for c in tags[op]["children"] if c != tag_id]
-        parent_details = []
-        for pid in new_parent_ids:
-            if pid:
-                is_case = any(c["id"]==pid for c in cases)
-                is_tag = pid in tags
-                if not is_case and not is_tag: raise HTTPException(404, f"父节点 '{pid}' 不存在")
-                parent_details.append({"id":pid,"type":"case" if is_case else "tag"})
-                if is_tag:
-                    if "children" not in tags[pid]: tags[pid]["children"] = []
-                    if tag_id not in tags[pid]["children"]: tags[pid]["children"].append(tag_id)
-        tags[tag_id]["parent_id"] = new_parent_ids[0] if len(new_parent_ids)==1 else None
-        tags[tag_id]["parent_ids"] = new_parent_ids
-        tags[tag_id]["parent_details"] = parent_details
-    save_tags(tags)
-    return tags[tag_id]
+    with repo.batch():
+        if new_parent_ids is not None:
+            cycle = repo.tag_cycle(tag_id, new_parent_ids)
+            if cycle is not None:
+                raise HTTPException(400, f"不能把 '{cycle}' 设为父节点：它是该标签自身或其子孙，会形成环")
+            old_pids = t.get("parent_ids", [])
+            if not old_pids and t.get("parent_id"): old_pids = [t["parent_id"]]
+            for op in old_pids:
+                parent = repo.get("tags", op)
+                if parent and tag_id in parent.get("children", []):
+                    parent["children"] = [c for c in parent["children"] if c != tag_id]
+                    repo.put("tags", parent)
+            parent_details = []
+            for pid in new_parent_ids:
+                if pid:
+                    is_case = repo.exists("cases", pid)
+                    parent = repo.get("tags", pid)
+                    if not is_case and parent is None: raise HTTPException(404, f"父节点 '{pid}' 不存在")
+                    parent_details.append({"id":pid,"type":"case" if is_case else "tag"})
+                    if parent is not None and tag_id not in parent.setdefault("children", []):
+                        parent["children"].append(tag_id)
+                        repo.put("tags", parent)
+            t["parent_id"] = new_parent_ids[0] if len(new_parent_ids)==1 else None
+            t["parent_ids"] = new_parent_ids
+            t["parent_details"] = parent_details
+        repo.put("tags", t)
+    return t
 
 @app.delete("/api/tags/{tag_id}")
 def delete_tag(tag_id: str):
     _record_history("delete_tag", {"tag_id": tag_id})
-    tags = load_tags()
-    cases = load_cases()
-    if tag_id not in tags: raise HTTPException(404, "Tag not found")
-    if tags[tag_id].get("children"): raise HTTPException(400, "请先删除所有子标签")
-    pids = tags[tag_id].get("parent_ids", [])
-    if not pids and tags[tag_id].get("parent_id"): pids = [tags[tag_id]["parent_id"]]
-    for pid in pids:
-        if pid in tags and "children" in tags[pid]: tags[pid]["children"] = [c for c in tags[pid]["children"] if c != tag_id]
-    tag_name = tags[tag_id]["name"]
-    used = [c for c in cases if tag_name in c.get("tags", [])]
+    t = repo.get("tags", tag_id)
+    if t is None: raise HTTPException(404, "Tag not found")
+    if repo.tag_descendants(tag_id): raise HTTPException(400, "请先删除所有子标签")
+    tag_name = t["name"]
+    used = repo.case_ids_with_tag(tag_name)
     if used: raise HTTPException(400, f"标签 '{tag_name}' 正在被 {len(used)} 个案例使用")
-    del tags[tag_id]
-    save_tags(tags)
+    pids = t.get("parent_ids", [])
+    if not pids and t.get("parent_id"): pids = [t["parent_id"]]
+    with repo.batch():
+        for pid in pids:
+            parent = repo.get("tags", pid)
+            if parent and "children" in parent:
+                parent["children"] = [c for c in parent["children"] if c != tag_id]
+                repo.put("tags", parent)
+        repo.delete("tags", tag_id)
     return {"ok": True}
 
 # —— Graph Data ——
-@app.get("/api/graph")
-def get_graph(active_nebula_id: str | None = None):
-    """获取图谱数据。如果指定 active_nebula_id，则只显示该星云内的节点，其他星云收起显示。"""
-    cached = _get_cached_graph(active_nebula_id)
-    if cached:
+def _tag_parents(td: dict) -> tuple[list, list]:
+    """标签的父节点 id 与详情，兼容旧的单父字段 parent_id/parent_type"""
+    pids = td.get("parent_ids", [])
+    pdetails = td.get("parent_details", [])
+    if not pids and td.get("parent_id"):
+        pids = [td["parent_id"]]
+        pdetails = [{"id": td["parent_id"], "type": td.get("parent_type", "tag")}]
+    return pids, pdetails
+
+
+def _edge_key(e: dict) -> tuple[str, str, str]:
+    return e["source"], e["target"], e["type"]
+
+
+class GraphModel:
+    """常驻内存的图谱模型：节点表 + 按所属实体分组的边 + 邻接索引。
+
+    仓库每次提交后只重算被改动的实体（以及引用了改动标签的案例）的节点和边，
+    并记录节点/边的增量；/api/graph 只是从模型中投影出所需视图。
+    """
+
+    def __init__(self):
+        self.version = -1                                  # 与 repo.version 不一致时整体重建
+        self.nodes: dict[str, dict] = {}                   # 案例/概念/标签/星云节点
+        self.legacy_nodes: dict[str, dict] = {}            # 案例中出现但未注册的标签名生成的节点
+        self.edges: dict[tuple[str, str], list] = {}       # (kind, 所属实体 id) -> 该实体产生的边
+        self.links: dict[tuple[str, str], dict] = {}       # 星云对 -> nebula_link 边（不含共享明细）
+        self.link_shared: dict[tuple[str, str], tuple] = {} # 星云对 -> (共享案例, 共享概念)
+        self._members: dict[str, tuple[set, set]] = {}     # 星云 -> (案例集合, 概念集合)
+        self._nebula_order: Optional[dict[str, int]] = None
+        self.adjacency: dict[str, dict[tuple[str, str], int]] = {}  # 节点 -> {(邻居, 边类型): 条数}
+        self._links_by_nebula: dict[str, set] = {}
+        self._case_unresolved: dict[str, list[str]] = {}
+        self._unresolved_count: dict[str, int] = {}
+        self._delta: Optional[dict] = None
+
+    # —— 增量维护 ——
+    def apply(self, changes: list) -> Optional[dict]:
+        """根据一次提交的 (kind, id, before, after) 列表更新模型，返回节点/边增量"""
+        if self.version != repo.version - 1:
+            self.version = -1
+            return None  # 尚未构建或已落后（如 reload），下次投影时整体重建
+        self._begin()
+        touched = {kind: set() for kind in COLLECTION_FILES}
+        legacy = set()
+        for kind, eid, before, after in changes:
+            touched[kind].add(eid)
+            if kind == "tags":
+                # 标签增删改名会改变同名/同 id 标签字符串的解析结果
+                names = {t.get("name") for t in (before, after) if t}
+                legacy |= names
+                for s in names | {eid}:
+                    touched["cases"] |= repo.case_ids_with_tag(s)
+        for cid in touched["cases"]:
+            legacy |= self._refresh_case(cid)
+        for kid in touched["concepts"]:
+            self._refresh_concept(kid)
+        for tid in touched["tags"]:
+            self._refresh_tag(tid)
+        self._nebula_order = None
+        for nid in touched["nebulas"]:
+            self._refresh_members(nid)
+        for s in legacy:
+            self._refresh_legacy(s)
+        for nid in touched["nebulas"]:
+            self._refresh_nebula(nid)
+        self.version = repo.version
+        delta, self._delta = self._delta, None
+        return delta
+
+    def rebuild(self):
+        self.__init__()
+        self._begin()
+        for c in repo.view("cases"):
+            self._refresh_case(c["id"])
+        for k in repo.view("concepts"):
+            self._refresh_concept(k["id"])
+        for tid in repo.view("tags"):
+            self._refresh_tag(tid)
+        for s in list(self._unresolved_count):
+            self._refresh_legacy(s)
+        for n in repo.view("nebulas"):
+            self._refresh_members(n["id"])
+        for n in repo.view("nebulas"):
+            self._refresh_nebula(n["id"], rebuilding=True)
+        self.version = repo.version
+        self._delta = None
+
+    def _begin(self):
+        self._delta = {"nodes": {"add": [], "update": [], "remove": []},
+                       "edges": {"add": [], "update": [], "remove": []}}
+
+    def _set_node(self, table: dict, nid: str, node: Optional[dict]):
+        old = table.get(nid)
+        if node is None:
+            if old is not None:
+                del table[nid]
+                self._delta["nodes"]["remove"].append(nid)
+        elif old is None:
+            table[nid] = node
+            self._delta["nodes"]["add"].append(node)
+        elif old != node:
+            table[nid] = node
+            self._delta["nodes"]["update"].append(node)
+
+    def _adjacent(self, key: tuple[str, str, str], n: int):
+        source, target, etype = key
+        self._adjacent_half(source, (target, etype), n)
+        self._adjacent_half(target, (source, etype), n)
+
+    def _adjacent_half(self, node: str, nbr: tuple[str, str], n: int):
+        nbrs = self.adjacency.get(node)
+        if nbrs is None:
+            nbrs = self.adjacency[node] = {}
+        count = nbrs.get(nbr, 0) + n
+        if count > 0:
+            nbrs[nbr] = count
+        else:
+            del nbrs[nbr]
+            if not nbrs:
+                del self.adjacency[node]
+
+    def _set_edges(self, owner: tuple[str, str], edges: list[dict]):
+        old = self.edges.get(owner, [])
+        if old == edges:
+            return
+        old_keys, new_keys = Counter(map(_edge_key, old)), Counter(map(_edge_key, edges))
+        for key, n in (old_keys - new_keys).items():
+            self._adjacent(key, -n)
+            self._delta["edges"]["remove"].append(dict(zip(("source", "target", "type"), key)))
+        for key, n in (new_keys - old_keys).items():
+            self._adjacent(key, n)
+            self._delta["edges"]["add"].append(dict(zip(("source", "target", "type"), key)))
+        if edges:
+            self.edges[owner] = edges
+        else:
+            self.edges.pop(owner, None)
+
+    def _set_link(self, pair: tuple[str, str], edge: Optional[dict]):
+        old = self.links.get(pair)
+        if old == edge:
+            return
+        if old is not None and (edge is None or _edge_key(old) != _edge_key(edge)):
+            self._adjacent(_edge_key(old), -1)
+            self._delta["edges"]["remove"].append({k: old[k] for k in ("source", "target", "type")})
+            for nid in pair:
+                _discard(self._links_by_nebula, nid, pair)
+            del self.links[pair]
+            old = None
+        if edge is None:
+            self.link_shared.pop(pair, None)
+            return
+        if old is None:
+            self._adjacent(_edge_key(edge), 1)
+            self._delta["edges"]["add"].append(edge)
+            for nid in pair:
+                self._links_by_nebula.setdefault(nid, set()).add(pair)
+        else:
+            self._delta["edges"]["update"].append(edge)
+        self.links[pair] = edge
+
+    def _refresh_case(self, cid: str) -> set[str]:
+        """重算案例节点和 case_tag 边，返回未注册标签名引用数发生变化的标签名"""
+        c = repo.peek("cases", cid)
+        node, edges, unresolved = None, [], []
+        if c is not None:
+            node = {"id": c["id"], "label": c["name"], "type": "case", "architect": c.get("architect", ""),
+                    "description": c.get("description", ""), "tags": c.get("tags", [])}
+            for tag in c.get("tags", []):
+                tag_id = tag if tag.startswith("tag_") else repo.tag_id_by_name(tag)
+                if not (tag_id and repo.exists("tags", tag_id)):
+                    tag_id = f"tag_{tag}"
+                    unresolved.append(tag)
+                edges.append({"source": cid, "target": tag_id, "type": "case_tag"})
+        self._set_node(self.nodes, cid, node)
+        self._set_edges(("cases", cid), edges)
+        old = self._case_unresolved.pop(cid, [])
+        if unresolved:
+            self._case_unresolved[cid] = unresolved
+        for tag in old:
+            self._unresolved_count[tag] -= 1
+            if not self._unresolved_count[tag]:
+                del self._unresolved_count[tag]
+        for tag in unresolved:
+            self._unresolved_count[tag] = self._unresolved_count.get(tag, 0) + 1
+        return set(old) ^ set(unresolved)
+
+    def _refresh_legacy(self, tag: str):
+        # 兼容未同步的旧数据：案例中出现的标签名若尚未在 tags 中，仍为其生成节点
+        node = None
+        if self._unresolved_count.get(tag) and not repo.tag_id_by_name(tag):
+            node = {"id": f"tag_{tag}", "label": tag, "type": "tag", "parent_ids": [], "parent_details": [],
+                    "is_subtag": False, "is_bridge": False}
+        self._set_node(self.legacy_nodes, f"tag_{tag}", node)
+
+    def _refresh_concept(self, kid: str):
+        k = repo.peek("concepts", kid)
+        node = None
+        if k is not None:
+            node = {"id": k["id"], "label": k["name"], "type": "concept", "keywords": k.get("keywords", []),
+                    "description": k.get("description", ""), "image_url": k.get("image_url", ""),
+                    "source_url": k.get("source_url", "")}
+        self._set_node(self.nodes, kid, node)
+
+    def _refresh_tag(self, tid: str):
+        td = repo.peek("tags", tid)
+        node, edges = None, []
+        if td is not None:
+            pids, pdetails = _tag_parents(td)
+            node = {"id": tid, "label": td["name"], "type": "tag", "parent_ids": pids, "parent_details": pdetails,
+                    "is_subtag": len(pids) > 0, "is_bridge": len(pids) > 1}
+            edges = [{"source": pd["id"], "target": tid, "type": "tag_hierarchy" if pd["type"] == "tag" else "case_subtag"}
+                     for pd in pdetails]
+        self._set_node(self.nodes, tid, node)
+        self._set_edges(("tags", tid), edges)
+
+    def _refresh_nebula(self, nid: str, rebuilding: bool = False):
+        n = repo.peek("nebulas", nid)
+        node, edges = None, []
+        if n is not None:
+            node = {"id": n["id"], "label": n["name"], "type": "nebula", "case_ids": n.get("case_ids", []),
+                    "concept_ids": n.get("concept_ids", []), "is_active": False, "is_collapsed": False}
+            edges = [{"source": nid, "target": cid, "type": "nebula_case"} for cid in n.get("case_ids", [])]
+            edges += [{"source": nid, "target": cid, "type": "nebula_concept"} for cid in n.get("concept_ids", [])]
+        self._set_node(self.nodes, nid, node)
+        self._set_edges(("nebulas", nid), edges)
+        self._refresh_links(nid, n, rebuilding)
+
+    def _refresh_members(self, nid: str):
+        n = repo.peek("nebulas", nid)
+        if n is None:
+            self._members.pop(nid, None)
+        else:
+            self._members[nid] = (set(n.get("case_ids", [])), set(n.get("concept_ids", [])))
+
+    def _order(self) -> dict[str, int]:
+        """星云在列表中的位置"""
+        if self._nebula_order is None:
+            self._nebula_order = {n["id"]: i for i, n in enumerate(repo.view("nebulas"))}
+        return self._nebula_order
+
+    def _refresh_links(self, nid: str, n: Optional[dict], rebuilding: bool = False):
+        """重算该星云与其他星云之间的连接（基于共享案例/概念数）。
+        通过 成员 -> 星云 倒排索引只访问确实有共享成员的星云，而不是两两比较；
+        整体重建时每对星云只在排在前面的一方计算一次。"""
+        shared: dict[str, tuple[list, list]] = {}
+        if n is not None:
+            members, order = self._members, self._order()
+            for i, member_ids in enumerate((n.get("case_ids", []), n.get("concept_ids", []))):
+                for mid in dict.fromkeys(member_ids):
+                    for other in repo.nebula_ids_containing(mid):
+                        if other == nid or other not in members or mid not in members[other][i]:
+                            continue
+                        if rebuilding and order[other] < order[nid]:
+                            continue
+                        shared.setdefault(other, ([], []))[i].append(mid)
+        for pair in list(self._links_by_nebula.get(nid, ())) if not rebuilding else ():
+            if (pair[1] if pair[0] == nid else pair[0]) not in shared:
+                self._set_link(pair, None)
+        for other, (shared_cases, shared_concepts) in shared.items():
+            # 边的方向与星云列表中的先后一致；共享数量越多，权重越大（用于前端决定线的粗细/亮度）
+            order = self._order()
+            source, target = (nid, other) if order[nid] < order[other] else (other, nid)
+            pair = tuple(sorted((nid, other)))
+            self._set_link(pair, {"source": source, "target": target, "type": "nebula_link",
+                                  "weight": len(shared_cases) + len(shared_concepts)})
+            self.link_shared[pair] = (sorted(shared_cases), sorted(shared_concepts))
+
+    def shared_members(self, nid1: str, nid2: str) -> tuple[list, list]:
+        """两个星云共享的案例和概念"""
+        with repo.lock:
+            if self.version != repo.version:
+                self.rebuild()
+            return self.link_shared.get(tuple(sorted((nid1, nid2))), ([], []))
+
+    def _links(self, include_shared: bool) -> list[dict]:
+        if not include_shared:
+            return list(self.links.values())
+        return [{**e, "shared_cases": self.link_shared[pair][0], "shared_concepts": self.link_shared[pair][1]}
+                for pair, e in self.links.items()]
+
+    # —— 遍历 ——
+    def _node(self, nid: str) -> Optional[dict]:
+        return self.nodes.get(nid) or self.legacy_nodes.get(nid)
+
+    def _neighbors(self, nid: str, edge_types: Optional[frozenset]):
+        for (other, etype) in self.adjacency.get(nid, ()):
+            if (edge_types is None or etype in edge_types) and self._node(other) is not None:
+                yield other
+
+    def _edges_among(self, ids, edge_types: Optional[frozenset]) -> list[dict]:
+        """两端都在 ids 中的边（保持原有方向）；每条边只属于一个实体，按所属实体取出即可不重不漏"""
+        edges = []
+        for nid in ids:
+            for kind in ("cases", "tags", "nebulas"):
+                edges += [e for e in self.edges.get((kind, nid), ())
+                          if e["source"] in ids and e["target"] in ids and (edge_types is None or e["type"] in edge_types)]
+            if edge_types is None or "nebula_link" in edge_types:
+                edges += [self.links[pair] for pair in self._links_by_nebula.get(nid, ()) if pair[0] == nid and pair[1] in ids]
+        return edges
+
+    def neighborhood(self, nid: str, hops: int, edge_types: Optional[frozenset] = None,
+                     limit: int = 500) -> Optional[dict]:
+        """从 nid 出发沿邻接索引做 BFS，返回 hops 跳以内的节点（附 hops 距离）及它们之间的边；
+        节点数达到 limit 时停止扩展并标记 truncated。节点不存在时返回 None。"""
+        with repo.lock:
+            if self.version != repo.version:
+                self.rebuild()
+            if self._node(nid) is None:
+                return None
+            depth, frontier, truncated = {nid: 0}, [nid], False
+            for d in range(1, hops + 1):
+                reached = []
+                for current in frontier:
+                    for other in self._neighbors(current, edge_types):
+                        if other in depth:
+                            continue
+                        if len(depth) >= limit:
+                            truncated = True
+                            break
+                        depth[other] = d
+                        reached.append(other)
+                    if truncated:
+                        break
+                if truncated or not reached:
+                    break
+                frontier = reached
+            nodes = [{**self._node(n), "hops": d} for n, d in depth.items()]
+            return {"nodes": nodes, "edges": self._edges_among(depth, edge_types), "truncated": truncated,
+                    "version": self.version}
+
+    def shortest_path(self, source: str, target: str, edge_types: Optional[frozenset] = None,
+                      max_hops: Optional[int] = None) -> Optional[dict]:
+        """双向 BFS 求两点间的最短路径（边视为无向），每轮从较小的一侧扩展。
+        返回路径上的节点和相邻两点之间的边，不可达时 length 为 None；任一端点不存在时返回 None。"""
+        with repo.lock:
+            if self.version != repo.version:
+                self.rebuild()
+            if self._node(source) is None or self._node(target) is None:
+                return None
+            parents = ({source: None}, {target: None})
+            frontiers = ([source], [target])
+            meet, hops = (source if source == target else None), 0
+            while meet is None and frontiers[0] and frontiers[1] and (max_hops is None or hops < max_hops):
+                side = 0 if len(frontiers[0]) <= len(frontiers[1]) else 1
+                mine, theirs = parents[side], parents[1 - side]
+                reached = []
+                for current in frontiers[side]:
+                    for other in self._neighbors(current, edge_types):
+                        if other in mine:
+                            continue
+                        mine[other] = current
+                        reached.append(other)
+                        if other in theirs:
+                            meet = other
+                            break
+                    if meet is not None:
+                        break
+                frontiers = (reached, frontiers[1]) if side == 0 else (frontiers[0], reached)
+                hops += 1
+            if meet is None:
+                return {"nodes": [], "edges": [], "length": None, "version": self.version}
+            path, n = [], meet
+            while n is not None:
+                path.append(n)
+                n = parents[0][n]
+            path.reverse()
+            n = parents[1][meet]
+            while n is not None:
+                path.append(n)
+                n = parents[1][n]
+            steps = {frozenset(pair) for pair in zip(path, path[1:])}
+            edges, seen = [], set()
+            for e in self._edges_among(set(path), edge_types):
+                step = frozenset((e["source"], e["target"]))
+                if step in steps and step not in seen:
+                    seen.add(step)
+                    edges.append(e)
+            return {"nodes": [self._node(n) for n in path], "edges": edges, "length": len(path) - 1,
+                    "version": self.version}
+
+    # —— 投影 ——
+    def project(self, active_nebula_id: Optional[str] = None, include_shared: bool = False) -> dict:
+        """从模型投影出图谱视图；节点和边对象在模型中只会被整体替换，可直接共享。
+        include_shared 为真时星云连接附带共享案例/概念列表。"""
+        with repo.lock:
+            if self.version != repo.version:
+                self.rebuild()
+            if not active_nebula_id:
+                nodes = list(self.nodes.values()) + list(self.legacy_nodes.values())
+                edges = [e for es in self.edges.values() for e in es] + self._links(include_shared)
+                return {"nodes": nodes, "edges": edges, "version": self.version}
+
+            # 激活星云时，只显示该星云内的案例/概念及与之关联的标签，其他星云收起显示
+            active = repo.peek("nebulas", active_nebula_id)
+            visible_case_ids = set(active.get("case_ids", [])) if active else set()
+            visible_concept_ids = set(active.get("concept_ids", [])) if active else set()
+            nodes, edges = [], []
+            related_tag_ids, legacy_ids = {}, {}
+            for cid in visible_case_ids:
+                node = self.nodes.get(cid)
+                if node is None or node["type"] != "case":
+                    continue
+                nodes.append(node)
+                for e in self.edges.get(("cases", cid), []):
+                    edges.append(e)
+                    if e["target"] in self.legacy_nodes:
+                        legacy_ids[e["target"]] = None
+                    elif e["target"] in self.nodes:
+                        related_tag_ids[e["target"]] = None
+            for kid in visible_concept_ids:
+                node = self.nodes.get(kid)
+                if node is not None and node["type"] == "concept":
+                    nodes.append(node)
+            for tid in related_tag_ids:
+                nodes.append(self.nodes[tid])
+                # 只添加父节点也在可见范围内的边
+                edges += [e for e in self.edges.get(("tags", tid), [])
+                          if e["type"] != "case_subtag" or e["source"] in visible_case_ids]
+            nodes += [self.legacy_nodes[tid] for tid in legacy_ids]
+            for n in repo.view("nebulas"):
+                is_active = n["id"] == active_nebula_id
+                nodes.append({**self.nodes[n["id"]], "is_active": is_active, "is_collapsed": not is_active})
+            edges += self.edges.get(("nebulas", active_nebula_id), [])
+            edges += self._links(include_shared)
+            return {"nodes": nodes, "edges": edges, "version": self.version}
+
+
+graph_model = GraphModel()
+
+
+# —— Graph Layout ——
+LAYOUT_ITERATIONS = int(os.getenv("LAYOUT_ITERATIONS", "100"))  # 冷启动布局的迭代次数，热启动只用其五分之一
+LAYOUT_DISTANCE = 70.0  # 理想边长，与前端 d3 力导向的尺度接近
+_layout_cache: "OrderedDict[tuple, dict]" = OrderedDict()  # (星云视图, 数据版本) -> {节点 id: (x, y)}
+_layout_seeds: "OrderedDict[Optional[str], dict]" = OrderedDict()  # 星云视图 -> 最近一次的布局，作为热启动初值
+_layout_lock = threading.Lock()
+
+# 多层网格的候选格子：父格 3x3 邻域的全部子格，相对于 2*父格坐标
+_LAYOUT_CHILD_OFFSETS = [(2 * px + cx, 2 * py + cy) for px in (-1, 0, 1) for py in (-1, 0, 1) for cx in (0, 1) for cy in (0, 1)]
+_LAYOUT_NEIGHBORS = [(dx, dy) for dx in (-1, 0, 1) for dy in (-1, 0, 1)]
+
+
+def _layout_repulsion(x, y, k2: float):
+    """Barnes–Hut 式的斥力近似：在逐层加密的网格上，远处的格子按质心和节点数整体计算，
+    只有最细一层相邻格子里的节点两两精确计算。每层每个节点最多面对 27 个格子。"""
+    n = len(x)
+    fx, fy = np.zeros(n), np.zeros(n)
+    x0, y0 = x.min(), y.min()
+    span = max(float(x.max() - x0), float(y.max() - y0), 1e-6) * (1 + 1e-9)
+    depth = max(0, int(round(np.log2(max(n, 4) / 4) / 2)))  # 最细一层平均每格约 4 个节点
+    off_x, off_y = (np.array(o) for o in zip(*_LAYOUT_CHILD_OFFSETS))
+
+    def cells(size):
+        return (np.minimum(((x - x0) / span * size).astype(np.int64), size - 1),
+                np.minimum(((y - y0) / span * size).astype(np.int64), size - 1))
+
+    for level in range(2, depth + 1):
+        size = 1 << level
+        cx, cy = cells(size)
+        flat = cx * size + cy
+        mass = np.bincount(flat, minlength=size * size).astype(float)
+        com_x = np.bincount(flat, x, minlength=size * size) / np.maximum(mass, 1)
+        com_y = np.bincount(flat, y, minlength=size * size) / np.maximum(mass, 1)
+        kx = ((cx >> 1) << 1)[:, None] + off_x
+        ky = ((cy >> 1) << 1)[:, None] + off_y
+        valid = (kx >= 0) & (kx < size) & (ky >= 0) & (ky < size)
+        valid &= (np.abs(kx - cx[:, None]) > 1) | (np.abs(ky - cy[:, None]) > 1)
+        kflat = np.where(valid, kx * size + ky, 0)
+        dx, dy = x[:, None] - com_x[kflat], y[:, None] - com_y[kflat]
+        w = np.where(valid, mass[kflat], 0.0) * k2 / np.maximum(dx * dx + dy * dy, 1e-2)
+        fx += (dx * w).sum(axis=1)
+        fy += (dy * w).sum(axis=1)
+    # 最细一层：相邻 3x3 格子内的节点精确计算
+    size = 1 << depth
+    cx, cy = cells(size)
+    flat = cx * size + cy
+    order = np.argsort(flat, kind="stable")
+    counts = np.bincount(flat, minlength=size * size)
+    starts = np.cumsum(counts) - counts
+    src, dst = [], []
+    for ox, oy in _LAYOUT_NEIGHBORS:
+        nx, ny = cx + ox, cy + oy
+        i = np.nonzero((nx >= 0) & (nx < size) & (ny >= 0) & (ny < size))[0]
+        nbf = nx[i] * size + ny[i]
+        cnt = counts[nbf]
+        total = int(cnt.sum())
+        if not total:
+            continue
+        # 展开每个节点与相邻格子里所有节点的配对
+        within = np.arange(total) - np.repeat(np.cumsum(cnt) - cnt, cnt)
+        src.append(np.repeat(i, cnt))
+        dst.append(order[np.repeat(starts[nbf], cnt) + within])
+    if src:
+        ii, jj = np.concatenate(src), np.concatenate(dst)
+        keep = ii != jj
+        ii, jj = ii[keep], jj[keep]
+        dx, dy = x[ii] - x[jj], y[ii] - y[jj]
+        w = k2 / np.maximum(dx * dx + dy * dy, 1e-2)
+        fx += np.bincount(ii, dx * w, minlength=n)
+        fy += np.bincount(ii, dy * w, minlength=n)
+    return fx, fy
+
+
+def _force_layout(pos, src, dst, iterations: int, temperature: float):
+    """Fruchterman–Reingold 力导向布局（向量化）。pos 为 N×2 初始坐标，src/dst 为边的端点下标。"""
+    k = LAYOUT_DISTANCE
+    n = len(pos)
+    x, y = pos[:, 0].copy(), pos[:, 1].copy()
+    for step in range(iterations):
+        fx, fy = _layout_repulsion(x, y, k * k)
+        dx, dy = x[src] - x[dst], y[src] - y[dst]
+        pull = np.sqrt(dx * dx + dy * dy) / k
+        fx += np.bincount(dst, dx * pull, minlength=n) - np.bincount(src, dx * pull, minlength=n)
+        fy += np.bincount(dst, dy * pull, minlength=n) - np.bincount(src, dy * pull, minlength=n)
+        fx -= x * (0.5 / k)  # 向中心的引力，避免孤立节点和不连通的分量飘远
+        fy -= y * (0.5 / k)
+        # 每步位移不超过当前温度，温度线性冷却
+        t = temperature * (1 - step / iterations) + 1.0
+        length = np.maximum(np.sqrt(fx * fx + fy * fy), 1e-9)
+        scale = np.minimum(length, t) / length
+        x += fx * scale
+        y += fy * scale
+    return np.stack([x, y], axis=1)
+
+
+def _graph_layout(view: Optional[str], graph: dict) -> Optional[dict]:
+    """计算（或取缓存的）节点坐标，以 (星云视图, 数据版本) 为键。
+    有上一个版本的布局时以它为初值热启动，新节点放在已有邻居旁边，只需少量迭代。"""
+    if np is None:
+        return None
+    key = (view, graph["version"])
+    with _layout_lock:
+        if key in _layout_cache:
+            _layout_cache.move_to_end(key)
+            return _layout_cache[key]
+        seed = _layout_seeds.get(view, {})
+    ids = list(dict.fromkeys(node["id"] for node in graph["nodes"]))
+    index = {nid: i for i, nid in enumerate(ids)}
+    pairs = [(index[e["source"]], index[e["target"]]) for e in graph["edges"]
+             if e["source"] in index and e["target"] in index and e["source"] != e["target"]]
+    src = np.array([p[0] for p in pairs], dtype=np.int64)
+    dst = np.array([p[1] for p in pairs], dtype=np.int64)
+    rng = np.random.default_rng(len(ids))
+    placed = np.array([nid in seed for nid in ids], dtype=bool)
+    radius = LAYOUT_DISTANCE * np.sqrt(max(len(ids), 1))
+    pos = rng.uniform(-radius, radius, size=(len(ids), 2))
+    if placed.any() and not placed.all():
+        pos[placed] = [seed[nid] for nid, p in zip(ids, placed) if p]
+        # 新节点放到一个已就位的邻居附近
+        for a, b in pairs + [(b, a) for a, b in pairs]:
+            if not placed[a] and placed[b]:
+                pos[a] = pos[b] + rng.uniform(-LAYOUT_DISTANCE / 2, LAYOUT_DISTANCE / 2, size=2)
+                placed[a] = True
+    elif placed.any():
+        pos[:] = [seed[nid] for nid in ids]
+    warm = placed.mean() > 0.9 if len(ids) else False
+    iterations = max(LAYOUT_ITERATIONS // 5, 1) if warm else LAYOUT_ITERATIONS
+    temperature = LAYOUT_DISTANCE if warm else radius / 4
+    if len(ids):
+        pos = _force_layout(pos, src, dst, iterations, temperature)
+    positions = {nid: (round(float(x), 1), round(float(y), 1)) for nid, (x, y) in zip(ids, pos)}
+    with _layout_lock:
+        _layout_cache[key] = positions
+        _layout_seeds[view] = positions
+        _layout_seeds.move_to_end(view)
+        for cache in (_layout_cache, _layout_seeds):
+            while len(cache) > GRAPH_CACHE_SIZE:
+                cache.popitem(last=False)
+    return positions
+
+
+def graph_data(active_nebula_id: Optional[str] = None, include_shared: bool = False, layout: bool = False,
+               fields: Optional[frozenset] = None) -> dict:
+    """图谱视图（带缓存），参数含义见 /api/graph；fields 为节点保留的字段，None 表示全部"""
+    view = (active_nebula_id or None, include_shared, layout, fields)
+    cached = _get_cached_graph(view)
+    if cached is not None:
         return cached
-    cases = load_cases()
-    tags = load_tags()
-    concepts = load_concepts()
-    nebulas = load_nebulas()
-    nodes, edges, tag_set = [], [], set()
-    for tid, td in tags.items(): tag_set.add(td["name"])
-    
-    # 确定要显示的案例和概念ID集合
-    visible_case_ids = set()
-    visible_concept_ids = set()
-    if active_nebula_id:
-        active_nebula = next((n for n in nebulas if n["id"] == active_nebula_id), None)
-        if active_nebula:
-            visible_case_ids = set(active_nebula.get("case_ids", []))
-            visible_concept_ids = set(active_nebula.get("concept_ids", []))
-        # 如果星云不存在或为空，仍然显示星云节点本身（让用户知道星云是空的）
-    
-    # 添加案例节点
-    for c in cases:
-        if not active_nebula_id or c["id"] in visible_case_ids:
-            nodes.append({"id":c["id"],"label":c["name"],"type":"case","architect":c.get("architect",""),"description":c.get("description",""),"tags":c.get("tags",[])})
-            for tag in c.get("tags",[]):
-                tag_id = None
-                if tag.startswith("tag_"): tag_id = tag
-                else:
-                    for tid,td in tags.items():
-                        if td["name"]==tag: tag_id=tid; break
-                if tag_id and tag_id in tags: edges.append({"source":c["id"],"target":tag_id,"type":"case_tag"})
-                else:
-                    tag_id = f"tag_{tag}"; tag_set.add(tag)
-                    edges.append({"source":c["id"],"target":tag_id,"type":"case_tag"})
-    
-    # 添加概念节点
-    for concept in concepts:
-        if not active_nebula_id or concept["id"] in visible_concept_ids:
-            nodes.append({"id":concept["id"],"label":concept["name"],"type":"concept","keywords":concept.get("keywords",[]),"description":concept.get("description",""),"image_url":concept.get("image_url",""),"source_url":concept.get("source_url","")})
-    
-    # 添加标签节点（只添加与可见案例/概念关联的标签）
-    if active_nebula_id:
-        # 激活星云时，只添加与星云内案例/概念关联的标签
-        related_tag_ids = set()
-        # 从可见案例的标签中收集标签ID
-        for c in cases:
-            if c["id"] in visible_case_ids:
-                for tag in c.get("tags", []):
-                    if tag.startswith("tag_"):
-                        related_tag_ids.add(tag)
-                    else:
-                        for tid, td in tags.items():
-                            if td["name"] == tag:
-                                related_tag_ids.add(tid)
-                                break
-        # 添加相关标签节点
-        for tid in related_tag_ids:
-            if tid in tags:
-                td = tags[tid]
-                pids = td.get("parent_ids", [])
-                pdetails = td.get("parent_details", [])
-                if not pids and td.get("parent_id"):
-                    pids = [td["parent_id"]]
-                    pdetails = [{"id": td["parent_id"], "type": td.get("parent_type", "tag")}]
-                is_sub = len(pids) > 0
-                is_br = len(pids) > 1
-                nodes.append({"id": tid, "label": td["name"], "type": "tag", "parent_ids": pids, "parent_details": pdetails, "is_subtag": is_sub, "is_bridge": is_br})
-                for pd in pdetails:
-                    # 只添加父节点也在可见范围内的边
-                    if pd["type"] == "case":
-                        if pd["id"] in visible_case_ids:
-                            edges.append({"source": pd["id"], "target": tid, "type": "case_subtag"})
-                    else:
-                        edges.append({"source": pd["id"], "target": tid, "type": "tag_hierarchy"})
+    if fields is not None:
+        full = graph_data(active_nebula_id, include_shared, layout)
+        result = {**full, "nodes": _project(full["nodes"], fields)}
     else:
-        # 未激活星云时，添加所有标签节点
-        for tid, td in tags.items():
-            pids = td.get("parent_ids", [])
-            pdetails = td.get("parent_details", [])
-            if not pids and td.get("parent_id"):
-                pids = [td["parent_id"]]
-                pdetails = [{"id": td["parent_id"], "type": td.get("parent_type", "tag")}]
-            is_sub = len(pids) > 0
-            is_br = len(pids) > 1
-            nodes.append({"id": tid, "label": td["name"], "type": "tag", "parent_ids": pids, "parent_details": pdetails, "is_subtag": is_sub, "is_bridge": is_br})
-            for pd in pdetails:
-                edges.append({"source": pd["id"], "target": tid, "type": "tag_hierarchy" if pd["type"] == "tag" else "case_subtag"})
-    
-    # 兼容未同步的旧数据：案例中出现的标签名若尚未在 tags 中，仍为其生成节点
-    # 只在未激活星云或标签关联到可见案例时添加
-    for tag in tag_set:
-        tid = f"tag_{tag}"
-        if not any(td["name"] == tag for td in tags.values()):
-            # 检查这个标签是否关联到可见案例
-            should_add = not active_nebula_id
-            if active_nebula_id:
-                for c in cases:
-                    if c["id"] in visible_case_ids and tag in c.get("tags", []):
-                        should_add = True
-                        break
-            if should_add:
-                nodes.append({"id": tid, "label": tag, "type": "tag", "parent_ids": [], "parent_details": [], "is_subtag": False, "is_bridge": False})
-    
-    # 添加星云节点
-    for nebula in nebulas:
-        is_active = nebula["id"] == active_nebula_id
-        nodes.append({
-            "id": nebula["id"],
-            "label": nebula["name"],
-            "type": "nebula",
-            "case_ids": nebula.get("case_ids", []),
-            "concept_ids": nebula.get("concept_ids", []),
-            "is_active": is_active,
-            "is_collapsed": not is_active and active_nebula_id is not None
-        })
-        # 星云到其包含的案例/概念的边
-        for cid in nebula.get("case_ids", []):
-            if not active_nebula_id or is_active:
-                edges.append({"source": nebula["id"], "target": cid, "type": "nebula_case"})
-        for cid in nebula.get("concept_ids", []):
-            if not active_nebula_id or is_active:
-                edges.append({"source": nebula["id"], "target": cid, "type": "nebula_concept"})
-    
-    # 计算星云之间的连接（基于共享案例数）
-    for i, n1 in enumerate(nebulas):
-        for n2 in nebulas[i+1:]:
-            shared_cases = set(n1.get("case_ids", [])) & set(n2.get("case_ids", []))
-            shared_concepts = set(n1.get("concept_ids", [])) & set(n2.get("concept_ids", []))
-            shared_count = len(shared_cases) + len(shared_concepts)
-            if shared_count > 0:
-                # 共享数量越多，权重越大（用于前端决定线的粗细/亮度）
-                edges.append({
-                    "source": n1["id"],
-                    "target": n2["id"],
-                    "type": "nebula_link",
-                    "weight": shared_count,
-                    "shared_cases": list(shared_cases),
-                    "shared_concepts": list(shared_concepts)
-                })
-    
-    result = {"nodes": nodes, "edges": edges}
-    _set_cached_graph(active_nebula_id, result)
+        result = graph_model.project(active_nebula_id, include_shared)
+        positions = _graph_layout(active_nebula_id or None, result) if layout else None
+        if positions:
+            result = {**result, "nodes": [{**n, "x": positions[n["id"]][0], "y": positions[n["id"]][1]} for n in result["nodes"]]}
+    _set_cached_graph(view, result, result["version"])
     return result
 
+
+# —— 列式编码 ——
+GRAPH_COLUMNAR_TYPE = "application/vnd.archgraph.columnar+json"
+
+
+def _encode_column(values: list, intern) -> tuple[str, list]:
+    """按值的类型选择列的编码：s=字符串下标 S=字符串下标列表 b=布尔(0/1) n=数值 j=原样 JSON，null 保持为 null"""
+    present = [v for v in values if v is not None]
+    if all(isinstance(v, str) for v in present):
+        return "s", [intern(v) if v is not None else None for v in values]
+    if all(isinstance(v, bool) for v in present):
+        return "b", [int(v) if v is not None else None for v in values]
+    if all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in present):
+        return "n", values
+    if all(isinstance(v, list) and all(isinstance(x, str) for x in v) for v in present):
+        return "S", [[intern(x) for x in v] if v is not None else None for v in values]
+    return "j", values
+
+
+def _graph_columnar(graph: dict) -> dict:
+    """把图谱编码为紧凑的列式结构：
+    - strings：字符串表，节点 id、标签名、描述等所有字符串只出现一次，其余位置用下标引用
+    - nodes：按节点类型分组，每组 {"count", "columns": {字段: {"kind", "values"}}}
+    - edges：source/target 为字符串下标的平行数组（悬空的端点同样在字符串表中），type 为 edge_types 的下标；
+      weight 等其余属性为稀疏列 {"kind", "index": 边下标, "values"}
+    前端的 decodeGraph() 还原为与 JSON 格式相同的 {nodes, edges, version}。"""
+    strings, table = [], {}
+
+    def intern(s: str) -> int:
+        i = table.get(s)
+        if i is None:
+            i = table[s] = len(strings)
+            strings.append(s)
+        return i
+
+    groups: dict[str, list] = {}
+    for n in graph["nodes"]:
+        groups.setdefault(n["type"], []).append(n)
+    nodes = {}
+    for ntype, items in groups.items():
+        columns = {}
+        for key in dict.fromkeys(k for n in items for k in n if k != "type"):
+            kind, values = _encode_column([n.get(key) for n in items], intern)
+            columns[key] = {"kind": kind, "values": values}
+        nodes[ntype] = {"count": len(items), "columns": columns}
+
+    edge_types, type_index = [], {}
+    source, target, etype, extra = [], [], [], {}
+    for i, e in enumerate(graph["edges"]):
+        source.append(intern(e["source"]))
+        target.append(intern(e["target"]))
+        if e["type"] not in type_index:
+            type_index[e["type"]] = len(edge_types)
+            edge_types.append(e["type"])
+        etype.append(type_index[e["type"]])
+        for key, value in e.items():
+            if key not in ("source", "target", "type"):
+                column = extra.setdefault(key, ([], []))
+                column[0].append(i)
+                column[1].append(value)
+    edge_columns = {}
+    for key, (index, values) in extra.items():
+        kind, values = _encode_column(values, intern)
+        edge_columns[key] = {"kind": kind, "index": index, "values": values}
+    return {"format": "columnar", "version": graph["version"], "strings": strings, "nodes": nodes,
+            "edge_types": edge_types, "edges": {"source": source, "target": target, "type": etype, "columns": edge_columns}}
+
+
+@app.get("/api/graph")
+def get_graph(request: Request, response: Response, active_nebula_id: str | None = None,
+              include_shared: bool = False, layout: bool = False, format: str | None = None, fields: str | None = None):
+    """获取图谱数据。如果指定 active_nebula_id，则只显示该星云内的节点，其他星云收起显示。
+    星云连接默认只带权重，include_shared=true 时附带共享案例/概念列表（也可按需调用 /api/nebulas/{id}/shared/{other_id}）。
+    layout=true 时节点附带服务端预先计算的坐标 x/y（需要 numpy），前端只需短暂热启动。
+    format=columnar（或 Accept: application/vnd.archgraph.columnar+json）返回紧凑的列式编码。
+    节点默认只带绘制所需的字段（id、label、type、坐标和状态标记），描述等详情用 fields=all / fields=description,tags 取回，
+    或点开节点时调用 /api/entities 按需获取。"""
+    if format is None:
+        format = "columnar" if GRAPH_COLUMNAR_TYPE in request.headers.get("accept", "") else "json"
+    if format not in ("json", "columnar"):
+        raise HTTPException(400, "format 只支持 json 或 columnar")
+    keep = _parse_fields(fields, GRAPH_NODE_FIELDS, ("id", "label", "type"))
+    graph = graph_data(active_nebula_id, include_shared, layout, keep)
+    cursor = _graph_cursor(graph["version"])  # 订阅 /api/graph/stream 时作为 since
+    if format == "json":
+        response.headers["Vary"] = "Accept"
+        return {**graph, "cursor": cursor}
+    view = (active_nebula_id or None, include_shared, layout, keep, "columnar")
+    encoded = _get_cached_graph(view)
+    if encoded is None or encoded["version"] != graph["version"]:
+        encoded = _graph_columnar(graph)
+        _set_cached_graph(view, encoded, encoded["version"])
+    return JSONResponse({**encoded, "cursor": cursor}, media_type=GRAPH_COLUMNAR_TYPE, headers={"Vary": "Accept"})
+
+
+@app.get("/api/nebulas/{nebula_id}/shared/{other_id}")
+def get_nebula_shared(nebula_id: str, other_id: str):
+    """两个星云共享的案例和概念（星云连接的明细，按需获取）"""
+    if not repo.exists("nebulas", nebula_id) or not repo.exists("nebulas", other_id):
+        raise HTTPException(404, "Nebula not found")
+    shared_cases, shared_concepts = graph_model.shared_members(nebula_id, other_id)
+    return {"weight": len(shared_cases) + len(shared_concepts), "shared_cases": shared_cases, "shared_concepts": shared_concepts}
+
+
+# —— 邻域与路径 ——
+GRAPH_EDGE_TYPES = ("case_tag", "tag_hierarchy", "case_subtag", "nebula_case", "nebula_concept", "nebula_link")
+NEIGHBORHOOD_MAX_HOPS = 6
+NEIGHBORHOOD_LIMIT = 5000
+
+
+def _parse_edge_types(edge_types: Optional[str]) -> Optional[frozenset]:
+    """逗号分隔的边类型，省略表示全部"""
+    if not edge_types:
+        return None
+    types = frozenset(t.strip() for t in edge_types.split(",") if t.strip())
+    unknown = types - set(GRAPH_EDGE_TYPES)
+    if unknown:
+        raise HTTPException(400, f"未知的边类型: {', '.join(sorted(unknown))}")
+    return types
+
+
+@app.get("/api/graph/neighbors/{node_id}")
+def get_neighbors(node_id: str, hops: int = 1, edge_types: str | None = None, limit: int = 500, fields: str | None = None):
+    """节点 hops 跳以内的邻域（在常驻的邻接索引上 BFS，不经过 /api/graph 的投影）。
+    edge_types 为逗号分隔的边类型（如 case_tag,tag_hierarchy），只沿这些边扩展；
+    节点附带 hops 距离，超过 limit 个节点时截断并返回 truncated=true。"""
+    if not 1 <= hops <= NEIGHBORHOOD_MAX_HOPS:
+        raise HTTPException(400, f"hops 须在 1 到 {NEIGHBORHOOD_MAX_HOPS} 之间")
+    if not 1 <= limit <= NEIGHBORHOOD_LIMIT:
+        raise HTTPException(400, f"limit 须在 1 到 {NEIGHBORHOOD_LIMIT} 之间")
+    keep = _parse_fields(fields, GRAPH_NODE_FIELDS + ("hops",), ("id", "label", "type", "hops"))
+    result = graph_model.neighborhood(node_id, hops, _parse_edge_types(edge_types), limit)
+    if result is None:
+        raise HTTPException(404, "Node not found")
+    return {**result, "nodes": _project(result["nodes"], keep)}
+
+
+@app.get("/api/graph/path")
+def get_path(source: str, target: str, edge_types: str | None = None, max_hops: int | None = None, fields: str | None = None):
+    """两个节点之间的最短路径（边视为无向，双向 BFS）；不可达（或超过 max_hops）时 length 为 null"""
+    keep = _parse_fields(fields, GRAPH_NODE_FIELDS, ("id", "label", "type"))
+    result = graph_model.shortest_path(source, target, _parse_edge_types(edge_types), max_hops)
+    if result is None:
+        raise HTTPException(404, "Node not found")
+    return {**result, "nodes": _project(result["nodes"], keep)}
+
+
+GRAPH_EPOCH = uuid.uuid4().hex[:8]  # 进程纪元：数据版本号每次启动从 0 开始，游标带上它才能识别服务已重启
+
+
+def _graph_cursor(version: int) -> str:
+    return f"{GRAPH_EPOCH}:{version}"
+
+
+class GraphEvents:
+    """图谱增量的广播与回放。
+
+    保留最近 GRAPH_DELTA_LOG 个版本的增量；带游标（纪元:版本）重连的客户端只补发错过的部分，
+    游标来自其他纪元（服务重启过）或过旧（增量已被淘汰或模型曾整体重建）时发送 reset，让客户端重新拉取 /api/graph。
+    """
+
+    def __init__(self, size: int):
+        self._log: deque = deque(maxlen=size)  # (事件名, 版本, 数据)，版本连续
+        self._subscribers: dict[asyncio.Queue, asyncio.AbstractEventLoop] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _reset(version: int) -> tuple:
+        return "reset", version, {"version": version}
+
+    def publish(self, version: int, delta: Optional[dict]):
+        """仓库提交时调用（持有仓库锁）；delta 为 None 表示图谱模型需要整体重建"""
+        with self._lock:
+            if delta is None:
+                self._log.clear()
+                event = self._reset(version)
+            else:
+                event = ("delta", version, {"version": version, **delta})
+                self._log.append(event)
+            subscribers = list(self._subscribers.items())
+        for queue, loop in subscribers:
+            loop.call_soon_threadsafe(self._offer, queue, event)
+
+    def _offer(self, queue: asyncio.Queue, event: tuple):
+        if queue.full():
+            # 客户端消费太慢：丢掉积压的增量，让它整体重新拉取
+            while not queue.empty():
+                queue.get_nowait()
+            event = self._reset(event[1])
+        queue.put_nowait(event)
+
+    def subscribe(self, queue: asyncio.Queue, loop: asyncio.AbstractEventLoop, since: Optional[int],
+                  epoch: str = GRAPH_EPOCH) -> list:
+        """登记订阅者，返回需要先补发的事件；since 为客户端已有的版本，epoch 为该版本所属的进程纪元"""
+        with repo.lock, self._lock:
+            current = repo.version
+            backlog = []
+            if epoch != GRAPH_EPOCH:
+                backlog = [self._reset(current)]
+            elif since is not None and since != current:
+                missed = [e for e in self._log if e[1] > since]
+                if since < current and missed and missed[0][1] == since + 1:
+                    backlog = missed
+                else:
+                    backlog = [self._reset(current)]
+            self._subscribers[queue] = loop
+        return backlog
+
+    def unsubscribe(self, queue: asyncio.Queue):
+        with self._lock:
+            self._subscribers.pop(queue, None)
+
+
+graph_events = GraphEvents(GRAPH_DELTA_LOG)
+
+
+def _sse(event: tuple, keep: Optional[frozenset] = None) -> str:
+    """编码一个事件；增量中的节点按订阅者的 fields 投影，与 /api/graph 返回的节点字段一致"""
+    name, version, data = event
+    if name == "delta" and keep is not None:
+        nodes = data["nodes"]
+        data = {**data, "nodes": {**nodes, "add": _project(nodes["add"], keep), "update": _project(nodes["update"], keep)}}
+    return f"id: {_graph_cursor(version)}\nevent: {name}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+def _parse_graph_cursor(cursor: str) -> tuple[Optional[int], str]:
+    """解析游标 纪元:版本；只有版本号时视为本进程的版本，格式不对时当作其他纪元（让客户端重新拉取）"""
+    epoch, _, version = cursor.rpartition(":")
+    if not version.isdigit():
+        return None, ""
+    return int(version), epoch if epoch else GRAPH_EPOCH
+
+
+@app.get("/api/graph/stream")
+async def stream_graph(request: Request, since: str | None = None, fields: str | None = None):
+    """以 Server-Sent Events 推送图谱节点/边的增减与更新（全量视图），事件 id 为游标 纪元:数据版本。
+    since（/api/graph 返回的 cursor，或重连时浏览器自动带上的 Last-Event-ID）为客户端已有的版本，只补发之后的增量；
+    游标来自重启之前的进程时发送 reset。fields 与 /api/graph 相同，节点默认只带绘制所需的字段。"""
+    keep = _parse_fields(fields, GRAPH_NODE_FIELDS, ("id", "label", "type"))
+    cursor = request.headers.get("last-event-id") or since
+    version, epoch = _parse_graph_cursor(cursor) if cursor else (None, GRAPH_EPOCH)
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue(maxsize=GRAPH_DELTA_LOG)
+    backlog = await asyncio.to_thread(graph_events.subscribe, queue, loop, version, epoch)
+
+    async def events():
+        try:
+            yield "retry: 3000\n\n"
+            for event in backlog:
+                yield _sse(event, keep)
+            while not await request.is_disconnected():
+                try:
+                    event = await asyncio.wait_for(queue.get(), timeout=15)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                yield _sse(event, keep)
+        finally:
+            graph_events.unsubscribe(queue)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+# —— Level of Detail ——
+LOD_EXPAND_PX = float(os.getenv("LOD_EXPAND_PX", "60"))  # 超级节点在屏幕上的半径超过多少像素时展开为下一层
+LOD_BATCH = 200                                           # 渐进加载时每批发送的节点数
+LOD_MISC_LABELS = {"case": "其他案例", "concept": "其他概念", "tag": "其他标签"}
+_lod_cache: "OrderedDict[int, dict]" = OrderedDict()      # 数据版本 -> 聚类层级
+_lod_lock = threading.Lock()
+
+
+def _label_propagation(adjacency: dict, seeds: Optional[dict] = None, rounds: int = 20) -> dict[str, str]:
+    """标签传播社区划分：每个节点反复采用邻居中票数最多的标签，直到不再变化。
+    邻居的票按 1/度 加权，避免大标签、星云这类枢纽节点把整张图吞进一个社区；
+    seeds 为初始标签（其余节点以自身 id 起步），按 id 顺序遍历，结果是确定的。"""
+    seeds = seeds or {}
+    labels = {n: seeds.get(n, n) for n in adjacency}
+    degree = {n: sum(nbrs.values()) or 1 for n, nbrs in adjacency.items()}
+    order = sorted(adjacency)
+    for _ in range(rounds):
+        changed = 0
+        for n in order:
+            votes: dict[str, float] = {}
+            for (m, _etype), count in adjacency[n].items():
+                votes[labels[m]] = votes.get(labels[m], 0.0) + count / degree[m]
+            if not votes:
+                continue
+            best = max(votes.items(), key=lambda kv: (kv[1], kv[0]))[0]
+            if best != labels[n]:
+                labels[n] = best
+                changed += 1
+        if not changed:
+            break
+    return labels
+
+
+def _lod_hierarchy() -> dict:
+    """全量视图的三层聚类（按数据版本缓存）：
+    - 第 1 层：星云及其成员按所属星云分组，标签树按根分组，其余节点（含独立的标签）按社区分组
+      （社区以星云成员关系为种子做标签传播）；
+    - 第 2 层：把分组之间的边聚合后再做一次标签传播；
+    - 第 0 层：真实节点。
+    每个聚类的坐标为成员服务端布局坐标的质心，r 为成员到质心的均方根距离，extent 为最大距离。"""
+    graph = graph_data(layout=True)
+    version = graph["version"]
+    with _lod_lock:
+        if version in _lod_cache:
+            return _lod_cache[version]
+    nodes = {n["id"]: n for n in graph["nodes"]}
+    adjacency: dict[str, Counter] = {nid: Counter() for nid in nodes}
+    for e in graph["edges"]:
+        s, t = e["source"], e["target"]
+        if s in nodes and t in nodes and s != t:
+            adjacency[s][(t, e["type"])] += 1
+            adjacency[t][(s, e["type"])] += 1
+    home: dict[str, str] = {}  # 成员 -> 所属的第一个星云
+    for n in reversed(repo.view("nebulas")):
+        for mid in n.get("case_ids", []) + n.get("concept_ids", []):
+            home[mid] = n["id"]
+    seeds = {**home, **{nid: nid for nid, n in nodes.items() if n["type"] == "nebula"}}
+    community = _label_propagation(adjacency, seeds)
+
+    def tag_root(tid: str) -> str:
+        seen = {tid}
+        while True:
+            parents = [pid for pid in nodes[tid].get("parent_ids", []) if nodes.get(pid, {}).get("type") == "tag"]
+            if not parents or parents[0] in seen:
+                return tid
+            tid = parents[0]
+            seen.add(tid)
+
+    roots = {nid: tag_root(nid) for nid, node in nodes.items() if node["type"] == "tag"}
+    trees = {root for nid, root in roots.items() if root != nid}  # 有子标签的根
+    groups: dict[str, str] = {}   # 节点 -> 第 1 层分组
+    labels: dict[str, str] = {}
+    for nid, node in nodes.items():
+        ntype = node["type"]
+        if ntype == "nebula":
+            key, label = nid, node["label"]
+        elif nid in home and home[nid] in nodes:
+            key, label = home[nid], nodes[home[nid]]["label"]
+        elif roots.get(nid) in trees:
+            key = roots[nid]
+            label = nodes[key]["label"]
+        else:
+            key, label = f"{ntype}:{community[nid]}", LOD_MISC_LABELS.get(ntype, ntype)
+        groups[nid] = f"lod1:{key}"
+        labels[groups[nid]] = label
+    # 分组之间的边聚合后再做一次标签传播，得到第 2 层
+    group_adjacency: dict[str, Counter] = {g: Counter() for g in labels}
+    for nid, nbrs in adjacency.items():
+        for (m, _etype), count in nbrs.items():
+            if groups[m] != groups[nid]:
+                group_adjacency[groups[nid]][(groups[m], "cluster_link")] += count
+    top_level = _label_propagation(group_adjacency)
+
+    clusters: dict[str, dict] = {}
+    for nid in nodes:
+        mid_id = groups[nid]
+        top_id = f"lod2:{top_level[mid_id]}"
+        top = clusters.setdefault(top_id, {"id": top_id, "level": 2, "children": {}, "members": []})
+        mid = clusters.setdefault(mid_id, {"id": mid_id, "level": 1, "label": labels[mid_id], "children": {}, "members": []})
+        top["children"][mid_id] = None
+        top["members"].append(nid)
+        mid["children"][nid] = None
+        mid["members"].append(nid)
+
+    degree = {nid: sum(nbrs.values()) for nid, nbrs in adjacency.items()}
+    for c in clusters.values():
+        members = c["members"]
+        xs = [nodes[m].get("x", 0.0) for m in members]
+        ys = [nodes[m].get("y", 0.0) for m in members]
+        cx, cy = sum(xs) / len(xs), sum(ys) / len(ys)
+        c["x"], c["y"] = round(cx, 1), round(cy, 1)
+        dist2 = [(x - cx) ** 2 + (y - cy) ** 2 for x, y in zip(xs, ys)]
+        c["r"] = round((sum(dist2) / len(dist2)) ** 0.5, 1)  # 成员的均方根距离，决定何时展开
+        c["extent"] = round(max(dist2) ** 0.5, 1)            # 最远成员的距离，用于视口裁剪
+        c["size"] = len(members)
+        c["types"] = dict(Counter(nodes[m]["type"] for m in members))
+        c["children"] = list(c["children"])
+    for c in clusters.values():
+        if c["level"] == 2:
+            # 社区以其中最大的分组命名
+            c["label"] = clusters[max(c["children"], key=lambda k: clusters[k]["size"])]["label"]
+    hierarchy = {"version": version, "nodes": nodes, "edges": graph["edges"], "degree": degree, "clusters": clusters,
+                 "roots": sorted((cid for cid, c in clusters.items() if c["level"] == 2),
+                                 key=lambda cid: -clusters[cid]["size"])}
+    with _lod_lock:
+        _lod_cache[version] = hierarchy
+        while len(_lod_cache) > 2:
+            _lod_cache.popitem(last=False)
+    return hierarchy
+
+
+def _lod_view(h: dict, zoom: float, box: Optional[tuple]) -> tuple[list, list]:
+    """按缩放比例和视口选出要显示的节点：视口外的聚类整体跳过；
+    在屏幕上半径超过 LOD_EXPAND_PX 像素（或只有一个成员）的聚类展开为下一层，否则作为超级节点返回。
+    返回按优先级排序的节点（聚类按规模、真实节点按度数，越靠近视口中心越靠前）和边；
+    两端都是真实节点的边原样保留，涉及超级节点的边聚合为带 weight 的 cluster_link。"""
+    clusters, nodes = h["clusters"], h["nodes"]
+    if box:
+        bx0, by0, bx1, by1 = min(box[0], box[2]), min(box[1], box[3]), max(box[0], box[2]), max(box[1], box[3])
+        center = ((bx0 + bx1) / 2, (by0 + by1) / 2)
+        diag = max(((bx1 - bx0) ** 2 + (by1 - by0) ** 2) ** 0.5, 1.0)
+    else:
+        center, diag = (0.0, 0.0), max((c["extent"] for c in clusters.values()), default=1.0) or 1.0
+
+    def visible(x: float, y: float, r: float) -> bool:
+        if not box:
+            return True
+        dx = max(bx0 - x, 0.0, x - bx1)
+        dy = max(by0 - y, 0.0, y - by1)
+        return dx * dx + dy * dy <= r * r
+
+    def priority(item: dict, weight: float) -> float:
+        dist = ((item.get("x", 0.0) - center[0]) ** 2 + (item.get("y", 0.0) - center[1]) ** 2) ** 0.5
+        return weight / (1 + dist / diag)
+
+    shown: list[tuple[float, dict]] = []
+    rep: dict[str, str] = {}  # 真实节点 -> 代表它显示的节点 id
+    stack = list(h["roots"])
+    while stack:
+        cid = stack.pop()
+        c = clusters[cid]
+        if not visible(c["x"], c["y"], c["extent"]):
+            continue
+        if c["size"] > 1 and c["r"] * zoom <= LOD_EXPAND_PX:
+            shown.append((priority(c, c["size"]), {"id": cid, "label": c["label"], "type": "cluster", "level": c["level"],
+                                                   "size": c["size"], "types": c["types"], "x": c["x"], "y": c["y"], "r": c["r"]}))
+            for m in c["members"]:
+                rep[m] = cid
+            continue
+        for child in c["children"]:
+            if child in clusters:
+                stack.append(child)
+                continue
+            node = nodes[child]
+            if visible(node.get("x", 0.0), node.get("y", 0.0), 0.0):
+                shown.append((priority(node, h["degree"][child] + 1), {k: node[k] for k in GRAPH_NODE_FIELDS if k in node}))
+                rep[child] = child
+    shown.sort(key=lambda item: -item[0])
+
+    edges, aggregated = [], Counter()
+    for e in h["edges"]:
+        s, t = rep.get(e["source"]), rep.get(e["target"])
+        if s is None or t is None or s == t:
+            continue
+        if s == e["source"] and t == e["target"]:
+            edges.append(e)
+        else:
+            aggregated[(s, t) if s < t else (t, s)] += 1
+    edges += [{"source": s, "target": t, "type": "cluster_link", "weight": w} for (s, t), w in aggregated.items()]
+    return [item for _, item in shown], edges
+
+
+@app.get("/api/graph/lod")
+def get_graph_lod(zoom: float = 1.0, x0: float | None = None, y0: float | None = None,
+                  x1: float | None = None, y1: float | None = None, batch: int = LOD_BATCH, min_nodes: int = 0):
+    """大图的分层细节视图（全量视图，坐标来自服务端布局）。
+    zoom 为前端的缩放比例，x0/y0/x1/y1 为视口在图坐标系下的范围（省略则为整张图）；
+    缩小时返回聚合的超级节点（type=cluster，带 level、size、types、r），放大后逐层展开为真实节点。
+    响应为 NDJSON：第一行 {"meta": ...}，之后每行一批 {"nodes", "edges"}，按优先级从高到低，
+    每条边随它较晚出现的端点一起发送，前端可以边收边画。
+    全量视图的节点数少于 min_nodes 时只返回 meta，不构建聚类（前端据此改为拉取完整图谱）。"""
+    if np is None:
+        raise HTTPException(503, "LOD 视图依赖服务端布局，需要安装 numpy")
+    if zoom <= 0 or batch <= 0:
+        raise HTTPException(400, "zoom 和 batch 必须为正数")
+    full = graph_data()
+    if len(full["nodes"]) < min_nodes:
+        meta = {"version": full["version"], "cursor": _graph_cursor(full["version"]), "total_nodes": len(full["nodes"])}
+        return StreamingResponse(iter([json.dumps({"meta": meta}) + "\n"]), media_type="application/x-ndjson")
+    corners = (x0, y0, x1, y1)
+    box = corners if None not in corners else None
+    h = _lod_hierarchy()
+    nodes, edges = _lod_view(h, zoom, box)
+    position = {n["id"]: i for i, n in enumerate(nodes)}
+    batches: dict[int, list] = {}
+    for e in edges:
+        batches.setdefault(max(position[e["source"]], position[e["target"]]) // batch, []).append(e)
+    meta = {"version": h["version"], "cursor": _graph_cursor(h["version"]), "zoom": zoom, "total_nodes": len(h["nodes"]), "nodes": len(nodes),
+            "edges": len(edges), "clusters": sum(1 for n in nodes if n["type"] == "cluster")}
+
+    def lines():
+        yield json.dumps({"meta": meta}) + "\n"
+        for i in range(0, len(nodes), batch):
+            yield json.dumps({"nodes": nodes[i:i + batch], "edges": batches.get(i // batch, [])}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+# —— Graph Analytics ——
+ANALYTICS_BETWEENNESS_SAMPLES = int(os.getenv("ANALYTICS_BETWEENNESS_SAMPLES", "256"))  # 介数中心性抽样的源点数，节点不多于它时精确计算
+ANALYTICS_DEBOUNCE = 2.0   # 写入后等待多少秒再后台重算，连续写入只算一次
+PAGERANK_DAMPING = 0.85
+ANALYTICS_METRICS = ("degree", "pagerank", "betweenness")
+
+
+def _pagerank(src, dst, weight, n: int, tol: float = 1e-10, max_iter: int = 100):
+    """加权 PageRank 幂迭代。边以 COO 形式给出（无向边展开为两个方向），bincount 即稀疏矩阵乘向量；
+    没有出边的节点把分数均分给所有节点。"""
+    out = np.bincount(src, weight, minlength=n)
+    share = weight / out[src]
+    dangling = out == 0
+    rank = np.full(n, 1.0 / n)
+    for _ in range(max_iter):
+        new = PAGERANK_DAMPING * (np.bincount(dst, rank[src] * share, minlength=n) + rank[dangling].sum() / n)
+        new += (1 - PAGERANK_DAMPING) / n
+        done = np.abs(new - rank).sum() < tol * n
+        rank = new
+        if done:
+            break
+    return rank
+
+
+def _betweenness(indptr, indices, n: int, sources):
+    """Brandes 算法（无权无向图），以 BFS 层为单位批量处理：每层在 CSR 邻接上一次展开整层、累加最短路条数，
+    回传依赖时同样逐层向量化。只从 sources 出发时结果按 n/len(sources) 放大，作为近似值；
+    无向图的每条最短路会从两端各计一次，最后除以 2。"""
+    bc = np.zeros(n)
+    for s in sources:
+        dist = np.full(n, -1, dtype=np.int64)
+        sigma = np.zeros(n)
+        dist[s], sigma[s] = 0, 1.0
+        frontier, levels, depth = np.array([s]), [], 0
+        while frontier.size:
+            depth += 1
+            starts = indptr[frontier]
+            counts = indptr[frontier + 1] - starts
+            total = int(counts.sum())
+            if not total:
+                break
+            u = np.repeat(frontier, counts)
+            v = indices[np.repeat(starts - (np.cumsum(counts) - counts), counts) + np.arange(total)]
+            dist[v[dist[v] < 0]] = depth
+            keep = dist[v] == depth
+            u, v = u[keep], v[keep]
+            sigma += np.bincount(v, sigma[u], minlength=n)
+            levels.append((u, v))
+            frontier = np.unique(v)
+        delta = np.zeros(n)
+        for u, v in reversed(levels):
+            delta += np.bincount(u, sigma[u] / sigma[v] * (1 + delta[v]), minlength=n)
+        delta[s] = 0.0
+        bc += delta
+    return bc * (n / max(len(sources), 1) / 2)
+
+
+class GraphAnalytics:
+    """全量图谱的分析指标：度、PageRank、介数中心性（大图抽样近似）和社区（标签传播），按数据版本缓存。
+
+    第一次请求时同步计算；此后每次写入唤醒后台线程，防抖 ANALYTICS_DEBOUNCE 秒后按最新版本重算。
+    请求总是立即拿到最近一次的结果，版本落后于数据时标记 stale。从没有人请求过时写入不会触发计算。
+    """
+
+    def __init__(self):
+        self._result: Optional[dict] = None
+        self._lock = threading.Lock()  # 同一时间只有一个计算
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def get(self, fresh: bool = False) -> dict:
+        result = self._result
+        if result is None or (fresh and result["version"] != repo.version):
+            return self._compute()
+        if result["version"] != repo.version:
+            self.schedule()
+        return result
+
+    def schedule(self):
+        """仓库提交后调用（持有仓库锁，只做唤醒）"""
+        if self._result is None:
+            return
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._worker, name="graph-analytics", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def _worker(self):
+        while True:
+            self._wake.wait()
+            time.sleep(ANALYTICS_DEBOUNCE)
+            self._wake.clear()
+            try:
+                self._compute()
+            except Exception:
+                logger.exception("图谱分析失败")
+
+    def _compute(self) -> dict:
+        with self._lock:
+            if self._result is not None and self._result["version"] == repo.version:
+                return self._result
+            with repo.lock:
+                if graph_model.version != repo.version:
+                    graph_model.rebuild()
+                version = graph_model.version
+                nodes = {nid: (n["label"], n["type"]) for table in (graph_model.nodes, graph_model.legacy_nodes)
+                         for nid, n in table.items()}
+                # 与 _lod_hierarchy 一致：丢掉指向已删除节点的悬空边（如被删案例仍留在星云成员里）
+                adjacency = {nid: {(m, etype): count for (m, etype), count in nbrs.items() if m in nodes}
+                             for nid, nbrs in graph_model.adjacency.items() if nid in nodes}
+            self._result = self._analyze(version, nodes, adjacency)
+            return self._result
+
+    @staticmethod
+    def _analyze(version: int, nodes: dict, adjacency: dict) -> dict:
+        started = time.perf_counter()
+        ids = list(nodes)
+        index = {nid: i for i, nid in enumerate(ids)}
+        n = len(ids)
+        # 同一对节点之间的多条边（不同类型）合并为一条带权边
+        pairs: Counter = Counter()
+        for a, nbrs in adjacency.items():
+            for (b, _etype), count in nbrs.items():
+                if b in index and a < b:
+                    pairs[(index[a], index[b])] += count
+        a = np.array([p[0] for p in pairs], dtype=np.int64)
+        b = np.array([p[1] for p in pairs], dtype=np.int64)
+        w = np.array(list(pairs.values()), dtype=float)
+        src, dst, weight = np.concatenate([a, b]), np.concatenate([b, a]), np.concatenate([w, w])
+        degree = np.bincount(src, weight, minlength=n)
+        pagerank = _pagerank(src, dst, weight, n) if n else np.zeros(0)
+        # CSR 邻接（无权）
+        order = np.argsort(src, kind="stable")
+        indices = dst[order]
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(src, minlength=n))])
+        sampled = n > ANALYTICS_BETWEENNESS_SAMPLES
+        sources = (np.random.default_rng(version).choice(n, ANALYTICS_BETWEENNESS_SAMPLES, replace=False)
+                   if sampled else np.arange(n))
+        betweenness = _betweenness(indptr, indices, n, sources)
+
+        labels = _label_propagation(adjacency)
+        by_label: dict[str, list[int]] = {}
+        for nid in ids:
+            by_label.setdefault(labels.get(nid, nid), []).append(index[nid])
+        groups = sorted(by_label.values(), key=lambda g: (-len(g), ids[g[0]]))
+        community = np.zeros(n, dtype=np.int64)
+        for c, members in enumerate(groups):
+            community[members] = c
+        # 模块度 Q = Σ_c [社区内边权/2m - (社区度数和/2m)^2]
+        total = weight.sum()
+        modularity = 0.0
+        if total:
+            inside = np.bincount(community[src], weight * (community[src] == community[dst]), minlength=len(groups))
+            modularity = float((inside / total - (np.bincount(community, degree, minlength=len(groups)) / total) ** 2).sum())
+        communities = []
+        for c, members in enumerate(groups):
+            members = sorted(members, key=lambda i: -pagerank[i])
+            communities.append({"id": c, "size": len(members), "label": nodes[ids[members[0]]][0],
+                                "types": dict(Counter(nodes[ids[i]][1] for i in members)),
+                                "top": [ids[i] for i in members[:10]]})
+        metrics = {"degree": degree, "pagerank": pagerank, "betweenness": betweenness}
+        return {"version": version, "ids": ids, "nodes": nodes, "metrics": metrics, "community": community,
+                "ranking": {m: np.argsort(-values, kind="stable") for m, values in metrics.items()},
+                "communities": communities, "modularity": round(modularity, 4), "edge_count": len(pairs),
+                "betweenness_sources": len(sources) if sampled else None,
+                "seconds": round(time.perf_counter() - started, 3)}
+
+
+graph_analytics = GraphAnalytics()
+
+
+@app.get("/api/graph/analytics")
+def get_graph_analytics(metric: str = "pagerank", type: str | None = None, community: int | None = None,
+                        top: int = 50, fresh: bool = False):
+    """全量图谱的中心性排名与社区划分。
+    metric 为排序指标（degree / pagerank / betweenness），type 只看某类节点（case / tag / concept / nebula），
+    community 只看某个社区的节点；每个节点带全部三项指标和所属社区编号。
+    结果在写入后由后台重算，期间返回上一版本的结果并标记 stale=true；fresh=true 时等待按最新数据计算。
+    节点超过 ANALYTICS_BETWEENNESS_SAMPLES 个时，介数中心性从同样数量的随机源点估计。"""
+    if np is None:
+        raise HTTPException(503, "图谱分析需要安装 numpy")
+    if metric not in ANALYTICS_METRICS:
+        raise HTTPException(400, f"metric 只支持 {' / '.join(ANALYTICS_METRICS)}")
+    if top < 1:
+        raise HTTPException(400, "top 必须为正数")
+    result = graph_analytics.get(fresh)
+    ids, nodes, metrics = result["ids"], result["nodes"], result["metrics"]
+    ranked = []
+    for i in result["ranking"][metric]:
+        nid = ids[i]
+        if (type is not None and nodes[nid][1] != type) or (community is not None and result["community"][i] != community):
+            continue
+        ranked.append({"id": nid, "label": nodes[nid][0], "type": nodes[nid][1], "community": int(result["community"][i]),
+                       **{m: round(float(metrics[m][i]), 6) for m in ANALYTICS_METRICS}})
+        if len(ranked) >= top:
+            break
+    return {"version": result["version"], "stale": result["version"] != repo.version,
+            "node_count": len(ids), "edge_count": result["edge_count"], "modularity": result["modularity"],
+            "betweenness_sources": result["betweenness_sources"], "seconds": result["seconds"],
+            "nodes": ranked, "communities": result["communities"][:top]}
+
 @app.post("/api/cases/from-suggestion")
 def add_from_suggestion(case: CaseCreate):
     cases = load_cases()
     for c in cases:
         if c["name"]==case.name: raise HTTPException(409, f"'{case.name}' 已存在")
     new_case = {"id":f"case_{uuid.uuid4().hex[:8]}", **case.model_dump()}
-    cases.append(new_case)
-    save_cases(cases)
-    sync_case_tags_to_registry(new_case)
+    with repo.batch():
+        repo.put("cases", new_case)
+        sync_case_tags_to_registry(new_case)
     return new_case
 
 # —— Data Export/Import ——
-@app.get("/api/export/json")
-def export_json():
-    """导出完整数据为JSON格式"""
-    data = {
-        "cases": load_cases(),
-        "concepts": load_concepts(),
-        "tags": load_tags(),
-        "nebulas": load_nebulas(),
-        "export_time": str(uuid.uuid4()),  # 简单的时间戳
-        "version": "1.0"
-    }
-    return Response(
-        content=json.dumps(data, ensure_ascii=False, indent=2),
-        media_type="application/json",
-        headers={"Content-Disposition": "attachment; filename=archgraph_export.json"}
-    )
-
-@app.get("/api/export/csv")
-def export_csv():
-    """导出案例数据为CSV格式"""
-    cases = load_cases()
+EXPORT_COLLECTIONS = ("cases", "concepts", "tags", "nebulas")
+EXPORT_CHUNK_SIZE = 64 * 1024  # 流式导出时每次发送的大约字节数
+CSV_HEADER = ["ID", "名称", "建筑师", "年份", "地点", "标签", "描述", "图片URL", "来源URL"]
+
+
+def _parse_collections(collections: Optional[str]) -> list[str]:
+    """逗号分隔的集合名，省略表示全部"""
+    if not collections:
+        return list(EXPORT_COLLECTIONS)
+    kinds = [k.strip() for k in collections.split(",") if k.strip()]
+    unknown = [k for k in kinds if k not in EXPORT_COLLECTIONS]
+    if unknown:
+        raise HTTPException(400, f"未知的集合: {', '.join(unknown)}")
+    return list(dict.fromkeys(kinds))
+
+
+def _chunked(parts):
+    """把很多小字符串攒成约 EXPORT_CHUNK_SIZE 的块再发送"""
+    buf, size = [], 0
+    for part in parts:
+        buf.append(part)
+        size += len(part)
+        if size >= EXPORT_CHUNK_SIZE:
+            yield "".join(buf).encode("utf-8")
+            buf, size = [], 0
+    if buf:
+        yield "".join(buf).encode("utf-8")
+
+
+def _gzipped(chunks):
+    """边生成边压缩（gzip 格式）"""
+    compress, _, finish = _compressor("gzip")
+    for chunk in chunks:
+        out = compress(chunk)
+        if out:
+            yield out
+    yield finish()
+
+
+def _export_response(parts, filename: str, media_type: str, gzip: bool = False) -> StreamingResponse:
+    """流式下载：逐条序列化的字符串片段按块发送，gzip=true 时下载 .gz 文件"""
+    chunks = _chunked(parts)
+    if gzip:
+        chunks, filename, media_type = _gzipped(chunks), filename + ".gz", "application/gzip"
+    return StreamingResponse(chunks, media_type=media_type,
+                             headers={"Content-Disposition": f"attachment; filename={filename}"})
+
+
+def _collection_items(kind: str):
+    """集合的只读视图（tags 附带 id），写入只会替换视图而不会修改它，导出过程中数据保持一致"""
+    items = repo.view(kind)
+    if kind == "tags":
+        return ({**td, "id": tid} for tid, td in items.items())
+    return iter(items)
+
+
+def _json_export_parts(kinds: list[str]):
+    yield "{\n"
+    for kind in kinds:
+        items = repo.view(kind)
+        if kind == "tags":
+            # tags 保持 id -> 标签 的字典结构，与 /api/import/json 一致
+            yield '  "tags": {'
+            records = (f"{json.dumps(tid)}: {json.dumps(td, ensure_ascii=False)}" for tid, td in items.items())
+            close = "}"
+        else:
+            yield f'  "{kind}": ['
+            records = (json.dumps(item, ensure_ascii=False) for item in items)
+            close = "]"
+        first = True
+        for record in records:
+            yield ("\n    " if first else ",\n    ") + record
+            first = False
+        yield ("" if first else "\n  ") + close + ",\n"
+    yield f'  "export_time": "{uuid.uuid4()}",\n  "version": "1.0"\n}}\n'
+
+
+def _csv_export_parts():
     import csv
     import io
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(["ID", "名称", "建筑师", "年份", "地点", "标签", "描述", "图片URL", "来源URL"])
-    for c in cases:
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    yield "\ufeff"  # BOM for Excel
+    writer.writerow(CSV_HEADER)
+    for c in repo.view("cases"):
         writer.writerow([
             c.get("id", ""),
             c.get("name", ""),
@@ -1629,38 +3349,100 @@ def export_csv():
             c.get("image_url", ""),
             c.get("source_url", "")
         ])
-    return Response(
-        content=output.getvalue().encode("utf-8-sig"),  # BOM for Excel
-        media_type="text/csv",
-        headers={"Content-Disposition": "attachment; filename=archgraph_cases.csv"}
-    )
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+
+
+@app.get("/api/export/json")
+def export_json(collections: str | None = None, gzip: bool = False):
+    """导出完整数据为JSON格式。流式输出，每条记录占一行；collections 指定导出哪些集合（逗号分隔），gzip=true 压缩下载"""
+    return _export_response(_json_export_parts(_parse_collections(collections)), "archgraph_export.json",
+                            "application/json", gzip)
+
+
+@app.get("/api/export/ndjson")
+def export_ndjson(collections: str | None = None, gzip: bool = False):
+    """导出为 NDJSON：每行一条记录 {"kind": 集合名, "data": 实体}，tags 的 data 中带 id，可直接用于 /api/import/stream"""
+    kinds = _parse_collections(collections)
+    parts = (json.dumps({"kind": kind, "data": item}, ensure_ascii=False) + "\n"
+             for kind in kinds for item in _collection_items(kind))
+    return _export_response(parts, "archgraph_export.ndjson", "application/x-ndjson", gzip)
+
+
+@app.get("/api/export/csv")
+def export_csv(gzip: bool = False):
+    """导出案例数据为CSV格式（流式输出）"""
+    return _export_response(_csv_export_parts(), "archgraph_cases.csv", "text/csv", gzip)
+
+# XML 1.0 不允许出现的控制字符
+_XML_INVALID = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+_GRAPHML_TYPES = ((bool, "boolean"), (int, "long"), (float, "double"))
+
+
+def _xml_escape(value) -> str:
+    """转义为可放进 XML 文本或双引号属性的字符串；列表/字典先编码为 JSON"""
+    if isinstance(value, bool):
+        value = "true" if value else "false"
+    elif isinstance(value, (list, dict)):
+        value = json.dumps(value, ensure_ascii=False)
+    elif not isinstance(value, str):
+        value = str(value)
+    return _XML_INVALID.sub("", value).replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;").replace('"', "&quot;")
+
+
+def _graphml_keys(items: list[dict], skip: tuple) -> dict[str, str]:
+    """扫描全部元素，得到 属性名 -> GraphML 类型；同一属性的值类型不一致时退化为 string"""
+    kinds: dict[str, set] = {}
+    for item in items:
+        for key, value in item.items():
+            if key not in skip and value is not None:
+                kinds.setdefault(key, set()).add(type(value))
+    keys = {}
+    for key, types in kinds.items():
+        keys[key] = "string"
+        for py_type, graphml_type in _GRAPHML_TYPES:
+            if types == {py_type} or (py_type is float and types <= {int, float}):
+                keys[key] = graphml_type
+                break
+    return keys
+
+
+def _graphml_lines(graph: dict):
+    nodes, edges = graph["nodes"], graph["edges"]
+    node_keys = _graphml_keys(nodes, ("id",))
+    edge_keys = _graphml_keys(edges, ("source", "target"))
+    # 节点和边的 key id 共用一个命名空间，重名时边的加 edge_ 前缀
+    edge_ids = {k: f"edge_{k}" if k in node_keys else k for k in edge_keys}
+    yield '<?xml version="1.0" encoding="UTF-8"?>\n'
+    yield '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
+    for key, kind in node_keys.items():
+        yield f'  <key id="{_xml_escape(key)}" for="node" attr.name="{_xml_escape(key)}" attr.type="{kind}"/>\n'
+    for key, kind in edge_keys.items():
+        yield f'  <key id="{_xml_escape(edge_ids[key])}" for="edge" attr.name="{_xml_escape(key)}" attr.type="{kind}"/>\n'
+    yield '  <graph id="G" edgedefault="directed">\n'
+    node_ids = set()
+    for node in nodes:
+        node_ids.add(node["id"])
+        data = "".join(f'<data key="{_xml_escape(k)}">{_xml_escape(v)}</data>'
+                       for k, v in node.items() if k in node_keys and v is not None)
+        yield f'    <node id="{_xml_escape(node["id"])}">{data}</node>\n'
+    for edge in edges:
+        if edge["source"] not in node_ids or edge["target"] not in node_ids:
+            continue  # 悬空的边（端点不在图中）会让导入工具报错
+        data = "".join(f'<data key="{_xml_escape(edge_ids[k])}">{_xml_escape(v)}</data>'
+                       for k, v in edge.items() if k in edge_keys and v is not None)
+        yield f'    <edge source="{_xml_escape(edge["source"])}" target="{_xml_escape(edge["target"])}">{data}</edge>\n'
+    yield '  </graph>\n</graphml>\n'
+
 
 @app.get("/api/export/graphml")
-def export_graphml():
-    """导出图谱数据为GraphML格式（可用于Gephi等工具）"""
-    graph_data = get_graph()
-    graphml = '<?xml version="1.0" encoding="UTF-8"?>\n'
-    graphml += '<graphml xmlns="http://graphml.graphdrawing.org/xmlns">\n'
-    graphml += '  <key id="type" for="node" attr.name="type" attr.type="string"/>\n'
-    graphml += '  <key id="label" for="node" attr.name="label" attr.type="string"/>\n'
-    graphml += '  <key id="weight" for="edge" attr.name="weight" attr.type="double"/>\n'
-    graphml += '  <graph id="G" edgedefault="directed">\n'
-    for node in graph_data["nodes"]:
-        graphml += f'    <node id="{node["id"]}">\n'
-        graphml += f'      <data key="type">{node.get("type", "unknown")}</data>\n'
-        graphml += f'      <data key="label">{node.get("label", "")}</data>\n'
-        graphml += '    </node>\n'
-    for edge in graph_data["edges"]:
-        source = edge["source"] if isinstance(edge["source"], str) else edge["source"]["id"]
-        target = edge["target"] if isinstance(edge["target"], str) else edge["target"]["id"]
-        weight = edge.get("weight", 1.0)
-        graphml += f'    <edge source="{source}" target="{target}">\n'
-        graphml += f'      <data key="weight">{weight}</data>\n'
-        graphml += '    </edge>\n'
-    graphml += '  </graph>\n'
-    graphml += '</graphml>'
-    return Response(
-        content=graphml.encode("utf-8"),
+def export_graphml(layout: bool = False):
+    """导出图谱数据为GraphML格式（可用于Gephi等工具）。
+    流式输出，节点和边的全部属性都会导出（列表类属性编码为 JSON 字符串）；layout=true 时附带服务端布局坐标 x/y。"""
+    graph = graph_data(layout=layout)
+    return StreamingResponse(
+        _chunked(_graphml_lines(graph)),
         media_type="application/xml",
         headers={"Content-Disposition": "attachment; filename=archgraph.graphml"}
     )
@@ -1676,181 +3458,926 @@ class ImportData(BaseModel):
 def import_json(data: ImportData):
     """从JSON导入数据"""
     _record_history("import", {"merge_mode": data.merge_mode})
-    if data.merge_mode == "replace":
-        if data.cases is not None:
-            save_cases(data.cases)
-        if data.concepts is not None:
-            save_concepts(data.concepts)
-        if data.tags is not None:
-            save_tags(data.tags)
-        if data.nebulas is not None:
-            save_nebulas(data.nebulas)
-    else:  # append
-        if data.cases:
-            existing = load_cases()
-            existing_ids = {c["id"] for c in existing}
-            new_cases = [c for c in data.cases if c.get("id") not in existing_ids]
-            existing.extend(new_cases)
-            save_cases(existing)
-        if data.concepts:
-            existing = load_concepts()
-            existing_ids = {c["id"] for c in existing}
-            new_concepts = [c for c in data.concepts if c.get("id") not in existing_ids]
-            existing.extend(new_concepts)
-            save_concepts(existing)
-        if data.tags:
-            existing = load_tags()
-            existing.update(data.tags)
-            save_tags(existing)
-        if data.nebulas:
-            existing = load_nebulas()
-            existing_ids = {n["id"] for n in existing}
-            new_nebulas = [n for n in data.nebulas if n.get("id") not in existing_ids]
-            existing.extend(new_nebulas)
-            save_nebulas(existing)
+    with repo.batch():
+        if data.merge_mode == "replace":
+            if data.cases is not None:
+                save_cases(data.cases)
+            if data.concepts is not None:
+                save_concepts(data.concepts)
+            if data.tags is not None:
+                save_tags(data.tags)
+            if data.nebulas is not None:
+                save_nebulas(data.nebulas)
+        else:  # append
+            if data.cases:
+                repo.put_many("cases", [c for c in data.cases if not repo.exists("cases", c.get("id"))])
+            if data.concepts:
+                repo.put_many("concepts", [c for c in data.concepts if not repo.exists("concepts", c.get("id"))])
+            if data.tags:
+                repo.put_many("tags", [{**td, "id": tid} for tid, td in data.tags.items()])
+            if data.nebulas:
+                repo.put_many("nebulas", [n for n in data.nebulas if not repo.exists("nebulas", n.get("id"))])
     return {"ok": True, "message": "导入成功"}
 
+
+IMPORT_BATCH = 1000                    # 每批校验/写入的记录数，也是进度汇报的粒度
+IMPORT_MAX_ERRORS = 50                 # 最多返回多少条被跳过记录的错误明细
+IMPORT_SPOOL_MEMORY = 8 * 1024 * 1024  # 上传内容超过该大小后暂存到临时文件
+IMPORT_REQUIRED = {"cases": "name", "concepts": "name", "tags": "name", "nebulas": "name"}
+_JSON_SCALAR_END = re.compile(r"[,}\]]")
+IMPORT_LIST_FIELDS = ("tags", "keywords", "case_ids", "concept_ids", "parent_ids", "parent_details", "children")
+
+
+def _iter_ndjson_records(reader):
+    """逐行解析 NDJSON：每行 {"kind": 集合名, "data": 实体}，产出 (集合名, 实体, 出错信息)"""
+    for lineno, line in enumerate(reader, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            yield record["kind"], record["data"], None
+        except (ValueError, KeyError, TypeError) as e:
+            yield None, None, f"第 {lineno} 行无法解析: {e}"
+
+
+def _iter_json_records(reader, chunk_size: int = 1 << 16):
+    """流式解析导出格式的 JSON 文档 {"cases": [...], "tags": {id: {...}}, ...}，逐条产出 (集合名, 实体, None)。
+    缓冲区只保留尚未解析的部分，单条记录用 raw_decode 解析，数据不够时再读一块；其余顶层字段跳过。"""
+    decoder = json.JSONDecoder()
+    buf, pos, eof = "", 0, False
+
+    def fill() -> bool:
+        nonlocal buf, pos, eof
+        data = "" if eof else reader.read(chunk_size)
+        if not data:
+            eof = True
+            return False
+        buf, pos = buf[pos:] + data, 0
+        return True
+
+    def peek() -> str:
+        nonlocal pos
+        while True:
+            while pos < len(buf) and buf[pos] in " \t\r\n":
+                pos += 1
+            if pos < len(buf):
+                return buf[pos]
+            if not fill():
+                raise ValueError("JSON 在中途结束")
+
+    def expect(chars: str) -> str:
+        nonlocal pos
+        c = peek()
+        if c not in chars:
+            raise ValueError(f"JSON 格式错误：应为 {' 或 '.join(chars)}，实际为 {c!r}")
+        pos += 1
+        return c
+
+    def value():
+        nonlocal pos
+        if peek() not in '{["':
+            # 数字/字面量可能在块边界被截断，读到后面的分隔符为止
+            while not _JSON_SCALAR_END.search(buf, pos) and fill():
+                pass
+        while True:
+            try:
+                obj, pos = decoder.raw_decode(buf, pos)
+                return obj
+            except json.JSONDecodeError:
+                if not fill():
+                    raise
+
+    expect("{")
+    if peek() == "}":
+        return
+    while True:
+        key = value()
+        expect(":")
+        if key in EXPORT_COLLECTIONS and peek() in "[{":
+            closer = "]" if expect("[{") == "[" else "}"
+            if peek() == closer:
+                pos += 1
+            else:
+                while True:
+                    if closer == "}":
+                        tid = value()
+                        expect(":")
+                        item = value()
+                        yield key, ({**item, "id": tid} if isinstance(item, dict) else item), None
+                    else:
+                        yield key, value(), None
+                    if expect("," + closer) == closer:
+                        break
+        else:
+            value()
+        if expect(",}") == "}":
+            return
+
+
+def _validate_import(kind: Optional[str], item) -> Optional[str]:
+    """检查一条导入记录，返回错误信息；tags 缺少 id 时补上"""
+    if kind not in EXPORT_COLLECTIONS:
+        return f"未知的集合: {kind}"
+    if not isinstance(item, dict):
+        return f"{kind} 的记录不是对象"
+    if not isinstance(item.get(IMPORT_REQUIRED[kind]), str) or not item[IMPORT_REQUIRED[kind]].strip():
+        return f"{kind} 的记录 {item.get('id', '')} 缺少 {IMPORT_REQUIRED[kind]}"
+    for field in IMPORT_LIST_FIELDS:
+        if field in item and not isinstance(item[field], list):
+            return f"{kind} 的记录 {item.get('id', '')} 的 {field} 不是列表"
+    return None
+
+
+def _run_import(spool, fmt: str, mode: str, total_bytes: int, emit):
+    """在后台线程中解析、校验并写入上传的数据，通过 emit 汇报进度。
+    每解析 IMPORT_BATCH 条就校验并在一个 repo.batch() 中写入，内存里只有当前这一批，不会随上传大小增长；
+    各批都记在同一个 import 操作下，整次导入可以一次撤销。中途出错时已写入的批次保留，error 事件里带已导入的统计。
+    replace 模式记下上传中出现过的 id，全部写完后删除这些集合里其余的实体。"""
+    imported, skipped, removed, errors, parsed = Counter(), Counter(), Counter(), [], 0
+    try:
+        raw = spool
+        if spool.read(2) == b"\x1f\x8b":  # gzip 压缩的导出文件
+            spool.seek(0)
+            raw = gzip.GzipFile(fileobj=spool, mode="rb")
+        else:
+            spool.seek(0)
+        reader = io.TextIOWrapper(raw, encoding="utf-8-sig", newline="")
+        records = _iter_ndjson_records(reader) if fmt == "ndjson" else _iter_json_records(reader)
+        seen: dict[str, set] = {}  # replace 模式：集合 -> 上传中出现过的 id
+        _record_history("import", {"merge_mode": mode})
+        batch = list(itertools.islice(records, IMPORT_BATCH))
+        while batch:
+            valid: dict[str, list] = {}
+            for kind, item, error in batch:
+                error = error or _validate_import(kind, item)
+                if error:
+                    skipped[kind or "unknown"] += 1
+                    if len(errors) < IMPORT_MAX_ERRORS:
+                        errors.append(error)
+                    continue
+                valid.setdefault(kind, []).append(Repository._with_id(kind, item))
+            with repo.batch():
+                for kind, items in valid.items():
+                    if mode == "append" and kind != "tags":
+                        # 追加模式下已存在的案例/概念/星云保持不变，标签按 id 覆盖
+                        fresh = [it for it in items if not repo.exists(kind, it["id"])]
+                        skipped[kind] += len(items) - len(fresh)
+                        items = fresh
+                    elif mode == "replace":
+                        seen.setdefault(kind, set()).update(it["id"] for it in items)
+                    repo.put_many(kind, items)
+                    imported[kind] += len(items)
+            parsed += len(batch)
+            emit({"phase": "apply", "records": parsed, "imported": sum(imported.values()),
+                  "bytes": spool.tell(), "total_bytes": total_bytes})
+            batch = list(itertools.islice(records, IMPORT_BATCH))
+
+        for kind, ids in seen.items():
+            stale = [eid for eid in (repo.view(kind) if kind == "tags" else (it["id"] for it in repo.view(kind)))
+                     if eid not in ids]
+            for i in range(0, len(stale), IMPORT_BATCH):
+                with repo.batch():
+                    for eid in stale[i:i + IMPORT_BATCH]:
+                        repo.delete(kind, eid)
+            removed[kind] = len(stale)
+        emit({"phase": "done", "imported": dict(imported), "skipped": dict(skipped), "removed": dict(removed),
+              "errors": errors})
+    except Exception as e:
+        logger.exception("导入失败")
+        emit({"phase": "error", "detail": str(e), "imported": dict(imported)})
+    finally:
+        spool.close()
+
+
+@app.post("/api/import/stream")
+async def import_stream(request: Request, mode: str = "append", format: str | None = None):
+    """流式导入：请求体直接是文件内容（/api/export/json 导出的 JSON 文档，或 /api/export/ndjson 的 NDJSON，可以是 gzip 压缩的）。
+    上传内容先暂存，再在后台逐条解析，每批校验后立即写入（整次导入记为一个可撤销的操作）；
+    响应为 NDJSON 进度流：每批一条 apply（已解析条数、已写入条数、字节），最后是 done（导入/跳过/删除统计和错误明细）或 error（带已写入的统计）。
+    mode 与 /api/import/json 的 merge_mode 相同：append 只添加不存在的记录，replace 用上传的内容替换出现的集合。"""
+    if mode not in ("append", "replace"):
+        raise HTTPException(400, "mode 只支持 append 或 replace")
+    if format is None:
+        format = "ndjson" if "ndjson" in request.headers.get("content-type", "") else "json"
+    if format not in ("json", "ndjson"):
+        raise HTTPException(400, "format 只支持 json 或 ndjson")
+    spool = tempfile.SpooledTemporaryFile(max_size=IMPORT_SPOOL_MEMORY)
+    try:
+        # 超过 IMPORT_SPOOL_MEMORY 后写的是磁盘文件，放到线程池里写，不阻塞事件循环
+        async for chunk in request.stream():
+            await asyncio.to_thread(spool.write, chunk)
+    except BaseException:
+        spool.close()
+        raise
+    total_bytes = spool.tell()
+    spool.seek(0)
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    threading.Thread(target=_run_import, args=(spool, format, mode, total_bytes,
+                                               lambda event: loop.call_soon_threadsafe(queue.put_nowait, event)),
+                     name="bulk-import", daemon=True).start()
+
+    async def events():
+        while True:
+            event = await queue.get()
+            yield json.dumps(event, ensure_ascii=False) + "\n"
+            if event["phase"] in ("done", "error"):
+                return
+
+    return StreamingResponse(events(), media_type="application/x-ndjson")
+
 # —— Version History & Snapshots ——
-def _load_history():
-    if HISTORY_FILE.exists():
-        with open(HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    return {"actions": [], "undo_stack": [], "redo_stack": []}
+HISTORY_LIMIT = 100     # 最多保留多少个操作
+HISTORY_UNDO_LIMIT = 50  # 撤销栈最大深度
+# 历史文件的落盘策略：batch 每写一批 fsync 一次；interval 最多每 HISTORY_FSYNC_INTERVAL 秒 fsync 一次；never 交给操作系统
+HISTORY_FSYNC = os.getenv("HISTORY_FSYNC", "batch").lower()
+HISTORY_FSYNC_INTERVAL = float(os.getenv("HISTORY_FSYNC_INTERVAL", "1.0"))
+if HISTORY_FSYNC not in ("batch", "interval", "never"):
+    raise RuntimeError(f"未知的 HISTORY_FSYNC: {HISTORY_FSYNC}")
+_history_action: contextvars.ContextVar[Optional[dict]] = contextvars.ContextVar("history_action", default=None)
+
+
+class History:
+    """增量式操作历史（撤销/重做）。
+
+    每个操作只记录它改动过的实体的前后状态 [集合, id, 修改前, 修改后]（新增时修改前为 None，删除时修改后为 None），
+    撤销时写回修改前的状态，重做时写回修改后的状态。
+    历史文件是追加式的 JSON Lines：do 记录一次操作的补丁，undo / redo 记录对某个操作的撤销和重做，
+    每次写入只追加这一条，成本与改动大小相当。启动时重放文件恢复撤销栈和重做栈；
+    记录数超过 HISTORY_LIMIT 的两倍后整体重写一次，只保留最近的操作。
+
+    写请求只同步更新内存中的栈并把记录放进队列，序列化和写盘由后台线程完成：
+    每次醒来把队列里积攒的记录一次写出，再按 HISTORY_FSYNC 决定是否 fsync，请求不必等待历史落盘。
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._actions: Optional["OrderedDict[str, dict]"] = None
+        self._undo: list[str] = []
+        self._redo: list[str] = []
+        self._records = 0
+        self._fh = None
+        self._pending: deque = deque()  # 待写入的记录
+        self._rewrite_due = False
+        self._io_lock = threading.Lock()  # 写线程与 flush() 互斥
+        self._wake = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+        self._unsynced = False
+        self._last_sync = 0.0
+
+    # —— 加载 ——
+    def _ensure_loaded(self):
+        if self._actions is None:
+            self._load()
+
+    def load(self):
+        """启动时预先加载，第一次写请求不必等待重放"""
+        with self._lock:
+            self._ensure_loaded()
+
+    def _load(self):
+        self._actions, self._undo, self._redo, self._records = OrderedDict(), [], [], 0
+        if LEGACY_HISTORY_FILE.exists():
+            # 旧版的全量快照无法作为补丁重放，改名保留，不删除用户数据
+            backup = LEGACY_HISTORY_FILE.with_name(LEGACY_HISTORY_FILE.name + ".bak")
+            if backup.exists():
+                backup = backup.with_name(f"{backup.name}.{datetime.now():%Y%m%d%H%M%S}")
+            os.replace(LEGACY_HISTORY_FILE, backup)
+            logger.warning("旧版全量快照式的历史文件 %s 已不再使用，已改名为 %s", LEGACY_HISTORY_FILE, backup)
+        if not self.path.exists():
+            return
+        valid_end = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                try:
+                    record = _decode(line)
+                except ValueError:
+                    break
+                valid_end += len(line)
+                self._replay(record)
+        if valid_end < self.path.stat().st_size:
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_end)
+
+    def _replay(self, record: dict):
+        self._records += 1
+        op, aid = record["op"], record.get("id")
+        if op == "do":
+            entry = self._actions.get(aid)
+            if entry is None:
+                self._actions[aid] = {"id": aid, "type": record["type"], "data": record["data"],
+                                      "timestamp": record["timestamp"], "changes": list(record["changes"])}
+                self._undo.append(aid)
+                for abandoned in self._redo:  # 新操作之后被撤销的分支再也无法重做
+                    self._actions.pop(abandoned, None)
+                self._redo.clear()
+                self._trim()
+            else:
+                entry["changes"].extend(record["changes"])
+        elif op == "undo" and self._undo and self._undo[-1] == aid:
+            self._redo.append(self._undo.pop())
+        elif op == "redo" and self._redo and self._redo[-1] == aid:
+            self._undo.append(self._redo.pop())
+        elif op == "state":
+            self._undo = [a for a in record["undo"] if a in self._actions]
+            self._redo = [a for a in record["redo"] if a in self._actions]
+
+    # —— 记录 ——
+    def capture(self, changes: list):
+        """仓库提交写入时调用：当前请求标记了操作（_record_history）时，把这批改动作为该操作的补丁追加到历史。
+        同一批内多次修改同一实体只保留最初的修改前和最终的修改后。调用方持有仓库锁。"""
+        action = _history_action.get()
+        if action is None:
+            return
+        merged: dict[tuple, list] = {}
+        for kind, eid, before, after in changes:
+            if (kind, eid) in merged:
+                merged[(kind, eid)][3] = after
+            else:
+                merged[(kind, eid)] = [kind, eid, before, after]
+        patch = [change for change in merged.values() if change[2] != change[3]]
+        if not patch:
+            return
+        record = {"op": "do", "id": action["id"], "type": action["type"], "data": action["data"],
+                  "timestamp": action["timestamp"], "changes": patch}
+        with self._lock:
+            self._ensure_loaded()
+            self._replay(record)
+            self._append(record)
+
+    def _trim(self):
+        del self._undo[:-HISTORY_UNDO_LIMIT]
+        while len(self._actions) > HISTORY_LIMIT:
+            aid, _ = self._actions.popitem(last=False)
+            for stack in (self._undo, self._redo):
+                if aid in stack:
+                    stack.remove(aid)
+
+    # —— 写盘 ——
+    def _append(self, record: dict):
+        """把记录交给写线程（调用方持有 self._lock）。记录数过多时改为整体重写，排队中的记录已包含在内存状态里。"""
+        if self._records > 2 * HISTORY_LIMIT:
+            self._rewrite_due = True
+        else:
+            self._pending.append(record)
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._writer, name="history-writer", daemon=True)
+            self._thread.start()
+        self._wake.set()
+
+    def _writer(self):
+        while True:
+            # interval 模式下还有没 fsync 的数据时，到点后即使没有新记录也醒来补一次
+            timeout = HISTORY_FSYNC_INTERVAL if self._unsynced else None
+            self._wake.wait(timeout)
+            self._wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("写入操作历史失败")
+
+    def flush(self):
+        """把排队的记录写入历史文件（写线程调用；关闭时也会同步调用一次）"""
+        with self._io_lock:
+            with self._lock:
+                rewrite, self._rewrite_due = self._rewrite_due, False
+                if rewrite:
+                    records = [{"op": "do", **entry, "changes": list(entry["changes"])} for entry in self._actions.values()]
+                    records.append({"op": "state", "undo": list(self._undo), "redo": list(self._redo)})
+                    self._records = len(records)
+                else:
+                    records = list(self._pending)
+                self._pending.clear()
+            if rewrite:
+                if self._fh is not None:
+                    self._fh.close()
+                    self._fh = None
+                _atomic_write(self.path, b"".join(_encode(r, "compact") + b"\n" for r in records))
+                self._unsynced = False
+            elif records:
+                if self._fh is None:
+                    self._fh = open(self.path, "ab")
+                self._fh.write(b"".join(_encode(r, "compact") + b"\n" for r in records))
+                self._fh.flush()
+                self._unsynced = HISTORY_FSYNC != "never"  # never 模式不补 fsync，写线程也就不必定时醒来
+            if self._unsynced and (
+                    HISTORY_FSYNC == "batch" or time.monotonic() - self._last_sync >= HISTORY_FSYNC_INTERVAL):
+                os.fsync(self._fh.fileno())
+                self._unsynced, self._last_sync = False, time.monotonic()
+
+    # —— 撤销 / 重做 ——
+    def undo(self) -> bool:
+        return self._move("undo")
+
+    def redo(self) -> bool:
+        return self._move("redo")
+
+    def _move(self, op: str) -> bool:
+        """撤销：倒序写回修改前的状态；重做：顺序写回修改后的状态。先取仓库锁再取历史锁，与 capture 的顺序一致。
+        写入提交成功后才移动撤销/重做栈并记录，落盘失败时仓库回滚，栈保持原样。"""
+        with repo.lock:
+            with repo.batch(), self._lock:
+                self._ensure_loaded()
+                source = self._undo if op == "undo" else self._redo
+                if not source:
+                    return False
+                aid = source[-1]
+                changes = self._actions[aid]["changes"]
+                for kind, eid, before, after in (reversed(changes) if op == "undo" else changes):
+                    state = before if op == "undo" else after
+                    if state is None:
+                        repo.delete(kind, eid)
+                    else:
+                        repo.put(kind, state)
+            with self._lock:
+                source, target = (self._undo, self._redo) if op == "undo" else (self._redo, self._undo)
+                target.append(source.pop())
+                self._records += 1
+                self._append({"op": op, "id": aid})
+        return True
+
+    def overrides(self, aid: str) -> Optional[dict]:
+        """该操作刚完成时的数据与当前数据的差别：(集合, id) -> 当时的实体（None 表示当时不存在）。
+        它之后仍生效的操作倒序取修改前的状态；它自己已被撤销时，从最早被撤销的操作顺序重做到它。
+        只反映历史中记录了的写入。调用方持有仓库锁。"""
+        with self._lock:
+            self._ensure_loaded()
+            if aid not in self._actions:
+                return None
+            order, undone, result = list(self._actions), set(self._redo), {}
+            i = order.index(aid)
+            if aid in undone:
+                for a in order[:i + 1]:
+                    if a in undone:
+                        for kind, eid, _, after in self._actions[a]["changes"]:
+                            result[(kind, eid)] = after
+            else:
+                for a in reversed(order[i + 1:]):
+                    if a not in undone:
+                        for kind, eid, before, _ in reversed(self._actions[a]["changes"]):
+                            result[(kind, eid)] = before
+            return result
+
+    def actions(self) -> list[dict]:
+        """最近的操作（不含补丁内容），新的在前"""
+        with self._lock:
+            self._ensure_loaded()
+            undone = set(self._redo)
+            return [{"id": e["id"], "type": e["type"], "data": e["data"], "timestamp": e["timestamp"],
+                     "changes": len(e["changes"]), "undone": e["id"] in undone}
+                    for e in reversed(self._actions.values())]
+
+
+history = History(HISTORY_FILE)
 
-def _save_history(history):
-    with open(HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
 
 def _record_history(action_type: str, data: dict):
-    """记录操作历史"""
-    history = _load_history()
-    snapshot = {
-        "cases": load_cases(),
-        "concepts": load_concepts(),
-        "tags": load_tags(),
-        "nebulas": load_nebulas()
-    }
-    history["actions"].append({
-        "type": action_type,
-        "data": data,
-        "timestamp": str(uuid.uuid4()),
-        "snapshot": snapshot
-    })
-    history["undo_stack"].append(snapshot)
-    history["redo_stack"] = []  # 清空重做栈
-    if len(history["actions"]) > 100:  # 限制历史记录数量
-        history["actions"] = history["actions"][-100:]
-    if len(history["undo_stack"]) > 50:  # 限制撤销栈大小
-        history["undo_stack"] = history["undo_stack"][-50:]
-    _save_history(history)
+    """标记当前请求正在执行的操作：此后本次请求提交的写入会作为该操作的补丁记入历史"""
+    _history_action.set({"id": uuid.uuid4().hex[:12], "type": action_type, "data": data,
+                         "timestamp": datetime.now().isoformat(timespec="seconds")})
+
+@app.get("/api/history")
+def get_history():
+    """最近的操作记录"""
+    return {"actions": history.actions()}
 
 @app.post("/api/history/undo")
 def undo():
-    """撤销操作"""
-    history = _load_history()
-    if not history["undo_stack"]:
+    """撤销操作：把最近一次操作改动过的实体恢复为修改前的状态"""
+    if not history.undo():
         raise HTTPException(400, "没有可撤销的操作")
-    current_snapshot = {
-        "cases": load_cases(),
-        "concepts": load_concepts(),
-        "tags": load_tags(),
-        "nebulas": load_nebulas()
-    }
-    history["redo_stack"].append(current_snapshot)
-    prev_snapshot = history["undo_stack"].pop()
-    save_cases(prev_snapshot["cases"])
-    save_concepts(prev_snapshot["concepts"])
-    save_tags(prev_snapshot["tags"])
-    save_nebulas(prev_snapshot["nebulas"])
-    _save_history(history)
     return {"ok": True}
 
 @app.post("/api/history/redo")
 def redo():
     """重做操作"""
-    history = _load_history()
-    if not history["redo_stack"]:
+    if not history.redo():
         raise HTTPException(400, "没有可重做的操作")
-    current_snapshot = {
-        "cases": load_cases(),
-        "concepts": load_concepts(),
-        "tags": load_tags(),
-        "nebulas": load_nebulas()
-    }
-    history["undo_stack"].append(current_snapshot)
-    next_snapshot = history["redo_stack"].pop()
-    save_cases(next_snapshot["cases"])
-    save_concepts(next_snapshot["concepts"])
-    save_tags(next_snapshot["tags"])
-    save_nebulas(next_snapshot["nebulas"])
-    _save_history(history)
     return {"ok": True}
 
 class SnapshotCreate(BaseModel):
     name: Optional[str] = None
 
+# 快照以内容寻址的方式存储：实体按 id 切成数据块，每块压缩后以其成员 (id, 实体哈希) 的哈希为键存进 blobs/，
+# 快照文件只是各集合的块键列表（清单）。没变的块在多个快照之间共享，新快照只写入变化了的块。
+SNAPSHOT_BLOBS_DIR = SNAPSHOTS_DIR / "blobs"
+SNAPSHOT_CHUNK = 64  # 平均每块的实体数
+SNAPSHOT_INDEX = SNAPSHOTS_DIR / "index.json"  # 快照索引：每个快照一条小记录，列表不必解析快照文件
+SNAPSHOT_PAGE_LIMIT = 500
+_snapshot_lock = threading.Lock()
+_entity_hashes: dict[tuple[str, str], tuple[dict, str]] = {}  # (集合, id) -> (实体对象, 哈希)
+_snapshot_index: Optional[dict[str, dict]] = None  # id -> 索引条目，按创建顺序
+
+
+def _canonical(obj) -> bytes:
+    """键排序的紧凑 JSON，相同内容总是得到相同的字节"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(obj, ensure_ascii=False, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def _content_hash(item: dict) -> str:
+    return hashlib.sha256(_canonical(item)).hexdigest()[:32]
+
+
+def _entity_hash(kind: str, item: dict) -> str:
+    """仓库中实体的内容哈希。存储中的实体对象从不原地修改，对象没换就直接用上次算好的值"""
+    key = (kind, item["id"])
+    cached = _entity_hashes.get(key)
+    if cached is not None and cached[0] is item:
+        return cached[1]
+    digest = _content_hash(item)
+    _entity_hashes[key] = (item, digest)
+    return digest
+
+
+def _snapshot_chunks(kind: str, items, hasher=_entity_hash):
+    """按实体 id 决定块边界（内容定义分块）：插入或删除实体只影响它所在的块，其余块的键不变。
+    产出 (块键, [(id, 实体哈希, 实体), ...])"""
+    chunk = []
+    for item in items:
+        chunk.append((item["id"], hasher(kind, item), item))
+        if zlib.crc32(item["id"].encode("utf-8")) % SNAPSHOT_CHUNK == 0 or len(chunk) >= 4 * SNAPSHOT_CHUNK:
+            yield _chunk_key(chunk), chunk
+            chunk = []
+    if chunk:
+        yield _chunk_key(chunk), chunk
+
+
+def _chunk_key(chunk: list) -> str:
+    return hashlib.sha256("\n".join(f"{eid}\t{digest}" for eid, digest, _ in chunk).encode("utf-8")).hexdigest()[:32]
+
+
+def _blob_path(key: str) -> Path:
+    return SNAPSHOT_BLOBS_DIR / key[:2] / key
+
+
+def _write_blob(key: str, chunk: list) -> int:
+    """块不存在时写入，返回新写入的字节数（已存在则为 0）"""
+    path = _blob_path(key)
+    if path.exists():
+        return 0
+    path.parent.mkdir(parents=True, exist_ok=True)
+    data = zlib.compress(_encode([list(entry) for entry in chunk], "compact"))
+    _atomic_write(path, data)
+    return len(data)
+
+
+def _fsync_dir(path: Path):
+    """让目录里新建、改名的文件项落盘（Windows 不支持对目录 fsync，跳过）"""
+    if os.name == "nt":
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read_blob(key: str) -> list:
+    """读出一个块：[[id, 实体哈希, 实体], ...]"""
+    try:
+        return _decode(zlib.decompress(_blob_path(key).read_bytes()))
+    except FileNotFoundError:
+        raise HTTPException(500, f"快照数据块 {key} 缺失")
+
+
+def _snapshot_manifests(strict: bool = False):
+    """遍历所有快照文件，产出 (文件, 内容)；读不出的文件跳过，strict=True 时抛出异常"""
+    for f in SNAPSHOTS_DIR.glob("snapshot_*.*"):
+        if f.suffix not in (".json", ".msgpack"):
+            continue
+        try:
+            data = _decode(f.read_bytes(), f.suffix)
+        except Exception:
+            if strict:
+                raise
+            logger.warning("无法读取快照文件 %s", f)
+            continue
+        yield f, data
+
+
+def _gc_snapshot_blobs() -> int:
+    """删除不再被任何快照引用的块，返回删除的个数（调用方持有 _snapshot_lock）。
+    有快照文件读不出时不回收，以免删掉它引用的块。"""
+    live = set()
+    try:
+        for f, data in _snapshot_manifests(strict=True):
+            for keys in data.get("collections", {}).values():
+                live.update(keys)
+    except Exception:
+        logger.exception("有快照文件无法读取，跳过数据块回收")
+        return 0
+    removed = 0
+    for path in SNAPSHOT_BLOBS_DIR.glob("*/*"):
+        if path.name not in live:
+            path.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
+def _snapshot_files() -> dict[str, Path]:
+    return {f.stem: f for f in SNAPSHOTS_DIR.glob("snapshot_*.*") if f.suffix in (".json", ".msgpack")}
+
+
+def _snapshot_entry(f: Path, data: dict) -> dict:
+    """从快照文件生成索引条目（重建索引或发现索引里没有的快照文件时才需要解析快照）"""
+    stat = f.stat()
+    if "collections" in data:
+        timestamp, counts = data.get("timestamp", ""), data.get("counts", {})
+    else:  # 旧版快照的 timestamp 是随机 uuid，改用文件修改时间
+        timestamp = datetime.fromtimestamp(stat.st_mtime).isoformat(timespec="seconds")
+        counts = {kind: len(data.get(kind) or []) for kind in COLLECTION_FILES}
+    return {"id": data.get("id") or f.stem, "name": data.get("name", "未命名快照"),
+            "timestamp": timestamp, "size": stat.st_size, "counts": counts}
+
+
+def _snapshot_index_entries() -> dict[str, dict]:
+    """加载快照索引，并与目录里的快照文件对照：去掉已不存在的，补上索引里没有的（如升级前的旧快照）。
+    对照只需列目录，不解析快照文件。调用方持有 _snapshot_lock。"""
+    global _snapshot_index
+    if _snapshot_index is None:
+        _snapshot_index = {e["id"]: e for e in _read_document(SNAPSHOT_INDEX, [])}
+    files = _snapshot_files()
+    stale = [sid for sid in _snapshot_index if sid not in files]
+    missing = [f for sid, f in files.items() if sid not in _snapshot_index]
+    for sid in stale:
+        del _snapshot_index[sid]
+    entries = []
+    for f in missing:
+        try:
+            entries.append(_snapshot_entry(f, _decode(f.read_bytes(), f.suffix)))
+        except Exception:
+            logger.warning("无法读取快照文件 %s", f)
+    for entry in sorted(entries, key=lambda e: e["timestamp"]):
+        _snapshot_index[entry["id"]] = entry
+    if stale or entries:
+        _write_document(SNAPSHOT_INDEX, list(_snapshot_index.values()))
+    return _snapshot_index
+
+
 @app.post("/api/snapshots")
 def create_snapshot(data: SnapshotCreate):
-    """创建快照"""
+    """创建快照：只写入上次以来变化了的数据块，其余块与已有快照共享"""
     snapshot_id = f"snapshot_{uuid.uuid4().hex[:8]}"
     snapshot_name = data.name or f"快照_{snapshot_id[-6:]}"
-    snapshot_data = {
-        "id": snapshot_id,
-        "name": snapshot_name,
-        "timestamp": str(uuid.uuid4()),
-        "cases": load_cases(),
-        "concepts": load_concepts(),
-        "tags": load_tags(),
-        "nebulas": load_nebulas()
-    }
-    snapshot_file = SNAPSHOTS_DIR / f"{snapshot_id}.json"
-    with open(snapshot_file, "w", encoding="utf-8") as f:
-        json.dump(snapshot_data, f, ensure_ascii=False, indent=2)
-    return {"ok": True, "snapshot_id": snapshot_id}
+    with _snapshot_lock:
+        with repo.lock:
+            views = {kind: list(repo.view(kind).values()) if kind == "tags" else repo.view(kind)
+                     for kind in COLLECTION_FILES}
+        collections, written, current, dirs = {}, 0, set(), set()
+        for kind, items in views.items():
+            collections[kind] = []
+            for key, chunk in _snapshot_chunks(kind, items):
+                size = _write_blob(key, chunk)
+                if size:
+                    written += size
+                    dirs.add(_blob_path(key).parent)
+                collections[kind].append(key)
+            current.update((kind, item["id"]) for item in items)
+        for key in [k for k in _entity_hashes if k not in current]:
+            del _entity_hashes[key]
+        if dirs:  # 块文件写入时已 fsync，再让它们的目录项落盘，之后才写引用它们的清单
+            for d in dirs | {SNAPSHOT_BLOBS_DIR}:
+                _fsync_dir(d)
+        index = _snapshot_index_entries()
+        manifest = {
+            "id": snapshot_id,
+            "name": snapshot_name,
+            "timestamp": datetime.now().isoformat(timespec="seconds"),
+            "counts": {kind: len(items) for kind, items in views.items()},
+            "collections": collections,
+        }
+        path = SNAPSHOTS_DIR / f"{snapshot_id}.json"
+        _write_document(path, manifest)
+        entry = _snapshot_entry(_document_candidates(path)[0], manifest)
+        entry["size"] += written  # 清单加上本次新写入的块，即这个快照实际占用的空间
+        index[snapshot_id] = entry
+        _write_document(SNAPSHOT_INDEX, list(index.values()))
+    return {"ok": True, "snapshot_id": snapshot_id, "bytes_written": written}
 
 @app.get("/api/snapshots")
-def list_snapshots():
-    """列出所有快照"""
-    snapshots = []
-    for f in SNAPSHOTS_DIR.glob("snapshot_*.json"):
-        try:
-            with open(f, "r", encoding="utf-8") as file:
-                data = json.load(file)
-                snapshots.append({
-                    "id": data.get("id"),
-                    "name": data.get("name", "未命名快照"),
-                    "timestamp": data.get("timestamp", "")
-                })
-        except:
-            continue
-    snapshots.sort(key=lambda x: x["timestamp"], reverse=True)
-    return {"snapshots": snapshots}
+def list_snapshots(offset: int = 0, limit: int = 50):
+    """列出快照（新的在前），分页返回索引中的小记录：名称、创建时间、占用空间（清单 + 新写入的块）和各集合实体数"""
+    if offset < 0:
+        raise HTTPException(400, "offset 不能为负数")
+    if not 1 <= limit <= SNAPSHOT_PAGE_LIMIT:
+        raise HTTPException(400, f"limit 须在 1 到 {SNAPSHOT_PAGE_LIMIT} 之间")
+    with _snapshot_lock:
+        entries = list(_snapshot_index_entries().values())
+    # 索引按创建顺序排列，同一秒内创建的快照靠它区分先后
+    entries = sorted(reversed(entries), key=lambda e: e["timestamp"], reverse=True)
+    return {"snapshots": entries[offset:offset + limit], "total": len(entries), "offset": offset, "limit": limit}
 
 @app.post("/api/snapshots/{snapshot_id}/restore")
 def restore_snapshot(snapshot_id: str):
-    """恢复快照"""
-    snapshot_file = SNAPSHOTS_DIR / f"{snapshot_id}.json"
-    if not snapshot_file.exists():
+    """恢复快照：逐块读回实体（旧版快照文件直接包含完整数据）"""
+    data = _read_document(SNAPSHOTS_DIR / f"{snapshot_id}.json")
+    if data is None:
         raise HTTPException(404, "快照不存在")
-    with open(snapshot_file, "r", encoding="utf-8") as f:
-        data = json.load(f)
-    save_cases(data.get("cases", []))
-    save_concepts(data.get("concepts", []))
-    save_tags(data.get("tags", {}))
-    save_nebulas(data.get("nebulas", []))
+    if "collections" in data:
+        with _snapshot_lock:
+            collections = {kind: [item for key in keys for _, _, item in _read_blob(key)]
+                           for kind, keys in data["collections"].items()}
+        data = {**collections, "tags": {t["id"]: t for t in collections.get("tags", [])}}
+    with repo.batch():
+        save_cases(data.get("cases", []))
+        save_concepts(data.get("concepts", []))
+        save_tags(data.get("tags", {}))
+        save_nebulas(data.get("nebulas", []))
     return {"ok": True}
 
 @app.delete("/api/snapshots/{snapshot_id}")
 def delete_snapshot(snapshot_id: str):
-    """删除快照"""
-    snapshot_file = SNAPSHOTS_DIR / f"{snapshot_id}.json"
-    if snapshot_file.exists():
-        snapshot_file.unlink()
-    return {"ok": True}
+    """删除快照，并回收不再被任何快照引用的数据块"""
+    with _snapshot_lock:
+        for snapshot_file in _document_candidates(SNAPSHOTS_DIR / f"{snapshot_id}.json"):
+            snapshot_file.unlink(missing_ok=True)
+        _snapshot_index_entries()
+        removed = _gc_snapshot_blobs()
+    return {"ok": True, "blobs_removed": removed}
+
+# —— Version Diff ——
+def _live_version(ref: str) -> Optional[dict]:
+    """当前数据（current）或某个历史操作刚完成时的数据，表示为当前数据上的覆盖：(集合, id) -> 实体。调用方持有仓库锁。"""
+    return {} if ref == "current" else history.overrides(ref)
+
+
+def _live_items(kind: str, overrides: dict):
+    """当前集合套上覆盖后的实体"""
+    items = repo.view(kind)
+    for item in (items.values() if kind == "tags" else items):
+        item = overrides.get((kind, item["id"]), item)
+        if item is not None:
+            yield item
+    for (k, eid), item in overrides.items():
+        if k == kind and item is not None and not repo.exists(kind, eid):
+            yield item
+
+
+def _live_hash(kind: str, item: dict) -> str:
+    return _entity_hash(kind, item) if repo.peek(kind, item["id"]) is item else _content_hash(item)
+
+
+def _version_chunks(kind: str, version: dict) -> list:
+    """一个版本中某集合的数据块：[(块键, 读出块内容的函数)]。内容寻址的快照直接用清单里的块键，不读块。"""
+    if "collections" in version:
+        return [(key, partial(_read_blob, key)) for key in version["collections"].get(kind, [])]
+    if "overrides" in version:
+        chunks = _snapshot_chunks(kind, _live_items(kind, version["overrides"]), _live_hash)
+    else:  # 旧版快照：完整数据直接在快照文件里
+        items = version.get(kind) or ([] if kind != "tags" else {})
+        items = [{**t, "id": tid} for tid, t in items.items()] if kind == "tags" else items
+        chunks = _snapshot_chunks(kind, items, lambda _, item: _content_hash(item))
+    return [(key, lambda chunk=chunk: chunk) for key, chunk in chunks]
+
+
+def _diff_entries(chunks_a: list, chunks_b: list):
+    """两边都有的块（键相同则成员和内容都相同）直接跳过，只比较其余块里实体的哈希。
+    返回 (新增, 删除, [(修改前, 修改后)])"""
+    shared = {key for key, _ in chunks_a} & {key for key, _ in chunks_b}
+    side_a = {eid: (digest, item) for key, load in chunks_a if key not in shared for eid, digest, item in load()}
+    side_b = {eid: (digest, item) for key, load in chunks_b if key not in shared for eid, digest, item in load()}
+    added = [item for eid, (_, item) in side_b.items() if eid not in side_a]
+    removed = [item for eid, (_, item) in side_a.items() if eid not in side_b]
+    modified = [(item, side_b[eid][1]) for eid, (digest, item) in side_a.items()
+                if eid in side_b and side_b[eid][0] != digest]
+    return added, removed, modified
+
+
+def _diff_live(a: dict, b: dict) -> dict:
+    """两个都以当前数据为底的版本：只有覆盖到的实体可能不同"""
+    result = {kind: ([], [], []) for kind in COLLECTION_FILES}
+    for kind, eid in dict.fromkeys(itertools.chain(a, b)):
+        before = a[(kind, eid)] if (kind, eid) in a else repo.peek(kind, eid)
+        after = b[(kind, eid)] if (kind, eid) in b else repo.peek(kind, eid)
+        added, removed, modified = result[kind]
+        if before is None and after is not None:
+            added.append(after)
+        elif after is None and before is not None:
+            removed.append(before)
+        elif before is not after and before != after:
+            modified.append((before, after))
+    return result
+
+
+def _diff_brief(item: dict) -> dict:
+    return {"id": item["id"], "name": item.get("name")}
+
+
+@app.get("/api/diff")
+def diff_versions(base: str, target: str = "current", details: bool = False):
+    """比较两个版本之间新增、删除和修改了哪些案例、概念、标签和星云。
+    版本可以是 current（当前数据）、快照 id，或历史操作 id（/api/history 中的 id，表示该操作刚完成时的数据）。
+    快照之间按数据块比较，相同的块整块跳过，其余只比较实体哈希；历史版本只需比较各自补丁涉及的实体。
+    修改的实体列出变化的字段；details=true 时附带完整实体（修改的附带修改前后）。"""
+    live = not (base.startswith("snapshot_") and target.startswith("snapshot_"))
+    # 只比较快照时不需要仓库锁，读块期间不阻塞写入
+    with _snapshot_lock, (repo.lock if live else nullcontext()):
+        versions = []
+        for ref in (base, target):
+            if ref.startswith("snapshot_"):
+                version = _read_document(SNAPSHOTS_DIR / f"{ref}.json")
+            else:
+                overrides = _live_version(ref)
+                version = None if overrides is None else {"overrides": overrides}
+            if version is None:
+                raise HTTPException(404, "Version not found")
+            versions.append(version)
+        a, b = versions
+        if "overrides" in a and "overrides" in b:
+            entries = _diff_live(a["overrides"], b["overrides"])
+        else:
+            entries = {kind: _diff_entries(_version_chunks(kind, a), _version_chunks(kind, b)) for kind in COLLECTION_FILES}
+    collections, summary = {}, {}
+    for kind, (added, removed, modified) in entries.items():
+        collections[kind] = {
+            "added": added if details else [_diff_brief(item) for item in added],
+            "removed": removed if details else [_diff_brief(item) for item in removed],
+            "modified": [{**_diff_brief(after),
+                          "fields": sorted(k for k in before.keys() | after.keys() if before.get(k) != after.get(k)),
+                          **({"before": before, "after": after} if details else {})} for before, after in modified],
+        }
+        summary[kind] = {"added": len(added), "removed": len(removed), "modified": len(modified)}
+    return {"base": base, "target": target, "summary": summary, "collections": collections}
+
 
 # —— Serve frontend ——
-app.mount("/static", StaticFiles(directory="static"), name="static")
+STATIC_DIR = Path("static")
+STATIC_PRECOMPRESS = {".html", ".js", ".mjs", ".css", ".json", ".svg", ".txt", ".map"}  # 预压缩的前端资源类型
+_static_assets: dict[str, dict] = {}
+_static_lock = threading.Lock()
+
+
+def _static_asset(rel: str) -> Optional[dict]:
+    """预压缩的前端资源：各编码的最高级别压缩版本和按内容哈希生成的强 ETag。
+    文件的大小或修改时间变化后重新压缩，开发时改完 index.html 刷新即可生效。"""
+    path = (STATIC_DIR / rel).resolve()
+    if STATIC_DIR.resolve() not in path.parents:  # 拒绝 ../ 等越出 static 目录的路径
+        return None
+    if path.suffix.lower() not in STATIC_PRECOMPRESS or UPLOAD_DIR.resolve() in path.parents:
+        return None
+    try:
+        stat = path.stat()
+    except OSError:
+        return None
+    key = (stat.st_size, stat.st_mtime_ns)
+    asset = _static_assets.get(rel)
+    if asset is not None and asset["key"] == key:
+        return asset
+    with _static_lock:
+        data = path.read_bytes()
+        variants = {"identity": data}
+        for enc in COMPRESS_ENCODINGS:
+            compressed = _compress(data, enc, best=True)
+            if len(compressed) < len(data):
+                variants[enc] = compressed
+        asset = {"key": key, "etag": hashlib.sha256(data).hexdigest()[:32], "variants": variants,
+                 "media_type": mimetypes.guess_type(path.name)[0] or "application/octet-stream"}
+        _static_assets[rel] = asset
+    return asset
+
+
+def _precompress_static():
+    """启动时预先压缩所有前端资源（上传目录除外）"""
+    for path in STATIC_DIR.rglob("*"):
+        if path.is_file():
+            _static_asset(path.relative_to(STATIC_DIR).as_posix())
+
+
+def _static_response(headers: Headers, rel: str) -> Optional[Response]:
+    """返回协商好编码的预压缩资源；每种编码的 ETag 不同，If-None-Match 命中时返回 304"""
+    asset = _static_asset(rel)
+    if asset is None:
+        return None
+    encoding = _negotiate_encoding(headers.get("accept-encoding", ""))
+    if encoding not in asset["variants"]:
+        encoding = "identity"
+    etag = f'"{asset["etag"]}"' if encoding == "identity" else f'"{asset["etag"]}-{encoding}"'
+    response_headers = {"ETag": etag, "Vary": "Accept-Encoding", "Cache-Control": "no-cache"}
+    if encoding != "identity":
+        response_headers["Content-Encoding"] = encoding
+    if_none_match = headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or
+                          etag in (t.strip().removeprefix("W/") for t in if_none_match.split(","))):
+        return Response(status_code=304, headers=response_headers)
+    return Response(asset["variants"][encoding], media_type=asset["media_type"], headers=response_headers)
+
+
+class PrecompressedStaticFiles(StaticFiles):
+    """前端资源直接返回内存中的预压缩版本，上传的图片等其余文件交给 StaticFiles"""
+
+    async def get_response(self, path: str, scope):
+        if scope["method"] in ("GET", "HEAD"):
+            response = _static_response(Headers(scope=scope), Path(path).as_posix())
+            if response is not None:
+                return response
+        return await super().get_response(path, scope)
+
+
+app.mount("/static", PrecompressedStaticFiles(directory="static"), name="static")
 
 @app.get("/")
-def index():
-    return FileResponse("static/index.html")
\ No newline at end of file
+def index(request: Request):
+    return _static_response(request.headers, "index.html") or FileResponse("static/index.html")
\ No newline at end of file
@@ -0,0 +1,60 @@
+"""
+存储格式基准：对比 json / compact / msgpack 三种 STORAGE_FORMAT 的保存与加载耗时。
+
+用法: python bench_storage.py [案例数量，默认 20000]
+"""
+import os, sys, time, uuid, random, shutil, atexit, tempfile
+from pathlib import Path
+
+# app 的数据文件都相对于当前工作目录，导入时就会建目录、读配置；先切到临时目录，不碰真实数据
+BENCH_DIR = tempfile.mkdtemp(prefix="archgraph-bench-")
+atexit.register(shutil.rmtree, BENCH_DIR, ignore_errors=True)
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+os.chdir(BENCH_DIR)
+
+from app import _encode, _decode, _atomic_write, FORMAT_SUFFIXES, orjson, msgpack
+
+WORDS = ["混凝土", "光影", "庭院", "折叠", "悬挑", "在地材料", "参数化", "社区", "滨水", "更新", "木构", "极简"]
+
+
+def make_cases(n: int) -> list[dict]:
+    rnd = random.Random(42)
+    return [{
+        "id": f"case_{uuid.UUID(int=rnd.getrandbits(128)).hex[:8]}",
+        "name": f"案例 {i}",
+        "architect": rnd.choice(["安藤忠雄", "隈研吾", "OMA", "BIG", "Herzog & de Meuron"]),
+        "year": str(rnd.randint(1950, 2025)),
+        "location": rnd.choice(["东京", "上海", "哥本哈根", "巴塞尔", "鹿特丹"]),
+        "tags": rnd.sample(WORDS, 5),
+        "description": "".join(rnd.choices(WORDS, k=60)),
+        "image_url": f"/static/uploads/{i}.jpg",
+        "source_url": f"https://www.archdaily.com/{i}",
+    } for i in range(n)]
+
+
+def bench(fmt: str, cases: list[dict], path: Path, repeat: int = 3) -> tuple[float, float, int]:
+    save, load = float("inf"), float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        _atomic_write(path, _encode(cases, fmt))
+        t1 = time.perf_counter()
+        assert len(_decode(path.read_bytes(), path.suffix)) == len(cases)
+        t2 = time.perf_counter()
+        save, load = min(save, t1 - t0), min(load, t2 - t1)
+    return save, load, path.stat().st_size
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    cases = make_cases(n)
+    formats = ["json", "compact"] + (["msgpack"] if msgpack is not None else [])
+    print(f"{n} 个案例，orjson={'有' if orjson else '无'}，msgpack={'有' if msgpack else '无'}")
+    print(f"{'格式':<10}{'保存(ms)':>12}{'加载(ms)':>12}{'大小(KB)':>12}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for fmt in formats:
+            save, load, size = bench(fmt, cases, Path(tmp) / f"data{FORMAT_SUFFIXES[fmt]}")
+            print(f"{fmt:<10}{save * 1000:>12.1f}{load * 1000:>12.1f}{size / 1024:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,37 @@
+"""
+测试夹具：在临时目录里启动应用。
+
+app.py 的数据文件（data.json、snapshots/、history.jsonl 等）都相对于当前工作目录，
+所以先把前端资源和种子数据复制到临时目录、切换过去，再导入 app。
+整个测试会话共用一个应用实例，各测试自己创建所需的数据，不依赖执行顺序。
+"""
+import os
+import shutil
+import sys
+from pathlib import Path
+
+import pytest
+
+ROOT = Path(__file__).resolve().parent.parent
+
+
+@pytest.fixture(scope="session")
+def app_module(tmp_path_factory):
+    data_dir = tmp_path_factory.mktemp("data")
+    shutil.copytree(ROOT / "static", data_dir / "static", ignore=shutil.ignore_patterns("uploads"))
+    shutil.copy(ROOT / "seed_data.json", data_dir / "seed_data.json")
+    cwd = os.getcwd()
+    os.chdir(data_dir)
+    sys.path.insert(0, str(ROOT))
+    try:
+        import app
+        yield app
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.fixture(scope="session")
+def client(app_module):
+    from fastapi.testclient import TestClient
+    with TestClient(app_module.app) as c:
+        yield c
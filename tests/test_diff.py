@@ -0,0 +1,36 @@
+def _ids(section: dict, change: str) -> set[str]:
+    return {item["id"] for item in section[change]}
+
+
+def test_diff_between_snapshots_history_and_current(client):
+    keep = client.post("/api/cases", json={"name": "保持"}).json()
+    edit = client.post("/api/cases", json={"name": "修改前", "year": "1990"}).json()
+    gone = client.post("/api/cases", json={"name": "将删除"}).json()
+    base = client.post("/api/snapshots", json={"name": "比较基准"}).json()["snapshot_id"]
+
+    client.put(f"/api/cases/{edit['id']}", json={"name": "修改后"})
+    action_id = client.get("/api/history").json()["actions"][0]["id"]
+    client.delete(f"/api/cases/{gone['id']}")
+    new = client.post("/api/cases", json={"name": "新增"}).json()
+    target = client.post("/api/snapshots", json={"name": "比较目标"}).json()["snapshot_id"]
+
+    for ref in (target, "current"):
+        r = client.get("/api/diff", params={"base": base, "target": ref})
+        assert r.status_code == 200
+        cases = r.json()["collections"]["cases"]
+        assert _ids(cases, "added") == {new["id"]}
+        assert _ids(cases, "removed") == {gone["id"]}
+        assert [(m["id"], m["fields"]) for m in cases["modified"]] == [(edit["id"], ["name"])]
+        assert keep["id"] not in _ids(cases, "modified")
+        assert r.json()["summary"]["cases"] == {"added": 1, "removed": 1, "modified": 1}
+
+    # 历史版本：修改刚完成时，之后的删除和新增都还没有发生
+    cases = client.get("/api/diff", params={"base": action_id, "target": "current"}).json()["collections"]["cases"]
+    assert _ids(cases, "added") == {new["id"]}
+    assert _ids(cases, "removed") == {gone["id"]}
+    assert cases["modified"] == []
+
+    detailed = client.get("/api/diff", params={"base": base, "target": target, "details": True}).json()
+    modified = detailed["collections"]["cases"]["modified"][0]
+    assert modified["before"]["name"] == "修改前" and modified["after"]["name"] == "修改后"
+    assert client.get("/api/diff", params={"base": "snapshot_missing"}).status_code == 404
@@ -0,0 +1,23 @@
+def test_analytics_after_deleting_nebula_member(client):
+    case_id = client.post("/api/cases", json={"name": "悬挑住宅", "tags": ["悬挑"]}).json()["id"]
+    nebula_id = client.post("/api/nebulas", json={"name": "待删成员", "case_ids": [case_id]}).json()["id"]
+    assert client.delete(f"/api/cases/{case_id}").status_code == 200
+
+    r = client.get("/api/graph/analytics", params={"fresh": True, "top": 100000})
+    assert r.status_code == 200
+    ids = {n["id"] for n in r.json()["nodes"]}
+    assert nebula_id in ids and case_id not in ids
+
+
+def test_neighbors_and_path(client):
+    tag = client.post("/api/tags", json={"name": "路径标签"}).json()
+    a = client.post("/api/cases", json={"name": "路径甲", "tags": ["路径标签"]}).json()
+    b = client.post("/api/cases", json={"name": "路径乙", "tags": ["路径标签"]}).json()
+
+    r = client.get(f"/api/graph/neighbors/{a['id']}", params={"hops": 2, "edge_types": "case_tag"}).json()
+    hops = {n["id"]: n["hops"] for n in r["nodes"]}
+    assert hops[a["id"]] == 0 and hops[tag["id"]] == 1 and hops[b["id"]] == 2
+
+    path = client.get("/api/graph/path", params={"source": a["id"], "target": b["id"], "edge_types": "case_tag"}).json()
+    assert path["length"] == 2 and [n["id"] for n in path["nodes"]] == [a["id"], tag["id"], b["id"]]
+    assert client.get("/api/graph/neighbors/missing_node").status_code == 404
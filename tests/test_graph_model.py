@@ -0,0 +1,37 @@
+import json
+
+
+def _canonical(graph: dict) -> tuple:
+    key = lambda item: json.dumps(item, sort_keys=True, ensure_ascii=False)
+    return sorted(map(key, graph["nodes"])), sorted(map(key, graph["edges"]))
+
+
+def _assert_matches_rebuild(app_module):
+    with app_module.repo.lock:
+        assert app_module.graph_model.version == app_module.repo.version  # 写入走的是增量更新，没有退回整体重建
+        incremental = app_module.graph_model.project(include_shared=True)
+        fresh = app_module.GraphModel()
+        fresh.rebuild()
+        assert _canonical(incremental) == _canonical(fresh.project(include_shared=True))
+
+
+def test_incremental_model_matches_full_rebuild(client, app_module):
+    client.get("/api/graph")  # 确保模型已构建，之后的写入都走增量
+    parent = client.post("/api/tags", json={"name": "增量父标签"}).json()
+    child = client.post("/api/tags", json={"name": "增量子标签", "parent_id": parent["id"]}).json()
+    a = client.post("/api/cases", json={"name": "增量甲", "tags": ["增量子标签", "未注册标签"]}).json()
+    b = client.post("/api/cases", json={"name": "增量乙", "tags": ["增量父标签"]}).json()
+    k = client.post("/api/concepts", json={"name": "增量概念"}).json()
+    n1 = client.post("/api/nebulas", json={"name": "增量星云一", "case_ids": [a["id"], b["id"]]}).json()
+    n2 = client.post("/api/nebulas", json={"name": "增量星云二", "case_ids": [b["id"]], "concept_ids": [k["id"]]}).json()
+    _assert_matches_rebuild(app_module)
+
+    client.put(f"/api/tags/{child['id']}", json={"name": "改名子标签", "parent_ids": []})
+    client.put(f"/api/cases/{a['id']}", json={"tags": ["改名子标签"]})
+    client.put(f"/api/nebulas/{n2['id']}", json={"case_ids": [a["id"], b["id"]]})
+    _assert_matches_rebuild(app_module)
+
+    client.delete(f"/api/cases/{b['id']}")
+    client.delete(f"/api/nebulas/{n1['id']}")
+    client.post("/api/history/undo")
+    _assert_matches_rebuild(app_module)
@@ -0,0 +1,103 @@
+import asyncio
+import json
+
+
+async def _read_events(app_module, headers: dict, count: int, during=None, settle: float = 0.2,
+                       query: str = "") -> list[dict]:
+    """直接调用 ASGI 应用读取 SSE 事件（测试客户端会一直等到无限的事件流结束）。
+    收到 count 个事件后再等 settle 秒，确认没有多余的事件，然后断开连接。"""
+    scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": "/api/graph/stream",
+             "raw_path": b"/api/graph/stream", "root_path": "", "query_string": query.encode(),
+             "headers": [(k.lower().encode(), v.encode()) for k, v in headers.items()],
+             "server": ("testserver", 80), "client": ("testclient", 50000)}
+    disconnected, started = asyncio.Event(), asyncio.Event()
+    body, events = b"", []
+    requested = False
+
+    async def receive():
+        nonlocal requested
+        if not requested:
+            requested = True
+            return {"type": "http.request", "body": b"", "more_body": False}
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    async def send(message):
+        nonlocal body
+        if message["type"] == "http.response.start":
+            started.set()
+            return
+        body += message.get("body", b"")
+        *blocks, body = body.split(b"\n\n")
+        for block in blocks:
+            fields = dict(line.split(": ", 1) for line in block.decode().splitlines() if ": " in line)
+            if "event" in fields:
+                events.append({"id": fields["id"], "event": fields["event"], "data": json.loads(fields["data"])})
+
+    task = asyncio.create_task(app_module.app(scope, receive, send))
+    await asyncio.wait_for(started.wait(), 5)
+    if during is not None:
+        await asyncio.to_thread(during)
+    for _ in range(100):
+        if len(events) >= count:
+            break
+        await asyncio.sleep(0.05)
+    await asyncio.sleep(settle)
+    disconnected.set()
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return events
+
+
+def test_reconnect_with_cursor_replays_only_missed_deltas(client, app_module):
+    graph = client.get("/api/graph").json()
+    epoch, _, version = graph["cursor"].rpartition(":")
+    assert int(version) == graph["version"] == app_module.repo.version
+    first = client.post("/api/cases", json={"name": "推送一"}).json()
+    second = client.post("/api/cases", json={"name": "推送二"}).json()
+    v = graph["version"]
+
+    events = asyncio.run(_read_events(app_module, {"Last-Event-ID": graph["cursor"]}, 2))
+    assert [(e["event"], e["id"]) for e in events] == [("delta", f"{epoch}:{v + 1}"), ("delta", f"{epoch}:{v + 2}")]
+    assert [n["id"] for n in events[0]["data"]["nodes"]["add"]] == [first["id"]]
+
+    events = asyncio.run(_read_events(app_module, {"Last-Event-ID": f"{epoch}:{v + 1}"}, 1))
+    assert [e["id"] for e in events] == [f"{epoch}:{v + 2}"]
+    assert [n["id"] for n in events[0]["data"]["nodes"]["add"]] == [second["id"]]
+
+    assert asyncio.run(_read_events(app_module, {"Last-Event-ID": f"{epoch}:{v + 2}"}, 0)) == []
+
+
+def test_cursor_from_previous_process_gets_reset(client, app_module):
+    version = app_module.repo.version
+    # 重启后的新进程版本号从 0 重新计数，旧游标的版本可能恰好等于当前版本
+    events = asyncio.run(_read_events(app_module, {"Last-Event-ID": f"oldepoch:{version}"}, 1))
+    assert [e["event"] for e in events] == ["reset"]
+    assert events[0]["id"] == app_module._graph_cursor(version)
+
+
+def test_live_delta_after_subscribe(client, app_module):
+    created = {}
+
+    def write():
+        created.update(client.post("/api/concepts", json={"name": "实时推送"}).json())
+
+    events = asyncio.run(_read_events(app_module, {}, 1, during=write))
+    assert len(events) == 1 and events[0]["event"] == "delta"
+    assert [n["id"] for n in events[0]["data"]["nodes"]["add"]] == [created["id"]]
+
+
+def test_delta_nodes_match_graph_projection(client, app_module):
+    cursor = client.get("/api/graph").json()["cursor"]
+    concept = client.post("/api/concepts", json={"name": "投影概念", "description": "不在精简字段里"}).json()
+    lean = next(n for n in client.get("/api/graph").json()["nodes"] if n["id"] == concept["id"])
+
+    events = asyncio.run(_read_events(app_module, {"Last-Event-ID": cursor}, 1))
+    assert events[0]["data"]["nodes"]["add"] == [lean]
+    assert set(lean) <= set(app_module.GRAPH_NODE_FIELDS)
+
+    events = asyncio.run(_read_events(app_module, {"Last-Event-ID": cursor}, 1, query="fields=all"))
+    assert events[0]["data"]["nodes"]["add"][0]["description"] == "不在精简字段里"
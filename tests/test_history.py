@@ -0,0 +1,115 @@
+import pytest
+
+
+def _undo(client):
+    assert client.post("/api/history/undo").status_code == 200
+
+
+def _redo(client):
+    assert client.post("/api/history/redo").status_code == 200
+
+
+def test_nebula_edits_are_undoable(client, app_module):
+    repo = app_module.repo
+    case = client.post("/api/cases", json={"name": "星云成员"}).json()
+    nebula = client.post("/api/nebulas", json={"name": "待改星云"}).json()
+    client.put(f"/api/nebulas/{nebula['id']}", json={"name": "改后星云", "case_ids": [case["id"]]})
+    assert repo.nebula_ids_containing(case["id"]) == {nebula["id"]}
+
+    _undo(client)
+    assert repo.peek("nebulas", nebula["id"])["name"] == "待改星云"
+    assert repo.nebula_ids_containing(case["id"]) == set()
+    _undo(client)
+    assert not repo.exists("nebulas", nebula["id"])
+    _redo(client)
+    _redo(client)
+    assert repo.peek("nebulas", nebula["id"])["case_ids"] == [case["id"]]
+
+    client.delete(f"/api/nebulas/{nebula['id']}")
+    _undo(client)
+    assert repo.peek("nebulas", nebula["id"])["name"] == "改后星云"
+    types = [a["type"] for a in client.get("/api/history").json()["actions"][:3]]
+    assert types == ["delete_nebula", "update_nebula", "create_nebula"]
+
+
+def test_case_crud_undo_redo(client, app_module):
+    repo = app_module.repo
+    case = client.post("/api/cases", json={"name": "原名", "tags": ["庭院"]}).json()
+    client.put(f"/api/cases/{case['id']}", json={"name": "新名", "tags": ["折叠"]})
+    client.delete(f"/api/cases/{case['id']}")
+    assert not repo.exists("cases", case["id"])
+
+    _undo(client)
+    assert repo.peek("cases", case["id"])["name"] == "新名"
+    _undo(client)
+    restored = repo.peek("cases", case["id"])
+    assert restored["name"] == "原名" and restored["tags"] == ["庭院"]
+    assert case["id"] in repo.case_ids_with_tag("庭院")
+    assert case["id"] not in repo.case_ids_with_tag("折叠")
+    _redo(client)
+    assert repo.peek("cases", case["id"])["name"] == "新名"
+
+    # 撤销后发生新操作，被撤销的分支不能再重做
+    concept = client.post("/api/concepts", json={"name": "新操作"}).json()
+    assert client.post("/api/history/redo").status_code == 400
+    assert repo.exists("concepts", concept["id"])
+    _undo(client)
+    assert not repo.exists("concepts", concept["id"])
+    assert repo.peek("cases", case["id"])["name"] == "新名"
+
+
+def test_only_touched_entities_are_restored(client, app_module):
+    repo = app_module.repo
+    a = client.post("/api/cases", json={"name": "甲"}).json()
+    b = client.post("/api/cases", json={"name": "乙"}).json()
+    client.put(f"/api/cases/{a['id']}", json={"name": "甲改"})
+    client.put(f"/api/cases/{b['id']}", json={"name": "乙改"})
+    _undo(client)
+    _undo(client)
+    assert repo.peek("cases", a["id"])["name"] == "甲"
+    assert repo.peek("cases", b["id"])["name"] == "乙"
+    _redo(client)
+    assert repo.peek("cases", a["id"])["name"] == "甲改"
+    assert repo.peek("cases", b["id"])["name"] == "乙"
+    latest, previous = client.get("/api/history").json()["actions"][:2]
+    assert latest["type"] == previous["type"] == "update_case"
+    assert latest["undone"] and not previous["undone"]
+    assert latest["changes"] == previous["changes"] == 1
+
+
+def test_history_file_replays_to_the_same_stacks(client, app_module):
+    case = client.post("/api/cases", json={"name": "重放"}).json()
+    client.put(f"/api/cases/{case['id']}", json={"name": "重放改"})
+    _undo(client)
+    app_module.history.flush()
+
+    replayed = app_module.History(app_module.HISTORY_FILE)
+    assert replayed.actions() == app_module.history.actions()
+    assert replayed._undo == app_module.history._undo
+    assert replayed._redo == app_module.history._redo
+
+
+def test_failed_undo_leaves_stacks_in_place(client, app_module, monkeypatch):
+    repo, history = app_module.repo, app_module.history
+    case = client.post("/api/cases", json={"name": "撤销前"}).json()
+    client.put(f"/api/cases/{case['id']}", json={"name": "撤销后"})
+    undo_stack, redo_stack = list(history._undo), list(history._redo)
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    for name in ("_disk_save", "_db_apply_changes"):
+        monkeypatch.setattr(app_module, name, fail)
+    monkeypatch.setattr(app_module.journal, "append", fail)
+    with pytest.raises(OSError):
+        history.undo()
+    monkeypatch.undo()
+
+    assert history._undo == undo_stack and history._redo == redo_stack
+    assert repo.peek("cases", case["id"])["name"] == "撤销后"
+    _undo(client)  # 再次撤销的仍是同一个操作
+    assert repo.peek("cases", case["id"])["name"] == "撤销前"
+    history.flush()
+    replayed = app_module.History(app_module.HISTORY_FILE)
+    replayed.load()
+    assert replayed._undo == history._undo and replayed._redo == history._redo
@@ -0,0 +1,122 @@
+import contextvars
+import threading
+
+
+def _capture(app_module, history, eid: str, name: str):
+    """在独立的上下文里标记操作并提交一批改动，不影响其他测试的上下文"""
+    def run():
+        app_module._record_history("create_case", {"case_name": name})
+        history.capture([("cases", eid, None, {"id": eid, "name": name})])
+    contextvars.copy_context().run(run)
+
+
+def test_concurrent_captures_replay_in_order(app_module, tmp_path):
+    history = app_module.History(tmp_path / "history.jsonl")
+    history.load()
+
+    def worker(t):
+        for i in range(10):
+            _capture(app_module, history, f"case_{t}_{i}", f"{t}-{i}")
+
+    threads = [threading.Thread(target=worker, args=(t,)) for t in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    history.flush()
+
+    replayed = app_module.History(history.path)
+    assert len(replayed.actions()) == 80
+    assert replayed.actions() == history.actions()
+    assert replayed._undo == history._undo
+
+
+def test_rewrite_keeps_recent_actions(app_module, tmp_path, monkeypatch):
+    monkeypatch.setattr(app_module, "HISTORY_LIMIT", 5)
+    monkeypatch.setattr(app_module, "HISTORY_UNDO_LIMIT", 5)
+    history = app_module.History(tmp_path / "history.jsonl")
+    history.load()
+    for i in range(30):
+        _capture(app_module, history, f"case_{i}", str(i))
+    history.flush()
+
+    lines = history.path.read_bytes().splitlines()
+    assert len(lines) <= 2 * 5 + 1
+    replayed = app_module.History(history.path)
+    assert [a["data"]["case_name"] for a in replayed.actions()] == ["29", "28", "27", "26", "25"]
+
+
+def test_torn_tail_is_truncated_on_load(app_module, tmp_path):
+    history = app_module.History(tmp_path / "history.jsonl")
+    history.load()
+    _capture(app_module, history, "case_a", "a")
+    history.flush()
+    with open(history.path, "ab") as f:
+        f.write(b'{"op": "do", "id": "trunc')
+    size = history.path.stat().st_size
+
+    replayed = app_module.History(history.path)
+    assert [a["data"]["case_name"] for a in replayed.actions()] == ["a"]
+    assert history.path.stat().st_size < size
+
+
+def test_legacy_history_file_is_kept_as_backup(app_module, tmp_path, monkeypatch):
+    legacy = tmp_path / "history.json"
+    legacy.write_text('[{"type": "create_case"}]', encoding="utf-8")
+    (tmp_path / "history.json.bak").write_text("older", encoding="utf-8")
+    monkeypatch.setattr(app_module, "LEGACY_HISTORY_FILE", legacy)
+
+    app_module.History(tmp_path / "history.jsonl").load()
+    assert not legacy.exists()
+    assert (tmp_path / "history.json.bak").read_text(encoding="utf-8") == "older"
+    backups = [p for p in tmp_path.glob("history.json.bak.*")]
+    assert len(backups) == 1 and backups[0].read_text(encoding="utf-8") == '[{"type": "create_case"}]'
+
+
+def _synchronous_history(app_module, path, monkeypatch, policy: str):
+    """不启动写线程的历史（由测试调用 flush()），并统计对历史文件的 fsync 次数"""
+    monkeypatch.setattr(app_module, "HISTORY_FSYNC", policy)
+    history = app_module.History(path)
+    history.load()
+    history._thread = threading.current_thread()  # 视为写线程已在运行
+    syncs = []
+    real_fsync = app_module.os.fsync
+
+    def fsync(fd):
+        if history._fh is not None and fd == history._fh.fileno():
+            syncs.append(fd)
+        real_fsync(fd)
+
+    monkeypatch.setattr(app_module.os, "fsync", fsync)
+    return history, syncs
+
+
+def test_fsync_policy_batch(app_module, tmp_path, monkeypatch):
+    history, syncs = _synchronous_history(app_module, tmp_path / "h.jsonl", monkeypatch, "batch")
+    _capture(app_module, history, "case_a", "a")
+    _capture(app_module, history, "case_b", "b")
+    history.flush()
+    assert len(syncs) == 1 and not history._unsynced  # 一批只 fsync 一次
+    history.flush()
+    assert len(syncs) == 1
+
+
+def test_fsync_policy_interval(app_module, tmp_path, monkeypatch):
+    history, syncs = _synchronous_history(app_module, tmp_path / "h.jsonl", monkeypatch, "interval")
+    _capture(app_module, history, "case_a", "a")
+    history.flush()
+    assert len(syncs) == 1
+    _capture(app_module, history, "case_b", "b")
+    history.flush()
+    assert len(syncs) == 1 and history._unsynced  # 间隔未到，等写线程到点补做
+    history._last_sync -= app_module.HISTORY_FSYNC_INTERVAL
+    history.flush()
+    assert len(syncs) == 2 and not history._unsynced
+
+
+def test_fsync_policy_never(app_module, tmp_path, monkeypatch):
+    history, syncs = _synchronous_history(app_module, tmp_path / "h.jsonl", monkeypatch, "never")
+    _capture(app_module, history, "case_a", "a")
+    history.flush()
+    assert syncs == [] and not history._unsynced  # 写线程不会因为待 fsync 而定时醒来
+    assert app_module.History(history.path).actions()[0]["data"]["case_name"] == "a"
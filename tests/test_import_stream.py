@@ -0,0 +1,118 @@
+import gzip
+import io
+import json
+
+
+def _events(response) -> list[dict]:
+    return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+
+def test_json_records_parse_across_small_chunks(client, app_module):
+    client.post("/api/cases", json={"name": "分块 \"引号\" 案例", "year": "2024", "tags": ["滨水", "更新"]})
+    document = client.get("/api/export/json").content.decode("utf-8")
+    expected = json.loads(document)
+    records = list(app_module._iter_json_records(io.StringIO(document), chunk_size=7))
+
+    assert all(error is None for _, _, error in records)
+    for kind in ("cases", "concepts", "nebulas"):
+        assert [item for k, item, _ in records if k == kind] == expected[kind]
+    assert {item["id"]: item for k, item, _ in records if k == "tags"} == expected["tags"]
+
+
+def test_ndjson_stream_import_reports_progress_and_errors(client, app_module):
+    lines = [
+        {"kind": "cases", "data": {"id": "case_stream_1", "name": "流式一", "tags": ["悬挑"]}},
+        {"kind": "cases", "data": {"name": "   "}},
+        {"kind": "unknown", "data": {"name": "x"}},
+        {"kind": "concepts", "data": {"id": "concept_stream_1", "name": "流式概念", "keywords": "不是列表"}},
+        {"kind": "tags", "data": {"name": "流式标签"}},
+    ]
+    body = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines) + "\n{broken\n"
+    r = client.post("/api/import/stream", params={"format": "ndjson"}, content=gzip.compress(body.encode("utf-8")))
+    events = _events(r)
+
+    assert [e["phase"] for e in events][0] == "apply" and events[-1]["phase"] == "done"
+    done = events[-1]
+    assert done["imported"] == {"cases": 1, "tags": 1}
+    assert sum(done["skipped"].values()) == 4 and len(done["errors"]) == 4
+    assert app_module.repo.peek("cases", "case_stream_1")["name"] == "流式一"
+    assert app_module.repo.tag_id_by_name("流式标签") is not None
+
+    # 追加模式下已存在的记录保持不变
+    again = json.dumps({"kind": "cases", "data": {"id": "case_stream_1", "name": "覆盖"}}, ensure_ascii=False)
+    done = _events(client.post("/api/import/stream", params={"format": "ndjson"}, content=again.encode("utf-8")))[-1]
+    assert done["imported"] == {"cases": 0} and done["skipped"] == {"cases": 1}
+    assert app_module.repo.peek("cases", "case_stream_1")["name"] == "流式一"
+
+
+def test_stream_import_is_one_undoable_action(client, app_module):
+    doc = {"cases": [{"id": "case_stream_a", "name": "甲"}, {"id": "case_stream_b", "name": "乙"}]}
+    done = _events(client.post("/api/import/stream", content=json.dumps(doc, ensure_ascii=False).encode("utf-8")))[-1]
+    assert done["imported"] == {"cases": 2}
+    assert client.get("/api/history").json()["actions"][0]["type"] == "import"
+    assert client.post("/api/history/undo").status_code == 200
+    assert not app_module.repo.exists("cases", "case_stream_a")
+    assert not app_module.repo.exists("cases", "case_stream_b")
+    assert client.post("/api/import/stream", params={"mode": "merge"}, content=b"{}").status_code == 400
+
+
+def test_stream_import_applies_each_batch_as_parsed(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "IMPORT_BATCH", 2)
+    before = {c["id"] for c in app_module.repo.view("concepts")}
+    lines = [{"kind": "concepts", "data": {"id": f"concept_batch_{i}", "name": f"分批{i}"}} for i in range(5)]
+    body = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines).encode("utf-8")
+    events = _events(client.post("/api/import/stream", params={"format": "ndjson", "mode": "replace"}, content=body))
+
+    # 每批写入后汇报一次，写入条数随批次增长
+    assert [(e["phase"], e["records"], e["imported"]) for e in events[:-1]] == [
+        ("apply", 2, 2), ("apply", 4, 4), ("apply", 5, 5)]
+    assert events[-1]["removed"] == {"concepts": len(before)}
+    assert [c["id"] for c in app_module.repo.view("concepts")] == [f"concept_batch_{i}" for i in range(5)]
+
+    assert client.post("/api/history/undo").status_code == 200
+    assert {c["id"] for c in app_module.repo.view("concepts")} == before
+
+
+def test_stream_import_keeps_written_batches_on_error(client, app_module, monkeypatch):
+    monkeypatch.setattr(app_module, "IMPORT_BATCH", 2)
+    put_many, calls = app_module.repo.put_many, []
+
+    def failing_put_many(kind, items):
+        calls.append(kind)
+        if len(calls) == 2:
+            raise RuntimeError("磁盘已满")
+        return put_many(kind, items)
+
+    monkeypatch.setattr(app_module.repo, "put_many", failing_put_many)
+    lines = [{"kind": "cases", "data": {"id": f"case_partial_{i}", "name": f"部分{i}"}} for i in range(4)]
+    body = "\n".join(json.dumps(line, ensure_ascii=False) for line in lines).encode("utf-8")
+    error = _events(client.post("/api/import/stream", params={"format": "ndjson"}, content=body))[-1]
+
+    assert error["phase"] == "error" and error["imported"] == {"cases": 2}
+    assert app_module.repo.exists("cases", "case_partial_1") and not app_module.repo.exists("cases", "case_partial_2")
+    monkeypatch.undo()
+    assert client.post("/api/history/undo").status_code == 200
+    assert not app_module.repo.exists("cases", "case_partial_0")
+
+
+
+def test_stream_import_spools_off_the_event_loop(client, app_module, monkeypatch):
+    import asyncio
+    import tempfile
+
+    on_loop = []
+
+    class RecordingSpool(tempfile.SpooledTemporaryFile):
+        def write(self, data):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            return super().write(data)
+
+    monkeypatch.setattr(app_module.tempfile, "SpooledTemporaryFile", RecordingSpool)
+    doc = {"cases": [{"id": "case_spool", "name": "暂存"}]}
+    done = _events(client.post("/api/import/stream", content=json.dumps(doc, ensure_ascii=False).encode("utf-8")))[-1]
+    assert done["imported"] == {"cases": 1}
+    assert on_loop and not any(on_loop)
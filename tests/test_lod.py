@@ -0,0 +1,41 @@
+import json
+
+
+def _lod(client, **params) -> tuple[dict, list, list]:
+    lines = [json.loads(line) for line in client.get("/api/graph/lod", params=params).text.splitlines()]
+    meta, batches = lines[0]["meta"], lines[1:]
+    nodes = [n for b in batches for n in b["nodes"]]
+    edges = [e for b in batches for e in b["edges"]]
+    seen = set()
+    for b in batches:  # 每条边在它的两个端点都已发送时才出现
+        seen |= {n["id"] for n in b["nodes"]}
+        assert all(e["source"] in seen and e["target"] in seen for e in b["edges"])
+    return meta, nodes, edges
+
+
+def test_lod_clusters_cover_every_node_once(client):
+    meta, nodes, edges = _lod(client, zoom=0.0001, batch=5)
+    clusters = [n for n in nodes if n["type"] == "cluster"]
+    assert clusters and meta["clusters"] == len(clusters)
+    assert sum(n["size"] if n["type"] == "cluster" else 1 for n in nodes) == meta["total_nodes"]
+    cluster_ids = {n["id"] for n in clusters}
+    assert all(e["type"] == "cluster_link" and e["weight"] > 0 for e in edges
+               if e["source"] in cluster_ids or e["target"] in cluster_ids)
+
+
+def test_lod_fully_zoomed_in_returns_real_graph(client):
+    meta, nodes, edges = _lod(client, zoom=1e9)
+    full = client.get("/api/graph").json()
+    ids = {n["id"] for n in full["nodes"]}
+    assert meta["clusters"] == 0 and {n["id"] for n in nodes} == ids
+    real_edges = {(e["source"], e["target"], e["type"]) for e in full["edges"]
+                  if e["source"] in ids and e["target"] in ids and e["source"] != e["target"]}
+    assert {(e["source"], e["target"], e["type"]) for e in edges} == real_edges
+
+
+def test_lod_viewport_and_small_graph_shortcut(client):
+    meta, nodes, _ = _lod(client, zoom=1e9, x0=1e7, y0=1e7, x1=1e7 + 1, y1=1e7 + 1)
+    assert nodes == [] and meta["nodes"] == 0
+    lines = client.get("/api/graph/lod", params={"min_nodes": 10 ** 9}).text.splitlines()
+    assert len(lines) == 1 and "total_nodes" in json.loads(lines[0])["meta"]
+    assert client.get("/api/graph/lod", params={"zoom": 0}).status_code == 400
@@ -0,0 +1,158 @@
+import json
+import os
+import shutil
+import subprocess
+import sys
+
+import pytest
+
+from conftest import ROOT
+
+
+def test_failed_write_rolls_back_memory(client, app_module, monkeypatch):
+    repo = app_module.repo
+    case = client.post("/api/cases", json={"name": "落盘前", "tags": ["木构"]}).json()
+    version = repo.version
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(app_module, "_disk_save", fail)
+    monkeypatch.setattr(app_module, "_db_apply_changes", fail)
+    monkeypatch.setattr(app_module.journal, "append", fail)
+    with pytest.raises(OSError):
+        with repo.batch():
+            repo.put("cases", {**case, "name": "落盘失败", "tags": ["混凝土"]})
+            repo.put("cases", {"name": "新案例"})
+    monkeypatch.undo()
+
+    assert repo.version == version
+    assert repo.peek("cases", case["id"])["name"] == "落盘前"
+    assert case["id"] in repo.case_ids_with_tag("木构")
+    assert case["id"] not in repo.case_ids_with_tag("混凝土")
+    assert not any(c["name"] == "新案例" for c in repo.view("cases"))
+
+
+def test_exception_inside_batch_rolls_back(client, app_module):
+    repo = app_module.repo
+    case = client.post("/api/cases", json={"name": "批次前"}).json()
+    with pytest.raises(RuntimeError):
+        with repo.batch():
+            repo.put("cases", {**case, "name": "批次中"})
+            raise RuntimeError
+    assert repo.peek("cases", case["id"])["name"] == "批次前"
+
+
+def _run_app(cwd, code: str, **env) -> str:
+    """在独立进程里导入 app 执行一段代码（模块级配置取自环境变量），返回最后一行输出"""
+    env = {**os.environ, "USE_DATABASE": "false", "STORAGE_FORMAT": "json", **env}
+    script = f"import sys, json; sys.path.insert(0, {str(ROOT)!r}); import app\n{code}"
+    out = subprocess.run([sys.executable, "-c", script], cwd=cwd, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return out.strip().splitlines()[-1]
+
+
+def test_leftover_journal_ignored_when_journal_mode_off(tmp_path):
+    shutil.copy(ROOT / "seed_data.json", tmp_path / "seed_data.json")
+    (tmp_path / "data.journal").write_text("")
+    seed = json.loads((ROOT / "seed_data.json").read_text(encoding="utf-8"))
+    assert int(_run_app(tmp_path, "print(len(app.load_cases()))", JOURNAL_MODE="false")) == len(seed)
+
+
+def test_journal_replay_and_compaction(tmp_path):
+    shutil.copy(ROOT / "seed_data.json", tmp_path / "seed_data.json")
+    write = """
+app.repo.put("cases", {"id": "case_keep", "name": "保留"})
+app.repo.put("cases", {"id": "case_drop", "name": "删除"})
+app.repo.delete("cases", "case_drop")
+with app.repo.batch():
+    c = app.repo.get("cases", "case_001")
+    c["name"] = "日志改名"
+    app.repo.put("cases", c)
+print("ok")
+"""
+    read = """
+cases = {c["id"]: c["name"] for c in app.load_cases()}
+print(json.dumps([cases.get("case_keep"), "case_drop" in cases, cases.get("case_001"), len(cases)]))
+"""
+    _run_app(tmp_path, write, JOURNAL_MODE="true")
+    assert not (tmp_path / "data.json").exists()
+    journal = tmp_path / "data.journal"
+    assert journal.read_bytes().count(b"\n") >= 4
+    with open(journal, "ab") as f:
+        f.write(b'{"ops": [{"op": "put", "kind": "cases", "id": "case_to')  # 崩溃时写了一半的行
+    seed_count = len(json.loads((ROOT / "seed_data.json").read_text(encoding="utf-8")))
+    expected = ["保留", False, "日志改名", seed_count + 1]
+
+    assert json.loads(_run_app(tmp_path, read + "app.repo.compact()", JOURNAL_MODE="true")) == expected
+    assert (tmp_path / "data.json").exists()
+    assert not journal.exists() and not (tmp_path / "data.journal.compacting").exists()
+    # 折叠后基础文件就是完整数据，不开日志模式也能读到
+    assert json.loads(_run_app(tmp_path, read, JOURNAL_MODE="false")) == expected
+
+
+@pytest.mark.parametrize("env", [{"JOURNAL_MODE": "true"}, {"USE_DATABASE": "true"}])
+def test_replace_order_survives_reload(tmp_path, env):
+    shutil.copy(ROOT / "seed_data.json", tmp_path / "seed_data.json")
+    write = """
+for i in range(5):
+    app.repo.put("cases", {"id": f"case_order_{i}", "name": str(i)})
+app.save_cases([{"id": "case_new", "name": "新"}, *reversed(app.load_cases()[1:])])
+print(json.dumps([c["id"] for c in app.load_cases()]))
+"""
+    expected = json.loads(_run_app(tmp_path, write, **env))
+    assert expected[:3] == ["case_new", "case_order_4", "case_order_3"]
+    # 重启后从日志/数据库重放，顺序与 replace() 传入的一致
+    assert json.loads(_run_app(tmp_path, 'print(json.dumps([c["id"] for c in app.load_cases()]))', **env)) == expected
+
+
+def test_failed_replace_restores_order(client, app_module, monkeypatch):
+    repo = app_module.repo
+    before = [c["id"] for c in repo.view("cases")]
+
+    def fail(*args, **kwargs):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(app_module, "_disk_save", fail)
+    monkeypatch.setattr(app_module, "_db_apply_changes", fail)
+    monkeypatch.setattr(app_module.journal, "append", fail)
+    with pytest.raises(OSError):
+        repo.replace("cases", list(reversed(repo.view("cases"))))
+    monkeypatch.undo()
+    assert [c["id"] for c in repo.view("cases")] == before
+
+
+def test_journal_compacts_in_background_past_threshold(tmp_path):
+    shutil.copy(ROOT / "seed_data.json", tmp_path / "seed_data.json")
+    code = """
+import time
+for i in range(20):
+    app.repo.put("cases", {"id": f"case_bg_{i}", "name": "x" * 200})
+deadline = time.time() + 10
+while (app.journal.path.exists() and app.journal.path.stat().st_size > 4096 or app.journal.rotated.exists()) and time.time() < deadline:
+    time.sleep(0.05)
+print(len(app._read_document(app.DATA_FILE)))
+"""
+    assert int(_run_app(tmp_path, code, JOURNAL_MODE="true", JOURNAL_COMPACT_BYTES="4096")) >= 13
+
+
+def test_writes_go_through_memory_and_disk(client, app_module):
+    repo = app_module.repo
+    case = client.post("/api/cases", json={"name": "写穿", "tags": ["社区"]}).json()
+    assert any(c["id"] == case["id"] for c in client.get("/api/cases").json())
+    view = repo.view("cases")
+
+    client.put(f"/api/cases/{case['id']}", json={"name": "写穿改"})
+    assert any(c["id"] == case["id"] and c["name"] == "写穿" for c in view)  # 已发出的视图不受后续写入影响
+    assert repo.peek("cases", case["id"])["name"] == "写穿改"
+    assert repo.tag_id_by_name("社区") is not None
+
+    copy = repo.get("cases", case["id"])
+    copy["name"] = "未提交"
+    assert repo.peek("cases", case["id"])["name"] == "写穿改"  # get() 返回副本
+
+    # 重新从磁盘加载（含日志重放 / 数据库）得到同样的数据
+    assert app_module.Repository().peek("cases", case["id"])["name"] == "写穿改"
+    client.delete(f"/api/cases/{case['id']}")
+    assert not app_module.Repository().exists("cases", case["id"])
+    assert client.put(f"/api/cases/{case['id']}", json={"name": "x"}).status_code == 404
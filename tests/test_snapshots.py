@@ -0,0 +1,59 @@
+def test_snapshot_after_importing_entities_without_string_ids(client, app_module):
+    r = client.post("/api/import/json", json={
+        "merge_mode": "append",
+        "tags": {"tag_imported": {"name": "导入标签"}},
+        "nebulas": [{"name": "无 id 星云"}, {"id": 7, "name": "数字 id 星云"}],
+    })
+    assert r.status_code == 200
+    assert app_module.repo.peek("nebulas", "7")["name"] == "数字 id 星云"
+    assert app_module.repo.peek("tags", "tag_imported")["id"] == "tag_imported"
+
+    r = client.post("/api/snapshots", json={"name": "导入之后"})
+    assert r.status_code == 200
+    snapshot_id = r.json()["snapshot_id"]
+    assert client.post(f"/api/snapshots/{snapshot_id}/restore").status_code == 200
+    assert app_module.repo.exists("nebulas", "7")
+
+
+def _blobs(app_module) -> set[str]:
+    return {p.name for p in app_module.SNAPSHOT_BLOBS_DIR.glob("*/*")}
+
+
+def test_snapshot_restore_and_blob_gc(client, app_module):
+    repo = app_module.repo
+    case = client.post("/api/cases", json={"name": "快照前"}).json()
+    first = client.post("/api/snapshots", json={"name": "一"}).json()
+    blobs_first = _blobs(app_module)
+
+    # 没有变化时不写任何块
+    unchanged = client.post("/api/snapshots", json={"name": "二"}).json()
+    assert unchanged["bytes_written"] == 0 and _blobs(app_module) == blobs_first
+
+    client.put(f"/api/cases/{case['id']}", json={"name": "快照后"})
+    added = client.post("/api/cases", json={"name": "快照后新增"}).json()
+    third = client.post("/api/snapshots", json={"name": "三"}).json()
+    assert 0 < third["bytes_written"]
+    new_blobs = _blobs(app_module) - blobs_first
+    assert new_blobs and len(new_blobs) < len(_blobs(app_module))  # 未变的块与之前的快照共享
+
+    assert client.post(f"/api/snapshots/{first['snapshot_id']}/restore").json()["ok"]
+    assert repo.peek("cases", case["id"])["name"] == "快照前"
+    assert not repo.exists("cases", added["id"])
+    assert client.post(f"/api/snapshots/{third['snapshot_id']}/restore").json()["ok"]
+    assert repo.peek("cases", case["id"])["name"] == "快照后"
+
+    # 删除仍有其他快照引用其块的快照不回收任何块；最后一个引用消失后回收
+    assert client.delete(f"/api/snapshots/{first['snapshot_id']}").json()["blobs_removed"] == 0
+    assert client.delete(f"/api/snapshots/{third['snapshot_id']}").json()["blobs_removed"] == len(new_blobs)
+    assert _blobs(app_module) == blobs_first
+    assert client.post(f"/api/snapshots/{unchanged['snapshot_id']}/restore").json()["ok"]
+    assert repo.peek("cases", case["id"])["name"] == "快照前"
+    assert client.post("/api/snapshots/snapshot_missing/restore").status_code == 404
+
+
+def test_snapshot_list_pagination(client):
+    ids = [client.post("/api/snapshots", json={"name": f"分页{i}"}).json()["snapshot_id"] for i in range(3)]
+    page = client.get("/api/snapshots", params={"offset": 0, "limit": 2}).json()
+    assert page["total"] >= 3 and len(page["snapshots"]) == 2
+    assert [s["id"] for s in page["snapshots"]] == ids[::-1][:2]
+    assert client.get("/api/snapshots", params={"limit": 0}).status_code == 400
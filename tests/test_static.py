@@ -0,0 +1,44 @@
+import asyncio
+import os
+
+import pytest
+
+
+def _raw_get(app_module, path: str) -> int:
+    """绕过 HTTP 客户端直接调用 ASGI 应用，保留路径里的 ../（客户端会把它规范化掉）"""
+    scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": path,
+             "raw_path": path.encode(), "root_path": "", "query_string": b"", "headers": [],
+             "server": ("testserver", 80), "client": ("testclient", 50000)}
+    messages = []
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    asyncio.run(app_module.app(scope, receive, send))
+    return messages[0]["status"]
+
+
+@pytest.mark.parametrize("path", ["/static/../seed_data.json", "/static/../data.json",
+                                  "/static/uploads/../../tags.json"])
+def test_static_rejects_paths_outside_static_dir(client, app_module, path):
+    assert _raw_get(app_module, path) == 404
+
+
+def test_static_rejects_absolute_escape(client, app_module, tmp_path):
+    secret = tmp_path / "secret_test.json"
+    secret.write_text('{"secret": 1}')
+    depth = len(os.path.abspath("static").split(os.sep))
+    assert _raw_get(app_module, "/static/" + "../" * depth + str(secret).lstrip("/")) == 404
+
+
+def test_static_serves_precompressed_with_etag(client):
+    r = client.get("/static/index.html", headers={"Accept-Encoding": "gzip"})
+    assert r.status_code == 200
+    assert r.headers["content-encoding"] == "gzip" and r.headers["etag"].endswith('-gzip"')
+    plain = client.get("/static/index.html", headers={"Accept-Encoding": "identity"})
+    assert r.content == plain.content
+    cached = client.get("/static/index.html", headers={"Accept-Encoding": "gzip", "If-None-Match": r.headers["etag"]})
+    assert cached.status_code == 304
@@ -0,0 +1,45 @@
+def test_case_filter_covers_tag_subtree(client):
+    root = client.post("/api/tags", json={"name": "结构体系"}).json()
+    child = client.post("/api/tags", json={"name": "壳体结构", "parent_id": root["id"]}).json()
+    leaf = client.post("/api/tags", json={"name": "薄壳", "parent_id": child["id"]}).json()
+    by_name = client.post("/api/cases", json={"name": "按名称打标签", "tags": ["薄壳"]}).json()
+    by_id = client.post("/api/cases", json={"name": "按 id 打标签", "tags": [child["id"]]}).json()
+    other = client.post("/api/cases", json={"name": "无关案例", "tags": ["滨水"]}).json()
+
+    def ids(tag_id):
+        return {c["id"] for c in client.get("/api/cases", params={"tag": tag_id}).json()}
+
+    assert {by_name["id"], by_id["id"]} <= ids(root["id"])
+    assert other["id"] not in ids(root["id"])
+    assert ids(leaf["id"]) == {by_name["id"]}
+
+    client.put(f"/api/tags/{leaf['id']}", json={"parent_ids": []})
+    assert by_name["id"] not in ids(root["id"])
+    assert client.get("/api/cases", params={"tag": "tag_missing"}).status_code == 404
+
+
+def test_tag_closure_and_cycle_detection(client, app_module):
+    repo = app_module.repo
+    a = client.post("/api/tags", json={"name": "闭包甲"}).json()
+    b = client.post("/api/tags", json={"name": "闭包乙", "parent_id": a["id"]}).json()
+    c = client.post("/api/tags", json={"name": "闭包丙", "parent_id": b["id"]}).json()
+    d = client.post("/api/tags", json={"name": "闭包丁", "parent_ids": [a["id"], c["id"]]}).json()
+
+    h = client.get(f"/api/tags/{a['id']}/hierarchy").json()
+    assert {t["id"]: t["depth"] for t in h["descendants"]} == {b["id"]: 1, c["id"]: 2, d["id"]: 1}
+    assert repo.tag_ancestors(d["id"]) == {a["id"]: 1, c["id"]: 1, b["id"]: 2}
+    assert repo.tag_depth(d["id"]) == 3
+
+    # 把后代或自身设为父节点会形成环
+    for tid, parent in ((a, c), (a, d), (b, d), (c, c)):
+        assert client.put(f"/api/tags/{tid['id']}", json={"parent_ids": [parent["id"]]}).status_code == 400
+    assert repo.tag_ancestors(a["id"]) == {}
+
+    # 移动子树后闭包随之更新
+    client.put(f"/api/tags/{c['id']}", json={"parent_ids": []})
+    assert repo.tag_ancestors(d["id"]) == {a["id"]: 1, c["id"]: 1}
+    assert c["id"] not in repo.tag_descendants(a["id"]) and d["id"] in repo.tag_descendants(c["id"])
+    assert (repo.tag_depth(c["id"]), repo.tag_depth(d["id"])) == (0, 1)  # 存下的最长路径层数同样更新
+    client.put(f"/api/tags/{c['id']}", json={"parent_ids": [b["id"]]})
+    assert repo.tag_depth(d["id"]) == 3
+    assert client.delete(f"/api/tags/{c['id']}").status_code == 400  # 仍有子标签